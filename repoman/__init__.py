@@ -6,10 +6,18 @@ import repoman.repo as repo
 
 from repoman.push import push
 from repoman.pushfile import push_file
-from repoman.create import create, add_platform
-from repoman.cleanup import delete_old, mod_urls, orphan_files, obsolete_files, live_versions
+from repoman.create import create, add_platform, add_storage_partition
+from repoman.cleanup import delete_old, mod_urls, orphan_files, obsolete_files, live_versions, \
+    restore_files
+from repoman.sync import sync
+from repoman.summary import rebuild_summary
+from repoman.stats import stats
+from repoman.gc import gc
+from repoman.caching import set_cache_control, cache_headers
+from repoman.migrate import migrate_storage
+from repoman.snapshot import export, import_collection
 from repoman.command import command, with_collection
-from repoman.backend.disk import DiskBackend
+from repoman.backend.disk import DiskBackend, TRANSFER_STRATEGIES
 from repoman.backend.s3 import S3Backend
 
 def main():
@@ -22,7 +30,22 @@ def main():
     parser.add_argument('--bucket', type=str, default=None,
                         dest='s3_bucket',
                         help='if specified, stores data in the given S3 bucket instead of on disk')
+    parser.add_argument('--s3-concurrency', type=int, default=32,
+                        dest='s3_concurrency',
+                        help="""maximum number of S3 requests to run at once. Fewer
+                        are run while S3 is throttling requests""")
 
+    parser.add_argument('--transfer', type=str, default='auto',
+                        choices=TRANSFER_STRATEGIES, dest='transfer',
+                        help="""how the disk backend copies files into storage. Use
+                        'hardlink' only if the source files are thrown away
+                        afterwards""")
+
+
+    parser.add_argument('--cache-versions', type=int, default=256, dest='cache_versions',
+                        help='maximum number of loaded versions to keep in memory')
+    parser.add_argument('--cache-mb', type=int, default=256, dest='cache_mb',
+                        help='rough maximum size of loaded versions to keep in memory')
 
     subparsers = parser.add_subparsers()
 
@@ -30,19 +53,35 @@ def main():
     add_command(subparsers, push_file)
     add_command(subparsers, create)
     add_command(subparsers, add_platform)
+    add_command(subparsers, add_storage_partition)
+    add_command(subparsers, set_cache_control)
+    add_command(subparsers, cache_headers)
 
     add_command(subparsers, delete_old)
     add_command(subparsers, mod_urls)
     add_command(subparsers, orphan_files)
     add_command(subparsers, obsolete_files)
+    add_command(subparsers, restore_files)
+    add_command(subparsers, gc)
     add_command(subparsers, live_versions)
+    add_command(subparsers, stats)
+
+    add_command(subparsers, sync)
+    add_command(subparsers, rebuild_summary)
+    add_command(subparsers, migrate_storage)
+    add_command(subparsers, export)
+    add_command(subparsers, import_collection)
 
     args = parser.parse_args()
 
+    repo.version_cache.max_entries = args.cache_versions
+    repo.version_cache.max_bytes = args.cache_mb * 1024 * 1024
+
     if args.s3_bucket != None:
-        args.backend = S3Backend(args.s3_bucket)
+        args.backend = S3Backend(args.s3_bucket,
+                                 max_concurrency=args.s3_concurrency)
     else:
-        args.backend = DiskBackend(os.getcwd())
+        args.backend = DiskBackend(os.getcwd(), args.transfer)
 
     try:
         args.command
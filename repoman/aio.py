@@ -0,0 +1,99 @@
+# This file contains asyncio versions of the collection traversals in
+# `repoman.repo`.
+#
+# They build the same `Platform`, `Channel` and `Version` objects as the
+# blocking API, but load platforms, channels and versions concurrently.
+
+import os, asyncio
+
+import repoman.repo as repo
+from repoman.backend.aio import AsyncBackend
+
+
+async def load_platform(abackend, col, name):
+    """
+    Loads a platform, or returns it if the collection already has it loaded.
+    """
+    plat = col.platforms.get(name)
+    if plat != None:
+        return plat
+    path = os.path.join(col.path, name)
+    obj, token = await abackend.read_json_versioned(os.path.join(path, 'channels.json'))
+    if obj == None:
+        raise IOError('No channels.json in {0}.'.format(path))
+
+    # Channels don't read anything until they're used, so they're loaded
+    # right here.
+    plat = repo.Platform(col, name, repo.load_channels(col.backend, path, obj, col.options))
+    plat.channels_token = token
+    # Another coroutine may have loaded the platform while we were reading.
+    return col.platforms.setdefault(name, plat)
+
+async def list_platforms(abackend, col):
+    """
+    Loads all of the collection's platforms at once.
+    """
+    dirs = await abackend.run(col.platform_dirs)
+    results = await asyncio.gather(*[load_platform(abackend, col, d) for d in dirs],
+                                   return_exceptions=True)
+    platforms = []
+    for p in results:
+        # Skip directories which aren't platforms, like file storage.
+        if isinstance(p, IOError):
+            print('Failed loading platform: {0}'.format(str(p)))
+        elif isinstance(p, Exception):
+            raise p
+        else:
+            platforms.append(p)
+    return platforms
+
+async def load_channels(abackend, platforms):
+    """
+    Loads the indexes of all of the given platforms' channels at once and
+    returns the channels which loaded.
+    """
+    chans = [ch for p in platforms for ch in p.channels]
+    results = await asyncio.gather(*[abackend.run(ch.load_index) for ch in chans],
+                                   return_exceptions=True)
+    loaded = []
+    for ch, e in zip(chans, results):
+        if isinstance(e, Exception):
+            print('Failed to load channel "{0}": {1}'.format(ch.path, str(e)))
+        else:
+            loaded.append(ch)
+    return loaded
+
+async def all_latest_versions(abackend, col):
+    """
+    Returns a list of the latest version of every channel in the collection.
+    """
+    chans = await load_channels(abackend, await list_platforms(abackend, col))
+    vsns = await asyncio.gather(*[abackend.run(ch.get_latest_vsn) for ch in chans])
+    return [v for v in vsns if v != None]
+
+async def all_versions_where(abackend, col, pred):
+    """
+    Returns a list of every version in the collection whose ID and name match
+    the given predicate.
+
+    Channels are loaded concurrently, but the versions within a channel are
+    loaded in order, since delta versions depend on earlier ones.
+    """
+    chans = await load_channels(abackend, await list_platforms(abackend, col))
+    results = await asyncio.gather(
+        *[abackend.run(lambda ch: list(ch.all_versions_where(pred)), ch)
+          for ch in chans])
+    return [v for vsns in results for v in vsns]
+
+
+def run(coro_func, col, *args, jobs=16):
+    """
+    Runs one of the coroutines in this module on the given collection's
+    backend and returns its result. This is the blocking entry point for the
+    functions above.
+    """
+    abackend = AsyncBackend(col.backend, jobs)
+    try:
+        return asyncio.run(coro_func(abackend, col, *args))
+    finally:
+        abackend.close()
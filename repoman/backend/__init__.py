@@ -1,12 +1,29 @@
 # This module defines interfaces for the various backends that can be used to
 # store version information.
 
-import os
+import os, io, json, shutil, tempfile
+from contextlib import contextmanager
+
+class ConflictError(Exception):
+    """
+    Raised by `Backend.write_json_if` when the file was changed by someone
+    else since it was read.
+    """
+    pass
 
 class Backend(object):
     """
     Base class for backend storage implementations.
     """
+    # Function which takes the path of a file being written and returns the
+    # value of its `Cache-Control` header, or `None`. Set by the collection
+    # for backends which can store headers.
+    cache_control = None
+    # Whether `archive_file` moves files to the cold tier without changing
+    # their paths. Backends without storage tiers archive files by moving
+    # them into another directory instead.
+    archives_in_place = False
+
     def __init__(self):
         pass
 
@@ -22,6 +39,58 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def open_read(self, path):
+        """
+        Opens the file at the given path for reading and returns a binary file
+        object, so big files can be read a piece at a time.
+
+        Backends which can stream files should override this. By default, the
+        whole file is read first.
+        """
+        return io.BytesIO(json.dumps(self.read_json(path)).encode('utf-8'))
+
+    @contextmanager
+    def open_write(self, path):
+        """
+        Context manager which yields a binary file object. Everything written
+        to it is saved to the given path when the block exits without an
+        error.
+
+        By default, the contents are written to a temporary file and uploaded.
+        """
+        with tempfile.TemporaryFile() as f:
+            yield f
+            f.seek(0)
+            self.upload_fileobj(f, path)
+
+    def read_json_versioned(self, path):
+        """
+        Reads a JSON file from the given path and returns a tuple with the
+        parsed object and a token identifying the file's current contents.
+
+        If the file does not exist, returns `(None, None)`.
+        """
+        raise NotImplementedError()
+
+    def get_token(self, path):
+        """
+        Returns the token `read_json_versioned` would return for the file at
+        the given path, without reading the file if possible. Returns `None`
+        if the file does not exist.
+        """
+        return self.read_json_versioned(path)[1]
+
+    def write_json_if(self, obj, path, token):
+        """
+        Writes a JSON file to the given path, but only if the file's contents
+        still match the given token from `read_json_versioned`. A token of
+        `None` means the file must not exist yet.
+
+        Returns the token for the new contents. Raises `ConflictError` if the
+        file was changed in the meantime.
+        """
+        raise NotImplementedError()
+
     def list_dir(self, path, type='all'):
         """
         Lists all of the files in the given directory.
@@ -38,6 +107,36 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def upload_fileobj(self, fileobj, dest):
+        """
+        Uploads the contents of the given file object to the given `dest` path
+        on the backend. The file object is read from its current position.
+
+        Backends which can upload from a stream should override this. By
+        default, the contents are written to a temporary file first.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='repoman-upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f)
+            self.upload_file(tmp, dest)
+        finally:
+            os.remove(tmp)
+
+    def transfer_summary(self):
+        """
+        Returns a string describing how files were uploaded, or `None` if the
+        backend has nothing interesting to report.
+        """
+        return None
+
+    def download_file(self, src, dest):
+        """
+        Downloads the file at the given `src` path on the backend to the given
+        local `dest` path.
+        """
+        raise NotImplementedError()
+
     def delete_file(self, path):
         """
         Deletes the given file.
@@ -50,6 +149,12 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the file at the given path.
+        """
+        raise NotImplementedError()
+
     def md5_dir(self, path):
         """
         Checks the MD5sum of all of the files in a directory and returns a
@@ -57,15 +162,134 @@ class Backend(object):
 
         This function does not recurse into subdirectories.
         """
-        files = self.list_dir(path, 'files')
         md5_map = dict()
-        for file in files:
-            file_path = os.path.join(path, file)
-            md5_map[self.get_md5(file_path)] = file_path
+        for file, md5 in self.list_md5s(path).items():
+            md5_map[md5] = os.path.join(path, file)
         return md5_map
 
+    def list_md5s(self, path):
+        """
+        Returns a dictionary mapping the names of all of the files in the given
+        directory to their MD5s.
+
+        This function does not recurse into subdirectories. Backends which can
+        get MD5s from a directory listing should override this.
+        """
+        md5s = dict()
+        for file in self.list_dir(path, 'files'):
+            md5s[file] = self.get_md5(os.path.join(path, file))
+        return md5s
+
+    def list_sizes(self, path):
+        """
+        Returns a dictionary mapping the names of all of the files in the given
+        directory to their sizes in bytes.
+
+        This function does not recurse into subdirectories.
+        """
+        sizes = dict()
+        for file in self.list_dir(path, 'files'):
+            sizes[file] = self.get_size(os.path.join(path, file))
+        return sizes
+
+    def walk_files(self, path):
+        """
+        Returns a list of the paths of all of the files in the given directory
+        and its subdirectories, relative to the given directory.
+        """
+        files = list(self.list_dir(path, 'files'))
+        for d in self.list_dir(path, 'dirs'):
+            files += [os.path.join(d, f) for f in self.walk_files(os.path.join(path, d))]
+        return files
+
+    def walk_md5s(self, path):
+        """
+        Like `list_md5s`, but recurses into subdirectories. The keys are paths
+        relative to the given directory.
+        """
+        md5s = dict()
+        for file in self.walk_files(path):
+            md5s[file] = self.get_md5(os.path.join(path, file))
+        return md5s
+
+    def walk_sizes(self, path):
+        """
+        Like `list_sizes`, but recurses into subdirectories. The keys are paths
+        relative to the given directory.
+        """
+        sizes = dict()
+        for file in self.walk_files(path):
+            sizes[file] = self.get_size(os.path.join(path, file))
+        return sizes
+
+    def copy_file(self, src, dest):
+        """
+        Copies the file at the given `src` path to the given `dest` path on the
+        backend.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='repoman-copy-')
+        os.close(fd)
+        try:
+            self.download_file(src, tmp)
+            self.upload_file(tmp, dest)
+        finally:
+            os.remove(tmp)
+
+    def move_file(self, src, dest):
+        """
+        Moves the file at the given `src` path to the given `dest` path on the
+        backend.
+        """
+        self.copy_file(src, dest)
+        self.delete_file(src)
+
+    def archive_file(self, src, dest):
+        """
+        Moves the file at the given `src` path to the given `dest` path on the
+        backend's cheapest storage tier. Backends without storage tiers just
+        move the file. If `archives_in_place` is true, `dest` can be the same
+        as `src`.
+        """
+        self.move_file(src, dest)
+
+    def restore_file(self, src, dest):
+        """
+        Moves a file archived with `archive_file` back to the given `dest`
+        path on the normal storage tier.
+        """
+        self.move_file(src, dest)
+
+    def walk_archived(self, path):
+        """
+        Returns a list of the paths of all of the files in the given directory
+        and its subdirectories which are on the cheapest storage tier,
+        relative to the given directory. Backends without storage tiers have
+        none.
+        """
+        return []
+
     def sanitize_file_name(self, filename):
         """
         Returns a sanitized version of the filename, suitable for the backend
         """
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+
+def list_md5s_or_empty(backend, path):
+    """
+    Lists the MD5s of the files in the given directory, treating a directory
+    which doesn't exist as empty.
+    """
+    try:
+        return backend.list_md5s(path)
+    except OSError:
+        return dict()
+
+def walk_md5s_or_empty(backend, path):
+    """
+    Like `list_md5s_or_empty`, but recurses into subdirectories.
+    """
+    try:
+        return backend.walk_md5s(path)
+    except OSError:
+        return dict()
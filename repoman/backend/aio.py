@@ -0,0 +1,97 @@
+# This module defines asyncio versions of the storage backends.
+#
+# The backends themselves are blocking (file I/O, and boto for S3), so each
+# call is run in a thread pool. This lets callers overlap many small metadata
+# requests with `asyncio.gather` instead of making them one at a time.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncBackend(object):
+    """
+    Wraps a `Backend` and exposes its methods as coroutines.
+    """
+    def __init__(self, backend, jobs=16):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def run(self, func, *args):
+        """
+        Runs the given blocking function in the backend's thread pool and
+        returns an awaitable for its result.
+        """
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown()
+
+    async def read_json(self, path):
+        return await self.run(self.backend.read_json, path)
+
+    async def write_json(self, obj, path):
+        return await self.run(self.backend.write_json, obj, path)
+
+    async def read_json_versioned(self, path):
+        return await self.run(self.backend.read_json_versioned, path)
+
+    async def write_json_if(self, obj, path, token):
+        return await self.run(self.backend.write_json_if, obj, path, token)
+
+    async def list_dir(self, path, type='all'):
+        return await self.run(self.backend.list_dir, path, type)
+
+    async def upload_file(self, src, dest):
+        return await self.run(self.backend.upload_file, src, dest)
+
+    async def download_file(self, src, dest):
+        return await self.run(self.backend.download_file, src, dest)
+
+    async def delete_file(self, path):
+        return await self.run(self.backend.delete_file, path)
+
+    async def get_md5(self, path):
+        return await self.run(self.backend.get_md5, path)
+
+    async def get_size(self, path):
+        return await self.run(self.backend.get_size, path)
+
+    async def list_md5s(self, path):
+        return await self.run(self.backend.list_md5s, path)
+
+    async def list_sizes(self, path):
+        return await self.run(self.backend.list_sizes, path)
+
+    async def walk_files(self, path):
+        return await self.run(self.backend.walk_files, path)
+
+    async def walk_md5s(self, path):
+        return await self.run(self.backend.walk_md5s, path)
+
+    async def walk_sizes(self, path):
+        return await self.run(self.backend.walk_sizes, path)
+
+    async def copy_file(self, src, dest):
+        return await self.run(self.backend.copy_file, src, dest)
+
+    async def move_file(self, src, dest):
+        return await self.run(self.backend.move_file, src, dest)
+
+
+class AsyncDiskBackend(AsyncBackend):
+    """
+    An asyncio backend which writes files to a folder.
+    """
+    def __init__(self, root_dir, jobs=16):
+        from repoman.backend.disk import DiskBackend
+        super().__init__(DiskBackend(root_dir), jobs)
+
+
+class AsyncS3Backend(AsyncBackend):
+    """
+    An asyncio backend which uses Amazon S3.
+    """
+    def __init__(self, bucket_name, jobs=16):
+        from repoman.backend.s3 import S3Backend
+        super().__init__(S3Backend(bucket_name), jobs)
@@ -1,17 +1,65 @@
-from repoman.backend import Backend
+from repoman.backend import Backend, ConflictError
 
-import os, json, hashlib, shutil
+import os, json, hashlib, shutil, time, errno, tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# How long to wait for another process to release a lock file.
+LOCK_TIMEOUT = 30
+# Lock files older than this are assumed to be left over from a crashed
+# process.
+LOCK_STALE_AGE = 120
+
+# Files written through temporary files get the permissions `open` would give
+# them, which depend on the umask. It can only be read by setting it, which
+# isn't safe once there are threads, so it's read once here.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# ioctl request for cloning a file on copy-on-write filesystems like btrfs and
+# XFS (FICLONE from linux/fs.h).
+FICLONE = 0x40049409
+
+# Ways of getting a file into storage, from cheapest to most expensive. `auto`
+# tries `reflink`, `range` and `copy` in that order. `hardlink` is never
+# picked automatically, since the stored file then shares its contents with
+# the source, so it's only safe when the source is thrown away afterwards.
+TRANSFER_STRATEGIES = ['auto', 'reflink', 'hardlink', 'range', 'copy']
+
+# Errors which mean a strategy isn't supported for a particular pair of files,
+# so the next one should be tried.
+UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS,
+                          errno.EOPNOTSUPP, errno.EPERM, errno.EBADF])
 
 class DiskBackend(Backend):
     """
     A storage backend which simply writes files to a folder.
     """
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, transfer='auto'):
+        if transfer not in TRANSFER_STRATEGIES:
+            raise ValueError('Invalid transfer strategy: {0}'.format(transfer))
         self.root_dir = root_dir
+        self.transfer = transfer
+        # Maps the strategies used by `upload_file` to the number of files and
+        # bytes copied with them.
+        self.transfer_stats = dict()
 
     def subpath(self, path):
         return os.path.join(self.root_dir, path)
 
+    def make_parent_dirs(self, path):
+        """
+        Creates the directory that the given file should be written to if it
+        doesn't exist yet.
+        """
+        parent = os.path.dirname(self.subpath(path))
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+
     def read_json(self, path):
         """
         Reads a JSON file from the given path.
@@ -23,9 +71,75 @@ class DiskBackend(Backend):
         """
         Writes a JSON file to the given path.
         """
+        self.make_parent_dirs(path)
         with open(self.subpath(path), 'w') as f:
             json.dump(obj, f)
 
+    def open_read(self, path):
+        return open(self.subpath(path), 'rb')
+
+    @contextmanager
+    def open_write(self, path):
+        """
+        Context manager which yields a file object to write the file at the
+        given path with. The file is written under a temporary name and only
+        renamed into place once the block exits without an error.
+        """
+        self.make_parent_dirs(path)
+        dest = self.subpath(path)
+        tmp = temp_path(dest)
+        try:
+            with open(tmp, 'wb') as f:
+                yield f
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def read_json_versioned(self, path):
+        """
+        Reads a JSON file from the given path and returns a tuple with the
+        parsed object and a token identifying the file's current contents.
+
+        If the file does not exist, returns `(None, None)`.
+        """
+        try:
+            with open(self.subpath(path), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+        return json.loads(data.decode('utf-8')), hashlib.md5(data).hexdigest()
+
+    def write_json_if(self, obj, path, token):
+        """
+        Writes a JSON file to the given path, but only if the file's contents
+        still match the given token from `read_json_versioned`.
+
+        Writers are serialized with a lock file and the new contents are
+        renamed into place, so readers never see a partially written file.
+        """
+        data = json.dumps(obj).encode('utf-8')
+        self.make_parent_dirs(path)
+        full_path = self.subpath(path)
+        with lock_file(full_path + '.lock'):
+            if self.get_token(path) != token:
+                raise ConflictError('{0} was modified by another writer.'.format(path))
+            tmp_path = full_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, full_path)
+        return hashlib.md5(data).hexdigest()
+
+    def get_token(self, path):
+        """
+        Returns the MD5 of the file at the given path, or `None` if the file
+        does not exist.
+        """
+        try:
+            return self.get_md5(path)
+        except FileNotFoundError:
+            return None
+
     def list_dir(self, path_, type='all'):
         """
         Lists all of the files in the given directory.
@@ -45,12 +159,100 @@ class DiskBackend(Backend):
     def upload_file(self, src, dest):
         """
         Uploads a local file from the given `src` path to the given `dest` path
-        on the backend.
+        on the backend, using the backend's transfer strategy.
+
+        Returns a tuple with the name of the strategy which was used and the
+        number of bytes which actually had to be copied.
+        """
+        self.make_parent_dirs(dest)
+        dest_path = self.subpath(dest)
+        if self.transfer == 'auto':
+            strategies = ['reflink', 'range', 'copy']
+        else:
+            strategies = [self.transfer, 'copy']
+        # Pushes of the same new file can upload it at the same time, so
+        # each one writes its own temporary file.
+        tmp = temp_path(dest_path)
+        try:
+            for strategy in strategies:
+                copied = TRANSFERS[strategy](src, tmp)
+                if copied != None:
+                    break
+            os.replace(tmp, dest_path)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        files, total = self.transfer_stats.get(strategy, (0, 0))
+        self.transfer_stats[strategy] = (files + 1, total + copied)
+        return strategy, copied
+
+    def upload_fileobj(self, fileobj, dest):
         """
-        shutil.copyfile(src, self.subpath(dest))
+        Writes the contents of the given file object to the given `dest` path.
+        The file is written under a temporary name and renamed into place, so
+        it never appears half-written.
+        """
+        self.make_parent_dirs(dest)
+        dest_path = self.subpath(dest)
+        tmp = temp_path(dest_path)
+        try:
+            with open(tmp, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, 1024 * 1024)
+                copied = f.tell()
+            os.replace(tmp, dest_path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        files, total = self.transfer_stats.get('stream', (0, 0))
+        self.transfer_stats['stream'] = (files + 1, total + copied)
+
+    def transfer_summary(self):
+        """
+        Returns a string describing how files were uploaded.
+        """
+        if len(self.transfer_stats) == 0:
+            return None
+        return ', '.join('{0} files by {1} ({2} bytes copied)'.format(n, s, b)
+                         for s, (n, b) in sorted(self.transfer_stats.items()))
+
+    def download_file(self, src, dest):
+        """
+        Downloads the file at the given `src` path on the backend to the given
+        local `dest` path.
+        """
+        shutil.copyfile(self.subpath(src), dest)
 
     def delete_file(self, path):
-        os.remove(path)
+        os.remove(self.subpath(path))
+
+    def copy_file(self, src, dest):
+        """
+        Copies the file at the given `src` path to the given `dest` path on the
+        backend, using the backend's transfer strategy.
+        """
+        return self.upload_file(self.subpath(src), dest)
+
+    def move_file(self, src, dest):
+        """
+        Moves the file at the given `src` path to the given `dest` path on the
+        backend.
+        """
+        self.make_parent_dirs(dest)
+        os.replace(self.subpath(src), self.subpath(dest))
+
+    def walk_files(self, path):
+        """
+        Returns a list of the paths of all of the files in the given directory
+        and its subdirectories, relative to the given directory.
+        """
+        root_path = self.subpath(path)
+        files = []
+        for root, dirs, names in os.walk(root_path):
+            rel = os.path.relpath(root, root_path)
+            for name in names:
+                files.append(name if rel == '.' else os.path.join(rel, name))
+        return files
 
     def get_md5(self, path):
         """
@@ -59,8 +261,134 @@ class DiskBackend(Backend):
         with open(self.subpath(path), 'rb') as f:
             return hashlib.md5(f.read()).hexdigest()
 
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the file at the given path.
+        """
+        return os.path.getsize(self.subpath(path))
+
     def sanitize_file_name(self, filename):
         """
         Returns a sanitized version of the filename, suitable for the backend
         """
-        return filename
\ No newline at end of file
+        return filename
+
+
+@contextmanager
+def lock_file(path):
+    """
+    Context manager which holds an exclusive lock file at the given path.
+    """
+    deadline = time.time() + LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > LOCK_STALE_AGE:
+                    print('Removing stale lock file {0}.'.format(path))
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise ConflictError('Timed out waiting for lock {0}.'.format(path))
+            time.sleep(0.05)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        os.remove(path)
+
+
+def temp_path(dest):
+    """
+    Creates an empty file with a unique name next to the given path, to be
+    renamed to it once it's written, and returns the file's path.
+
+    The name starts with a dot and ends with `.tmp`, so it's never mistaken
+    for a storage file or a metadata file.
+    """
+    fd, path = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                prefix='.' + os.path.basename(dest) + '.', suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o666 & ~UMASK)
+    finally:
+        os.close(fd)
+    return path
+
+
+def transfer_reflink(src, dest):
+    """
+    Clones the source file's blocks. Nothing is copied, but this only works
+    within one copy-on-write filesystem.
+    """
+    if fcntl == None:
+        return None
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return None
+            raise
+    return 0
+
+def transfer_hardlink(src, dest):
+    """
+    Links the destination to the source file. Nothing is copied, but this only
+    works within one filesystem.
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return None
+        raise
+    return 0
+
+def transfer_range(src, dest):
+    """
+    Copies the file inside the kernel with `copy_file_range`, or `sendfile` if
+    that isn't available, so the data doesn't pass through user space.
+    """
+    if hasattr(os, 'copy_file_range'):
+        def copy(fin, fout, count, offset):
+            return os.copy_file_range(fin, fout, count, offset, offset)
+    elif hasattr(os, 'sendfile'):
+        def copy(fin, fout, count, offset):
+            return os.sendfile(fout, fin, offset, count)
+    else:
+        return None
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while offset < size:
+            try:
+                n = copy(fsrc.fileno(), fdest.fileno(), size - offset, offset)
+            except OSError as e:
+                if offset == 0 and e.errno in UNSUPPORTED_ERRNOS:
+                    return None
+                raise
+            if n == 0:
+                break
+            offset += n
+    return offset
+
+def transfer_copy(src, dest):
+    """
+    Copies the file the ordinary way.
+    """
+    shutil.copyfile(src, dest)
+    return os.path.getsize(dest)
+
+TRANSFERS = dict(
+    reflink = transfer_reflink,
+    hardlink = transfer_hardlink,
+    range = transfer_range,
+    copy = transfer_copy,
+)
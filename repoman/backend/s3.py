@@ -1,18 +1,59 @@
-from repoman.backend import Backend
+from repoman.backend import Backend, ConflictError
+from repoman.backend.scheduler import RequestScheduler, RetryPolicy
 
-import os, json, hashlib
-import ssl
+import os, json, hashlib, tempfile
+import ssl, socket, http.client
+from contextlib import contextmanager
 
 import boto
 from boto.s3.key import Key
+from boto.exception import S3ResponseError, BotoServerError
+
+# Retry policies for operations which need something other than the default.
+# Listings are cheap to repeat and block everything after them, so they retry
+# for longer.
+RETRY_POLICIES = {
+    'list': RetryPolicy(max_retries=8),
+}
+
+# Files written with `open_write` up to this size are kept in memory until
+# they're uploaded.
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# Storage class of archived files. Unlike Glacier, files in this class can
+# still be downloaded directly.
+COLD_STORAGE_CLASS = 'STANDARD_IA'
 
 class S3Backend(Backend):
     """
     A storage backend which uses Amazon S3.
 
     AWS IDs are read from environment variables.
+
+    All requests go through a `RequestScheduler`, which retries transient
+    errors and limits how many requests run at once. A connection and
+    scheduler can be passed in, for example to run against a local S3
+    stand-in which injects faults.
+
+    Archived files stay where they are and only move to a cheaper storage
+    class, so their URLs keep working.
     """
-    def __init__(self, bucket_name):
+    # Files are archived by changing their storage class.
+    archives_in_place = True
+
+    def __init__(self, bucket_name, conn=None, scheduler=None,
+                 max_concurrency=32):
+        if scheduler == None:
+            scheduler = RequestScheduler(classify_error,
+                                         max_concurrency=max_concurrency,
+                                         policies=RETRY_POLICIES)
+        self.scheduler = scheduler
+        self.cold_storage_class = COLD_STORAGE_CLASS
+
+        if conn != None:
+            self.conn = conn
+            self.bucket = self.request('get_bucket', conn.get_bucket, bucket_name)
+            return
 
         # monkey-patch for boto bug: https://github.com/boto/boto/issues/2836
         _old_match_hostname = ssl.match_hostname
@@ -24,7 +65,25 @@ class S3Backend(Backend):
         ssl.match_hostname = _new_match_hostname
 
         self.conn = boto.connect_s3()
-        self.bucket = self.conn.get_bucket(bucket_name)
+        self.bucket = self.request('get_bucket', self.conn.get_bucket, bucket_name)
+
+    def request(self, op, func, *args, size=0, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` through the request scheduler as the
+        operation with the given name.
+        """
+        return self.scheduler.call(op, lambda: func(*args, **kwargs), size=size)
+
+    def get_key(self, path):
+        return self.request('head', self.bucket.get_key, path)
+
+    def list_keys(self, prefix, delimiter=''):
+        # The listing is fetched lazily page by page, so the whole iteration
+        # has to happen inside the request.
+        return self.request('list', lambda: list(self.bucket.list(prefix, delimiter)))
+
+    def transfer_summary(self):
+        return 'S3: ' + self.scheduler.summary()
 
     def get_contents(self, path):
         """
@@ -32,16 +91,57 @@ class S3Backend(Backend):
         """
         k = Key(self.bucket)
         k.key = path
-        return k.get_contents_as_string().decode('utf-8')
+        data = self.request('get', k.get_contents_as_string)
+        return data.decode('utf-8')
+
+    def open_read(self, path):
+        """
+        Opens the file at the given path for reading. The returned key reads
+        the object's contents from S3 as they're needed.
+        """
+        k = Key(self.bucket)
+        k.key = path
+        self.request('get', k.open_read)
+        return k
+
+    @contextmanager
+    def open_write(self, path):
+        """
+        Context manager which yields a file object to write the JSON file at
+        the given path with. Uploads need to know their size, so what's
+        written is kept in memory, or in a temporary file if it gets big, and
+        uploaded when the block exits.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+            yield f
+            size = f.tell()
+            k = self.new_key(path)
+            k.set_metadata('Content-Type', 'application/json')
+            def upload():
+                f.seek(0)
+                k.set_contents_from_file(f, size=size)
+            self.request('put', upload, size=size)
 
     def set_contents(self, string, path):
         """
         Sets the contents of the file at the given path to the given string.
         """
+        k = self.new_key(path)
+        k.set_metadata('Content-Type', 'application/json')
+        self.request('put', k.set_contents_from_string, string, size=len(string))
+
+    def new_key(self, path):
+        """
+        Returns a new key for writing to the given path, with the collection's
+        caching policy applied.
+        """
         k = Key(self.bucket)
         k.key = path
-        k.set_metadata('Content-Type', 'application/json')
-        k.set_contents_from_string(string)
+        if self.cache_control != None:
+            header = self.cache_control(path)
+            if header != None:
+                k.set_metadata('Cache-Control', header)
+        return k
 
     def sanitize_file_name(self, filename):
         """
@@ -61,6 +161,56 @@ class S3Backend(Backend):
         """
         return self.set_contents(json.dumps(obj), path)
 
+    def read_json_versioned(self, path):
+        """
+        Reads a JSON file from the given path and returns a tuple with the
+        parsed object and the object's ETag.
+
+        If the file does not exist, returns `(None, None)`.
+        """
+        k = self.get_key(path)
+        if k == None: return None, None
+        # The GET updates the key's ETag, so it matches the contents we read.
+        data = self.request('get', k.get_contents_as_string).decode('utf-8')
+        return json.loads(data), k.etag
+
+    def get_token(self, path):
+        """
+        Returns the ETag of the object at the given path with a HEAD request,
+        or `None` if it does not exist.
+        """
+        k = self.get_key(path)
+        if k == None: return None
+        return k.etag
+
+    def write_json_if(self, obj, path, token):
+        """
+        Writes a JSON file to the given path, but only if the object's ETag
+        still matches the given token from `read_json_versioned`.
+
+        This uses S3's conditional writes, so the check and the write happen
+        atomically on the server.
+        """
+        if token == None:
+            headers = {'If-None-Match': '*'}
+        else:
+            headers = {'If-Match': token}
+        k = self.new_key(path)
+        k.set_metadata('Content-Type', 'application/json')
+        data = json.dumps(obj)
+        try:
+            self.request('put', k.set_contents_from_string, data,
+                         headers=headers, size=len(data))
+        except S3ResponseError as e:
+            # 409 is returned when a concurrent conditional write to the same
+            # key wins the race. These are never retried by the scheduler. If
+            # a retried write already went through the first time, it fails
+            # here too, and the caller reloads and finds its own changes.
+            if e.status in (409, 412):
+                raise ConflictError('{0} was modified by another writer.'.format(path))
+            raise
+        return k.etag
+
     def list_dir(self, path, type='all'):
         """
         Lists all of the files in the given directory non-recursively.
@@ -72,9 +222,11 @@ class S3Backend(Backend):
             raise ValueError('Invalid list_dir type: {0}'.format(type))
 
         list = []
-        keys = [n.key for n in self.bucket.list(path)]
+        keys = [n.key for n in self.list_keys(path)]
         if type == 'files' or type == 'all':
-            list += [k for k in keys if is_file_key(k)]
+            # The listing includes keys in subdirectories too.
+            dir = path.rstrip('/')
+            list += [k for k in keys if is_file_key(k) and os.path.dirname(k) == dir]
         if type == 'dirs' or type == 'all':
             list += key_dirs(path, keys)
         return [path_last_component(p) for p in list]
@@ -84,26 +236,169 @@ class S3Backend(Backend):
         Uploads a local file from the given `src` path to the given `dest` path
         on the backend.
         """
-        k = Key(self.bucket)
-        k.key = dest
-        k.set_contents_from_filename(src)
+        k = self.new_key(dest)
+        self.request('put', k.set_contents_from_filename, src,
+                     size=os.path.getsize(src))
+
+    def upload_fileobj(self, fileobj, dest):
+        """
+        Uploads the contents of the given file object to the given `dest` path.
+        The file object has to be seekable, so failed uploads can be retried.
+        """
+        k = self.new_key(dest)
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        def upload():
+            fileobj.seek(start)
+            k.set_contents_from_file(fileobj, size=size)
+        self.request('put', upload, size=size)
+
+    def download_file(self, src, dest):
+        """
+        Downloads the file at the given `src` path on the backend to the given
+        local `dest` path.
+        """
+        k = self.get_key(src)
+        if k == None:
+            raise IOError('{0} does not exist.'.format(src))
+        self.request('get', k.get_contents_to_filename, dest, size=k.size)
+
+    def copy_file(self, src, dest):
+        """
+        Copies the file at the given `src` path to the given `dest` path on the
+        backend. The copy happens inside S3.
+        """
+        self.request('copy', self.bucket.copy_key, dest, self.bucket.name, src,
+                     preserve_acl=True)
+
+    def archive_file(self, src, dest):
+        """
+        Moves the file at the given `src` path to the given `dest` path and
+        into the cold storage class. If the paths are the same, the key is
+        copied onto itself, which only changes its storage class.
+        """
+        self.request('copy', self.bucket.copy_key, dest, self.bucket.name, src,
+                     storage_class=self.cold_storage_class, preserve_acl=True)
+        if dest != src:
+            self.delete_file(src)
+
+    def restore_file(self, src, dest):
+        """
+        Moves an archived file back to the given `dest` path and into the
+        standard storage class. Like with `archive_file`, the paths can be
+        the same.
+        """
+        self.request('copy', self.bucket.copy_key, dest, self.bucket.name, src,
+                     storage_class='STANDARD', preserve_acl=True)
+        if dest != src:
+            self.delete_file(src)
+
+    def walk_archived(self, path):
+        """
+        Returns the paths of the files under the given directory which are in
+        the cold storage class, taken from the bucket listing.
+        """
+        return [p for p, k in self.walk_keys(path).items()
+                if k.storage_class == self.cold_storage_class]
 
     def delete_file(self, path):
         """
-        Uploads a local file from the given `src` path to the given `dest` path
-        on the backend.
+        Deletes the given file.
         """
-        k = self.bucket.get_key(path)
-        k.delete()
+        self.request('delete', self.bucket.delete_key, path)
 
     def get_md5(self, path):
         """
         Returns a hex digest of the MD5sum of the file at the given path.
         """
-        k = self.bucket.get_key(path)
+        k = self.get_key(path)
         if k == None: return None
         return k.etag.strip('"')
 
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the file at the given path.
+        """
+        k = self.get_key(path)
+        if k == None: return None
+        return k.size
+
+    def list_md5s(self, path):
+        """
+        Returns a dictionary mapping the names of all of the files in the given
+        directory to their MD5s.
+
+        The MD5s are taken from the ETags in the bucket listing, so this only
+        takes one request per thousand keys.
+        """
+        prefix = path if path == '' or path.endswith('/') else path + '/'
+        md5s = dict()
+        for k in self.list_keys(prefix, '/'):
+            if isinstance(k, Key) and is_file_key(k.name):
+                md5s[path_last_component(k.name)] = k.etag.strip('"')
+        return md5s
+
+    def walk_files(self, path):
+        """
+        Returns a list of the paths of all of the files in the given directory
+        and its subdirectories, relative to the given directory.
+        """
+        return list(self.walk_keys(path).keys())
+
+    def walk_md5s(self, path):
+        """
+        Like `list_md5s`, but recurses into subdirectories. This only takes
+        one listing request per thousand keys, however deep the tree is.
+        """
+        return dict((p, k.etag.strip('"')) for p, k in self.walk_keys(path).items())
+
+    def walk_sizes(self, path):
+        """
+        Like `list_sizes`, but recurses into subdirectories.
+        """
+        return dict((p, k.size) for p, k in self.walk_keys(path).items())
+
+    def walk_keys(self, path):
+        """
+        Returns a dictionary mapping the paths of all keys under the given
+        directory, relative to it, to the keys from the bucket listing.
+        """
+        prefix = path if path == '' or path.endswith('/') else path + '/'
+        keys = dict()
+        for k in self.list_keys(prefix):
+            if is_file_key(k.name):
+                keys[k.name[len(prefix):]] = k
+        return keys
+
+    def list_sizes(self, path):
+        """
+        Returns a dictionary mapping the names of all of the files in the given
+        directory to their sizes in bytes, using the bucket listing.
+        """
+        prefix = path if path == '' or path.endswith('/') else path + '/'
+        sizes = dict()
+        for k in self.list_keys(prefix, '/'):
+            if isinstance(k, Key) and is_file_key(k.name):
+                sizes[path_last_component(k.name)] = k.size
+        return sizes
+
+
+def classify_error(e):
+    """
+    Tells the request scheduler whether an error from boto is worth retrying
+    and whether it means S3 is throttling us.
+
+    Server errors and network errors are retried. Client errors, including
+    failed conditional writes, are not.
+    """
+    if isinstance(e, BotoServerError):
+        throttle = e.status in (429, 503) or e.error_code == 'SlowDown'
+        retry = throttle or e.status >= 500 or e.error_code == 'RequestTimeout'
+        return retry, throttle
+    if isinstance(e, (ConnectionError, socket.timeout, http.client.HTTPException)):
+        return True, False
+    return False, False
+
 
 def is_file_key(path):
     """Returns True if the given S3 key is a file."""
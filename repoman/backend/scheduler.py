@@ -0,0 +1,139 @@
+# This module contains a scheduler for backend requests which handles retries
+# and limits how many requests run at once.
+
+import time, random, threading
+
+
+class RetryPolicy(object):
+    """
+    How often and how long to retry a failed request.
+
+    Delays use exponential backoff with full jitter: the n-th retry waits a
+    random time between zero and `base_delay * 2**n`, capped at `max_delay`.
+    """
+    def __init__(self, max_retries=5, base_delay=0.1, max_delay=20.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RequestScheduler(object):
+    """
+    Runs backend requests with retries and adaptive concurrency.
+
+    `classify` is a function which takes an exception raised by a request and
+    returns a tuple of two booleans: whether the request should be retried,
+    and whether the error means the server is throttling us.
+
+    The number of requests allowed to run at once is adjusted like TCP's
+    AIMD congestion control. Each successful request raises the limit a
+    little, by `1 / limit`, and each throttling error halves it. The limit
+    never goes below one or above `max_concurrency`.
+
+    `policies` maps operation names to `RetryPolicy` objects for operations
+    which need different retry behaviour than `default_policy`.
+    """
+    def __init__(self, classify, max_concurrency=32, initial_concurrency=8,
+                 default_policy=None, policies=None, sleep=time.sleep):
+        self.classify = classify
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.default_policy = default_policy if default_policy != None else RetryPolicy()
+        self.policies = policies if policies != None else dict()
+        self.sleep = sleep
+
+        self.cond = threading.Condition()
+        self.active = 0
+        # When the limit was last halved. Throttling errors from requests which
+        # were already running at the time don't halve it again.
+        self.last_decrease = 0
+
+        self.started = time.time()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def call(self, op, func, *args, size=0):
+        """
+        Runs `func(*args)` as the operation with the given name, retrying it
+        according to the operation's retry policy, and returns its result.
+
+        `size` is the number of bytes the request transfers, for the
+        throughput metrics.
+        """
+        policy = self.policies.get(op, self.default_policy)
+        attempt = 0
+        while True:
+            self.acquire()
+            started = time.time()
+            try:
+                result = func(*args)
+            except Exception as e:
+                retry, throttle = self.classify(e)
+                self.release('throttled' if throttle else 'failed', started)
+                if not retry or attempt >= policy.max_retries:
+                    with self.cond:
+                        self.failures += 1
+                    raise
+                with self.cond:
+                    self.retries += 1
+                delay = policy.delay(attempt)
+                print('{0} failed ({1}), retrying in {2:.2f}s.'.format(op, e, delay))
+                self.sleep(delay)
+                attempt += 1
+                continue
+            self.release('ok', started)
+            with self.cond:
+                self.requests += 1
+                self.bytes += size
+            return result
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, outcome, started):
+        """
+        Frees a request slot and adjusts the concurrency limit based on the
+        request's outcome, which is 'ok', 'throttled' or 'failed'.
+        """
+        with self.cond:
+            self.active -= 1
+            if outcome == 'throttled':
+                self.throttled += 1
+                if started >= self.last_decrease:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.time()
+            elif outcome == 'ok':
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def metrics(self):
+        """
+        Returns a dictionary of statistics about the requests made so far.
+        """
+        with self.cond:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return dict(
+                requests = self.requests,
+                retries = self.retries,
+                throttled = self.throttled,
+                failures = self.failures,
+                concurrency_limit = int(self.limit),
+                requests_per_second = self.requests / elapsed,
+                bytes_per_second = self.bytes / elapsed,
+            )
+
+    def summary(self):
+        m = self.metrics()
+        return ('{requests} requests ({retries} retries, {throttled} throttled, '
+                '{failures} failed), concurrency limit {concurrency_limit}, '
+                '{requests_per_second:.1f} requests/s, {bytes_per_second:.0f} bytes/s'
+                .format(**m))
@@ -0,0 +1,76 @@
+# The "set-cache-control" and "cache-headers" commands manage the caching
+# headers clients and CDNs see for a collection's files.
+
+import re
+from urllib.parse import urlparse
+
+import repoman.repo as repo
+from repoman.command import command, Argument, with_collection
+
+
+@command('set-cache-control',
+         Argument('kind', choices=repo.FILE_KINDS, help='kind of file to set the header for'),
+         Argument('value', help='the Cache-Control header, or "" for none'),
+         description="""
+         Sets the Cache-Control header new files of the given kind are written
+         with. Files which already exist keep their headers until they're
+         written again.
+         """,
+)
+@with_collection
+def set_cache_control(collection, kind, value, **kwargs):
+    policy = collection.cache_control()
+    policy[kind] = value if value != '' else None
+    collection.options['cache_control'] = policy
+    collection.save()
+
+
+@command('cache-headers',
+         Argument('--output', type=str, default=None,
+                  help='file to write the configuration to, instead of printing it'),
+         description="""
+         Writes an nginx map from URIs to the collection's Cache-Control
+         headers, for collections served from disk.
+         """,
+)
+@with_collection
+def cache_headers(collection, output, **kwargs):
+    conf = nginx_header_map(collection)
+    if output == None:
+        print(conf, end='')
+    else:
+        with open(output, 'w') as f:
+            f.write(conf)
+        print('Wrote {0}.'.format(output))
+
+
+def nginx_header_map(collection):
+    """
+    Returns an nginx `map` from request URIs to the collection's
+    Cache-Control headers.
+
+    The patterns follow `Collection.file_kind`, and nginx uses the first one
+    which matches.
+    """
+    policy = collection.cache_control()
+    base = urlparse(collection.url).path.rstrip('/')
+    rules = []
+    for part in collection.storage.partitions():
+        rules.append(('storage', '^' + re.escape(urlparse(part.url).path.rstrip('/') + '/')))
+    rules += [
+        ('config',   '^{0}/gc/'.format(re.escape(base))),
+        ('config',   '^{0}/[^/]+$'.format(re.escape(base))),
+        ('platform', '^{0}/[^/]+/channels\\.json$'.format(re.escape(base))),
+        ('index',    '^{0}/[^/]+/[^/]+/(index|head)\\.json$'.format(re.escape(base))),
+        ('version',  '^{0}/'.format(re.escape(base))),
+    ]
+    lines = ['# Generated by repoman cache-headers. Include this in the http block and',
+             '# add this to the server block serving the collection:',
+             '#     add_header Cache-Control $repoman_cache_control;',
+             'map $uri $repoman_cache_control {',
+             '    default "";']
+    for kind, pattern in rules:
+        header = policy.get(kind)
+        lines.append('    "~{0}" "{1}";'.format(pattern, header if header != None else ''))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
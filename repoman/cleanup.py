@@ -1,6 +1,7 @@
 # The "cleanup" command removes all versions older than a certain ID from a channel.
 
 import os, re
+from concurrent.futures import ThreadPoolExecutor
 
 import repoman.repo as repo
 from repoman.command import command, Argument, with_channel, with_collection
@@ -11,28 +12,119 @@ from repoman.storage import FileStorage
 @command('mod-urls',
          Argument('match', help='regex pattern to replace'),
          Argument('replace', help='string to replace the pattern with'),
+         Argument('--prefix', action='store_true',
+                  help='treat `match` as a literal URL prefix instead of a regex'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of channels to process at once'),
          Argument('--commit', action='store_true', help='if not given, changes are only simulated'),
          description='Perform a regex replace on all of a repo\'s URLs',
 )
 @with_collection
-def mod_urls(collection, match, replace, commit, **kwargs):
-    # For every single version, update file URLs.
-    for vsn in collection.all_versions_where(lambda id, name: True):
-        for f in vsn.files:
-            f.sources = [mod_url(match, replace, url) for url in f.sources]
-        if commit: vsn.save()
+def mod_urls(collection, match, replace, prefix, jobs, commit, **kwargs):
+    rewriter = UrlRewriter(match, replace, prefix)
+    platforms = list(collection.list_platforms())
+    chans = [ch for plat in platforms for ch in plat.channels]
+
+    # For every single version, update file URLs. Channels are independent,
+    # so they're processed in parallel, and only versions whose URLs actually
+    # changed are saved.
+    def mod_channel(chan):
+        changed = 0
+        for vsn in chan.all_versions_where(lambda id, name: True, cached=False):
+            vsn_changed = False
+            for f in vsn.files:
+                sources = [rewriter.rewrite(url) for url in f.sources]
+                if sources != f.sources:
+                    f.sources = sources
+                    vsn_changed = True
+            if vsn_changed:
+                changed += 1
+                if commit: vsn.save()
+        # Change manifests list URLs too.
+        manifests = chan.rewrite_change_manifests(rewriter.rewrite, commit)
+        return changed, manifests
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(mod_channel, chans))
+    changed_vsns = sum(r[0] for r in results)
+    changed_manifests = sum(r[1] for r in results)
 
     # For every platform, update channel URLs.
-    for plat in collection.list_platforms():
+    changed_plats = 0
+    for plat in platforms:
+        plat_changed = False
         for chan in plat.channels:
-            chan.url = mod_url(match, replace, chan.url)
-        if commit: plat.save()
+            url = rewriter.rewrite(chan.url)
+            if url != chan.url:
+                chan.url = url
+                plat_changed = True
+        if plat_changed:
+            changed_plats += 1
+            if commit: plat.save()
+
+    for url, new in rewriter.examples():
+        print('Changing "{0}" to "{1}".'.format(url, new))
+    if len(rewriter.changes) > len(rewriter.examples()):
+        print('... and {0} more.'.format(len(rewriter.changes) - len(rewriter.examples())))
+    print('{0} distinct URLs changed in {1} versions, {2} change manifests and {3} platforms.{4}'
+          .format(len(rewriter.changes), changed_vsns, changed_manifests, changed_plats,
+                  '' if commit else ' Nothing was saved.'))
+
+
+class UrlRewriter(object):
+    """
+    Class which replaces a pattern in URLs.
+
+    The same storage URLs show up in many versions, so results are cached.
+    Plain patterns are replaced with `str.replace` or prefix checks instead of
+    regexes, and regexes are compiled once.
+    """
+    # How many changes `examples` returns.
+    max_examples = 10
+
+    def __init__(self, match, replace, prefix=False):
+        self.match = match
+        self.replace = replace
+        if prefix:
+            self.rewrite_uncached = self.rewrite_prefix
+        elif re.escape(match) == match and '\\' not in replace:
+            # No special characters, so a plain string replace does the same
+            # as the regex.
+            self.rewrite_uncached = self.rewrite_literal
+        else:
+            self.pattern = re.compile(match)
+            self.rewrite_uncached = self.rewrite_regex
+        self.cache = dict()
+        # Maps every URL which was changed to its new value.
+        self.changes = dict()
+
+    def rewrite(self, url):
+        """
+        Returns the given URL with the pattern replaced.
+        """
+        new = self.cache.get(url)
+        if new == None:
+            new = self.cache[url] = self.rewrite_uncached(url)
+            if new != url:
+                self.changes[url] = new
+        return new
+
+    def rewrite_prefix(self, url):
+        if url.startswith(self.match):
+            return self.replace + url[len(self.match):]
+        return url
 
+    def rewrite_literal(self, url):
+        return url.replace(self.match, self.replace)
+
+    def rewrite_regex(self, url):
+        return self.pattern.sub(self.replace, url)
+
+    def examples(self):
+        """
+        Returns a few of the changes which were made, as `(old, new)` tuples.
+        """
+        return sorted(self.changes.items())[:self.max_examples]
 
-def mod_url(match, replace, url):
-    new = re.sub(match, replace, url)
-    print('Changing "{0}" to "{1}.'.format(url, new))
-    return new
 
 @command('delete-before',
          Argument('platform'),
@@ -72,11 +164,22 @@ def orphan_files(collection, delete, **kwargs):
 
 @command('obsolete-files',
          Argument('--delete', action='store_true', help='if given, kill obsolete files'),
-         description="""Removes obsolete files from storage.""",
+         Argument('--archive', action='store_true',
+                  help='if given, move obsolete files to the cold storage tier'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of files to archive at once'),
+         description="""
+         Removes obsolete files, which no channel's latest version uses, from
+         storage. Archived files can be brought back with restore-files, and
+         push restores them automatically when they're needed again.
+         """,
 )
 @with_collection
-def obsolete_files(collection, delete, **kwargs):
+def obsolete_files(collection, delete, archive, jobs, **kwargs):
     storage = collection.storage
+    if delete and archive:
+        print('Only one of --delete and --archive can be given.')
+        exit(-1)
 
     # Load a set of all files used.
     files = latest_files(collection)
@@ -84,11 +187,58 @@ def obsolete_files(collection, delete, **kwargs):
     storage_files = set(storage.get_all_files())
     # Subtract used files.
     to_delete = storage_files - files
+    if archive:
+        # Load the MD5s once up front, not in every worker thread.
+        storage.load_md5s()
+        # Files archived in place are still listed in storage.
+        to_delete -= set(storage.get_archived_files())
     to_keep = storage_files - to_delete
     print('{0}'.format("\n".join(str(e) for e in to_delete)))
     if delete:
         for f in to_delete:
             storage.remove_file(f)
+    elif archive:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(storage.archive_file, to_delete):
+                pass
+        print('Archived {0} files.'.format(len(to_delete)))
+
+@command('restore-files',
+         Argument('files', nargs='*', help='names of the archived files to restore'),
+         Argument('--all', action='store_true', dest='restore_all',
+                  help='restore all archived files'),
+         Argument('--linked', action='store_true',
+                  help='restore the archived files which any version links to'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of files to restore at once'),
+         description="""
+         Moves files archived by obsolete-files back into storage. Without any
+         arguments, lists the archived files.
+         """,
+)
+@with_collection
+def restore_files(collection, files, restore_all, linked, jobs, **kwargs):
+    storage = collection.storage
+    archived = storage.get_archived_files()
+    if restore_all:
+        names = set(archived)
+    elif linked:
+        names = linked_files(collection) & set(archived)
+    else:
+        names = set(files)
+    if len(names) == 0:
+        print('{0}'.format("\n".join(sorted(archived))))
+        print('{0} archived files.'.format(len(archived)))
+        return
+
+    missing = names - set(archived)
+    if len(missing) > 0:
+        print('Not archived: {0}'.format(', '.join(sorted(missing))))
+        exit(-1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for _ in pool.map(lambda n: storage.restore_md5(archived[n]), names):
+            pass
+    print('Restored {0} files.'.format(len(names)))
 
 @command('live-versions',
          description="""Lists versions that are not missing files.""",
@@ -98,7 +248,7 @@ def live_versions(collection, **kwargs):
     storage = collection.storage
     storage_files = set(storage.get_all_files())
     present_files = set()
-    for vsn in collection.all_versions_where(lambda id, name: True):
+    for vsn in collection.all_versions_where(lambda id, name: True, cached=False):
         files = set()
         for f in vsn.files:
             for src in f.sources:
@@ -115,7 +265,7 @@ def linked_files(collection):
     collection.
     """
     files = set()
-    for vsn in collection.all_versions_where(lambda id, name: True):
+    for vsn in collection.all_versions_where(lambda id, name: True, cached=False):
         for f in vsn.files:
             for src in f.sources:
                 files.add(os.path.basename(src))
@@ -127,7 +277,8 @@ def latest_files(collection):
     collection.
     """
     files = set()
-    for vsn in collection.all_latest_versions():
+    # The summary could be out of date, so read the channel indexes.
+    for vsn in collection.all_latest_versions(use_summary=False):
         for f in vsn.files:
             for src in f.sources:
                 files.add(os.path.basename(src))
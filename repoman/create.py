@@ -17,13 +17,41 @@ from repoman.command import command, Argument, with_collection
                   collection's root directory"""),
          Argument('storage_url', help=
                   """URL of the file storage's root directory"""),
+         Argument('--history-page-size', type=int, default=None, help=
+                  """if given, channel histories are split into archive pages
+                  of this many versions and a small head file"""),
+         Argument('--index-limit', type=int, default=None, help=
+                  """maximum number of versions to list in each channel's
+                  index.json when histories are split"""),
+         Argument('--delta-snapshot-interval', type=int, default=None, help=
+                  """if given, versions are also saved as deltas from the
+                  previous version, with a full snapshot every this many
+                  versions"""),
+         Argument('--change-manifests', type=int, default=None, help=
+                  """if given, push also publishes lists of the files which
+                  changed from each of this many previous versions"""),
          description='Creates a new collection.')
-def create(backend, path, url, storage_path, storage_url, **kwargs):
+def create(backend, path, url, storage_path, storage_url,
+           history_page_size, index_limit, delta_snapshot_interval,
+           change_manifests, **kwargs):
     if not os.path.isdir(path):
         os.mkdir(path)
     store = storage.FileStorage(backend, storage_path, storage_url)
-    collection = repo.Collection(backend, path, url, store)
+    options = dict()
+    if history_page_size != None:
+        options['history'] = dict(page_size = history_page_size)
+        if index_limit != None:
+            options['history']['index_limit'] = index_limit
+    if delta_snapshot_interval != None:
+        options['delta_versions'] = dict(snapshot_interval = delta_snapshot_interval)
+    if change_manifests != None:
+        options['change_manifests'] = dict(count = change_manifests)
+    collection = repo.Collection(backend, path, url, store, options)
     collection.save()
+    # The collection has no channels yet, so an empty summary is complete,
+    # and push keeps it up to date from here.
+    backend.write_json(dict(format_version = 0, platforms = dict()),
+                       collection.summary_path())
 
 @command("add-platform",
          Argument('id', help=
@@ -33,3 +61,35 @@ def create(backend, path, url, storage_path, storage_url, **kwargs):
 def add_platform(backend, collection, id, **kwargs):
     plat = collection.new_platform(id)
     plat.save()
+
+@command("add-storage-partition",
+         Argument('name', help=
+                  """the partition's name"""),
+         Argument('path', help=
+                  """path to the partition's storage directory"""),
+         Argument('url', help=
+                  """URL of the partition's storage directory"""),
+         Argument('--bucket', type=str, default=None, help=
+                  """S3 bucket the partition is in, if not the collection's"""),
+         Argument('--dir', type=str, default=None, help=
+                  """local directory the partition is in, if not the
+                  collection's"""),
+         description="""
+         Adds a storage partition. New files are spread over the partitions by
+         their MD5s. Existing files stay where they are.
+         """)
+@with_collection
+def add_storage_partition(collection, name, path, url, bucket, dir, **kwargs):
+    config = collection.options.setdefault('storage_partitions', dict(partitions = []))
+    names = [storage.DEFAULT_PARTITION] + [p['name'] for p in config['partitions']]
+    if name in names:
+        print('There is already a storage partition named "{0}".'.format(name))
+        exit(-1)
+    obj = dict(name = name, path = path, url = url)
+    if bucket != None: obj['bucket'] = bucket
+    if dir != None: obj['dir'] = dir
+    config['partitions'].append(obj)
+    # Check that the new partition works with the others before saving it.
+    storage.load_storage(collection.backend, collection.storage.path,
+                         collection.storage.url, collection.options)
+    collection.save()
@@ -0,0 +1,129 @@
+# The "gc" command removes unused storage files without stopping pushes.
+
+import os, time, socket
+
+from repoman.command import command, Argument, with_collection
+from repoman.cleanup import linked_files
+from repoman.storage import BLOB_NAME_RE
+
+# Leases older than this many seconds are left over from pushes which died,
+# and are ignored.
+LEASE_TIMEOUT = 24 * 60 * 60
+
+
+@command('gc',
+         Argument('--grace', type=float, default=6.0, help=
+                  """hours a file must stay unused before it's deleted. This
+                  must be longer than the longest push takes"""),
+         Argument('--commit', action='store_true', help='if not given, nothing is deleted'),
+         description="""
+         Deletes storage files which no version links to, safely while pushes
+         are running. Each run marks newly unused files with a tombstone and
+         deletes files whose tombstones are older than the grace period and
+         which are still unused. Files in use by running pushes are never
+         deleted. Run it regularly, for example from cron.
+         """,
+)
+@with_collection
+def gc(collection, grace, commit, **kwargs):
+    storage = collection.storage
+    b = collection.backend
+    now = time.time()
+
+    # List storage before versions, so a file uploaded by a push in between
+    # is either missed by the listing or linked by the time versions are read.
+    stored = set(storage.get_all_files())
+    linked = linked_files(collection)
+    unused = stored - linked
+
+    obj = b.read_json_versioned(tombstones_path(collection))[0]
+    old = obj['tombstones'] if obj != None else dict()
+    # Files which are used again, or were deleted some other way, lose their
+    # tombstones.
+    tombstones = dict((n, t) for n, t in old.items() if n in unused)
+    for name in unused - set(tombstones):
+        tombstones[name] = now
+    expired = set(n for n, t in tombstones.items() if now - t >= grace * 3600)
+
+    # Read leases last, right before deleting.
+    leased = leased_md5s(collection, now)
+    to_delete = sorted(n for n in expired if name_md5(n) not in leased)
+    print('{0} unused files, {1} newly marked, {2} past the grace period, {3} in use by pushes.'
+          .format(len(unused), len(unused - set(old)), len(expired),
+                  len(expired) - len(to_delete)))
+    for name in to_delete:
+        # A push may have started using the file since we read the leases,
+        # so read them again right before deleting it.
+        if commit and name_md5(name) in leased_md5s(collection, time.time()):
+            print('Keep: {0} (now in use by a push)'.format(name))
+            continue
+        print('Delete: {0}'.format(name))
+        if commit:
+            storage.remove_file(name)
+            del tombstones[name]
+    if commit:
+        b.write_json(dict(format_version = 0, tombstones = tombstones),
+                     tombstones_path(collection))
+    else:
+        print('Nothing was saved.')
+
+
+class Lease(object):
+    """
+    Class which tells `gc` which files a running push is using, so it doesn't
+    delete them before the push's version is saved.
+
+    The lease is a file in the collection's `gc/leases` directory listing
+    MD5s. It's deleted by `release`, and ignored by `gc` once it's older than
+    `LEASE_TIMEOUT`, so a push which dies doesn't block `gc` forever.
+    """
+    def __init__(self, collection):
+        self.backend = collection.backend
+        self.path = os.path.join(leases_dir(collection), '{0}-{1}-{2}.json'
+                                 .format(socket.gethostname(), os.getpid(), int(time.time())))
+        self.md5s = set()
+
+    def hold(self, md5s):
+        """
+        Adds the given MD5s to the lease and saves it.
+        """
+        self.md5s |= set(md5s)
+        self.backend.write_json(dict(created = time.time(), md5s = sorted(self.md5s)),
+                                self.path)
+
+    def release(self):
+        if len(self.md5s) > 0:
+            self.backend.delete_file(self.path)
+            self.md5s = set()
+
+
+def leased_md5s(collection, now):
+    """
+    Returns the set of MD5s held by all leases which haven't timed out.
+    """
+    b = collection.backend
+    md5s = set()
+    try:
+        names = b.list_dir(leases_dir(collection), 'files')
+    except OSError:
+        return md5s
+    for name in names:
+        try:
+            obj, _ = b.read_json_versioned(os.path.join(leases_dir(collection), name))
+        except ValueError:
+            # The lease is being written right now.
+            continue
+        # Released leases disappear while we're listing.
+        if obj != None and now - obj['created'] < LEASE_TIMEOUT:
+            md5s |= set(obj['md5s'])
+    return md5s
+
+def name_md5(name):
+    m = BLOB_NAME_RE.match(name)
+    return m.group(1) if m != None else None
+
+def leases_dir(collection):
+    return os.path.join(collection.path, 'gc', 'leases')
+
+def tombstones_path(collection):
+    return os.path.join(collection.path, 'gc', 'tombstones.json')
@@ -0,0 +1,118 @@
+# This module contains the journal which lets an interrupted push resume where
+# it stopped.
+
+import os, json, time, hashlib
+
+# Where journals are kept unless push is told otherwise.
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'repoman', 'journals')
+
+# How often the journal is saved while pushing, in seconds.
+FLUSH_INTERVAL = 5.0
+
+# Journals older than this many seconds are deleted.
+JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class PushJournal(object):
+    """
+    Class which records the progress of a push in a local file.
+
+    The journal is named after a fingerprint of the push's destination and of
+    the paths, sizes and modification times of every file in the build tree,
+    so it's only picked up again by a push of exactly the same files. It
+    records the MD5 of every file which was hashed and whether the version
+    was saved. Files which were uploaded don't need to be recorded, since
+    they're found in storage like any other.
+
+    The journal file is always replaced atomically, so an interrupted push
+    never leaves a broken journal behind.
+    """
+    @classmethod
+    def open(cls, journal_dir, key, tree):
+        """
+        Opens the journal for pushing the build tree at the given path. `key`
+        is a list of strings identifying the destination of the push.
+        """
+        # Push changes to the build directory, so relative paths would break.
+        journal_dir = os.path.abspath(journal_dir)
+        os.makedirs(journal_dir, exist_ok=True)
+        prune_journals(journal_dir)
+        fingerprint = tree_fingerprint(key, tree)
+        path = os.path.join(journal_dir, fingerprint + '.json')
+        journal = cls(path, fingerprint)
+        if os.path.exists(path):
+            with open(path) as f:
+                obj = json.load(f)
+            journal.hashed = obj['hashed']
+            journal.committed = obj['committed']
+            print('Resuming push, {0} files already hashed.'.format(len(journal.hashed)))
+        return journal
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        # Maps the paths of files in the build tree to their MD5s.
+        self.hashed = dict()
+        # The ID of the version once it has been saved.
+        self.committed = None
+        self.last_flush = time.time()
+
+    def record_hash(self, path, md5):
+        self.hashed[path] = md5
+        self.flush()
+
+    def commit(self, vsn_id):
+        """
+        Records that the version was saved.
+        """
+        self.committed = vsn_id
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        """
+        Saves the journal if `force` is given or it hasn't been saved for a
+        while.
+        """
+        if not force and time.time() - self.last_flush < FLUSH_INTERVAL:
+            return
+        obj = dict(
+            fingerprint = self.fingerprint,
+            hashed = self.hashed,
+            committed = self.committed,
+        )
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp, self.path)
+        self.last_flush = time.time()
+
+
+def tree_fingerprint(key, tree):
+    """
+    Returns a hash of the given key strings and the paths, sizes,
+    modification times and permissions of all of the files under the given
+    directory. Nothing is read but the directory listings.
+    """
+    h = hashlib.sha1()
+    for k in key:
+        h.update(k.encode('utf-8') + b'\0')
+    entries = []
+    for root, dirs, files in os.walk(tree):
+        for file in files:
+            path = os.path.join(root, file)
+            st = os.stat(path)
+            entries.append('{0}\0{1}\0{2}\0{3}'.format(os.path.relpath(path, tree), st.st_size,
+                                                    st.st_mtime_ns, st.st_mode))
+    for e in sorted(entries):
+        h.update(e.encode('utf-8', 'surrogateescape') + b'\n')
+    return h.hexdigest()
+
+def prune_journals(journal_dir):
+    now = time.time()
+    for name in os.listdir(journal_dir):
+        path = os.path.join(journal_dir, name)
+        try:
+            if now - os.path.getmtime(path) > JOURNAL_MAX_AGE:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,154 @@
+# This module contains functions for reading and writing big JSON objects a
+# piece at a time.
+
+import json, codecs
+
+# How many bytes to read from the stream at once.
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+# Characters which can continue a number. In valid JSON, a number is never
+# directly followed by one of them, so a number which is means it was cut off.
+NUMBER_CHARS = '0123456789+-.eE'
+
+_decoder = json.JSONDecoder()
+
+
+def iter_members(stream, array_keys=()):
+    """
+    Parses a JSON object from the given binary stream and yields its members
+    as `(key, value)` tuples as they're read.
+
+    Arrays under the keys in `array_keys` aren't returned whole. Instead,
+    each of their elements is yielded separately as `(key, element)`, so only
+    one element has to be in memory at a time.
+    """
+    reader = _Reader(stream)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.next()
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError('Expected an object key.')
+        reader.expect(':')
+        if key in array_keys and reader.peek() == '[':
+            reader.next()
+            if reader.peek() == ']':
+                reader.next()
+            else:
+                while True:
+                    yield key, reader.value()
+                    c = reader.next()
+                    if c == ']':
+                        break
+                    if c != ',':
+                        raise ValueError('Expected "," or "]" but found {0!r}.'.format(c))
+        else:
+            yield key, reader.value()
+        c = reader.next()
+        if c == '}':
+            return
+        if c != ',':
+            raise ValueError('Expected "," or "}}" but found {0!r}.'.format(c))
+
+def dump_members(stream, members):
+    """
+    Writes a JSON object with the given `(key, value)` members to the given
+    binary stream. Values which are iterators are written as arrays, one
+    element at a time.
+
+    The output is the same as `json.dump` would write for the whole object.
+    """
+    stream.write(b'{')
+    first = True
+    for key, value in members:
+        if not first:
+            stream.write(b', ')
+        first = False
+        stream.write(json.dumps(key).encode('utf-8') + b': ')
+        if hasattr(value, '__next__'):
+            stream.write(b'[')
+            for i, item in enumerate(value):
+                if i > 0:
+                    stream.write(b', ')
+                stream.write(json.dumps(item).encode('utf-8'))
+            stream.write(b']')
+        else:
+            stream.write(json.dumps(value).encode('utf-8'))
+    stream.write(b'}')
+
+
+class _Reader(object):
+    """
+    Buffers text decoded from a binary stream and decodes JSON values from it.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Reads more of the stream into the buffer. Returns False at the end of
+        the stream.
+        """
+        if self.eof:
+            return False
+        data = self.stream.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            self.buf = self.buf[self.pos:] + self.decoder.decode(b'', final=True)
+        else:
+            self.buf = self.buf[self.pos:] + self.decoder.decode(data)
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        if self.pos >= len(self.buf):
+            raise ValueError('Unexpected end of JSON.')
+        return self.buf[self.pos]
+
+    def next(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def expect(self, c):
+        found = self.next()
+        if found != c:
+            raise ValueError('Expected {0!r} but found {1!r}.'.format(c, found))
+
+    def value(self):
+        """
+        Decodes the next value. The buffer is refilled until the value is
+        complete and followed by something, so numbers cut off at the end of
+        the buffer, even right after a sign, point or exponent, aren't decoded
+        early.
+        """
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if self.eof or (end < len(self.buf) and
+                            not (isinstance(value, (int, float)) and
+                                 self.buf[end] in NUMBER_CHARS)):
+                self.pos = end
+                return value
+            self.fill()
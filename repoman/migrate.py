@@ -0,0 +1,104 @@
+# The "migrate-storage" command moves a collection's files into shard
+# directories.
+
+import os
+
+from repoman.command import command, Argument, with_collection
+from repoman.storage import BLOB_NAME_RE
+
+
+@command('migrate-storage',
+         Argument('--shard-depth', type=int, default=2, help=
+                  """number of directory levels to shard files into"""),
+         Argument('--limit', type=int, default=None, help=
+                  """maximum number of files to copy in this run"""),
+         Argument('--commit', action='store_true', help='if not given, changes are only simulated'),
+         description="""
+         Moves storage files from the top-level storage directory into
+         directories named after their MD5s, like ab/cd/<md5>-<name>. Files
+         are copied first, then version URLs are rewritten to point at the
+         copies, and only then are the old files deleted, so the collection
+         stays usable throughout. The migration can be stopped and rerun at
+         any point, and --limit migrates it in smaller steps.
+         """,
+)
+@with_collection
+def migrate_storage(collection, shard_depth, limit, commit, **kwargs):
+    storage = collection.storage
+    if len(storage.partitions()) > 1:
+        print('Partitioned storage cannot be migrated.')
+        return
+    if storage.shard_depth not in (0, shard_depth):
+        print('Storage is already sharded {0} levels deep.'.format(storage.shard_depth))
+        return
+
+    # New pushes should go into shard directories right away.
+    if storage.shard_depth == 0:
+        print('Switching storage layout to shard depth {0}.'.format(shard_depth))
+        storage.shard_depth = shard_depth
+        collection.options['storage_layout'] = dict(shard_depth = shard_depth)
+        if commit: collection.save()
+
+    # Find the files which haven't been copied to their shard directory yet.
+    flat = set()
+    sharded = set()
+    for rel in storage.backend.walk_files(storage.path):
+        name = os.path.basename(rel)
+        if '/' not in rel and BLOB_NAME_RE.match(name) != None:
+            flat.add(name)
+        elif '/' in rel and storage.is_blob_path(rel):
+            sharded.add(name)
+    to_copy = sorted(flat - sharded)
+    if limit != None:
+        to_copy = to_copy[:limit]
+    print('{0} files left in the top-level directory, copying {1}.'
+          .format(len(flat - sharded), len(to_copy)))
+    for name in to_copy:
+        if commit:
+            storage.backend.copy_file(os.path.join(storage.path, name),
+                                      storage.blob_path(name))
+        sharded.add(name)
+
+    # Point versions at the copies. Files which haven't been copied yet keep
+    # their old URLs. URLs which don't start with the storage URL, like ones
+    # moved to a CDN by mod-urls, are left alone, and the files they link to
+    # are kept, since we can't tell which storage directory they're served
+    # from.
+    still_linked = set()
+    def migrate_url(url):
+        name = url[len(storage.url):]
+        if url.startswith(storage.url) and '/' not in name and name in sharded:
+            return storage.url + os.path.relpath(storage.blob_path(name), storage.path)
+        elif not (url.startswith(storage.url) and '/' in name):
+            still_linked.add(os.path.basename(url))
+        return url
+    changed_vsns = 0
+    for vsn in collection.all_versions_where(lambda id, name: True, cached=False):
+        changed = False
+        for f in vsn.files:
+            sources = [migrate_url(url) for url in f.sources]
+            changed = changed or sources != f.sources
+            f.sources = sources
+        if changed:
+            changed_vsns += 1
+            if commit: vsn.save()
+    # Change manifests link to the same files as the versions.
+    changed_manifests = 0
+    for plat in collection.list_platforms():
+        for chan in plat.channels:
+            changed_manifests += chan.rewrite_change_manifests(migrate_url, commit)
+    print('Rewrote URLs in {0} versions and {1} change manifests.'
+          .format(changed_vsns, changed_manifests))
+
+    # Finally, remove the old copies which nothing links to anymore.
+    to_delete = [n for n in flat if n in sharded and n not in still_linked]
+    kept = [n for n in flat if n in sharded and n in still_linked]
+    if len(kept) > 0:
+        print('Keeping {0} copied files which versions still link to by other URLs.'
+              .format(len(kept)))
+    print('Deleting {0} migrated files from the top-level directory.'.format(len(to_delete)))
+    if commit:
+        for name in to_delete:
+            storage.backend.delete_file(os.path.join(storage.path, name))
+    if len(flat - sharded) == 0 and len(still_linked) == 0:
+        print('Migration complete.')
@@ -1,31 +1,111 @@
 # The "push" command pushes a new version to a particular channel.
 
-import os, stat, hashlib
+import os, stat, time, hashlib, tarfile, zipfile, tempfile
 
 import repoman.repo as repo
 from repoman.command import command, Argument, with_channel
+from repoman.watch import watch_dir
+from repoman.gc import Lease
+from repoman.journal import PushJournal, DEFAULT_JOURNAL_DIR
 
 from repoman.storage import FileStorage
 
 
+# How long a changed file has to stay untouched before `push --watch` hashes
+# and uploads it, in seconds.
+SETTLE_TIME = 1.0
+
+# Files from archives up to this size are buffered in memory between hashing
+# and uploading them. Bigger ones are buffered in a temporary file.
+SPOOL_SIZE = 64 * 1024 * 1024
+
+LINK_ERROR = ('"{0}" in the archive is a link. Create the archive with links '
+              'replaced by the files they point to, or push a directory instead.')
+
+
 @command('push',
          Argument('platform'),
          Argument('channel'),
          Argument('vsn_id'),
          Argument('vsn_name'),
-         Argument('vsn_path'),
+         Argument('vsn_path', help=
+                  """directory with the files for the new version, or a zip or
+                  tar archive of them"""),
+         Argument('--watch', action='store_true', help=
+                  """after pushing, keep watching the directory and push a new
+                  version whenever files change. New versions get the ID
+                  after the channel's newest version and are named after the
+                  first one"""),
+         Argument('--quiet-period', type=float, default=10.0, help=
+                  """with --watch, how many seconds nothing must change for
+                  before a new version is pushed"""),
+         Argument('--journal-dir', type=str, default=DEFAULT_JOURNAL_DIR, help=
+                  """directory to record the push's progress in, so it can be
+                  resumed if it's interrupted"""),
+         Argument('--no-journal', action='store_false', dest='use_journal',
+                  help="don't record the push's progress"),
          description='Push a new version to a particular channel.',
 )
 @with_channel
-def push(channel, collection,
-         vsn_id, vsn_name, vsn_path,
-         **kwargs):
+def push(channel, platform, collection,
+         vsn_id, vsn_name, vsn_path, watch, quiet_period,
+         journal_dir, use_journal, **kwargs):
     """
     Pushes a new version to the given channel from the files at the given path.
     `path` is the path to the files for the new version.
     `storage` is the collection's file storage object.
     """
     storage = collection.storage
+    if watch and not vsn_id.isdigit():
+        print('Version IDs must be numbers to use --watch.')
+        exit(-1)
+
+    # Keep gc from deleting the files we use until the version is saved.
+    lease = Lease(collection)
+    try:
+        if os.path.isfile(vsn_path):
+            if watch:
+                print('Archives cannot be watched.')
+                exit(-1)
+            reused = []
+            files = archive_entries(storage, vsn_path, reused)
+            if len(files) == 0:
+                print('"{0}" has no files to push.'.format(vsn_path))
+                exit(-1)
+            # Files we uploaded are safe for gc's grace period, but files
+            # which were already in storage might not be used by anything.
+            lease.hold(f.md5 for f, _ in files.values())
+            missing = missing_files(storage, reused)
+            if len(missing) > 0:
+                # The archive can't be read again to upload them.
+                print('{0} files were deleted from storage while pushing, like "{1}". '
+                      'Push again.'.format(len(missing), missing[0][0]))
+                exit(-1)
+            publish(channel, platform, collection, vsn_id, vsn_name, files)
+        else:
+            # Journals are only kept for one-off pushes of directories.
+            # Archives have to be read again to be hashed anyway.
+            journal = None
+            if use_journal and not watch:
+                key = [collection.path, platform.name, channel.id, vsn_id, vsn_name]
+                journal = PushJournal.open(journal_dir, key, vsn_path)
+            push_dir(channel, platform, collection, vsn_id, vsn_name, vsn_path,
+                     watch, quiet_period, lease, journal)
+    finally:
+        lease.release()
+
+
+def push_dir(channel, platform, collection, vsn_id, vsn_name, vsn_path,
+             watch, quiet_period, lease, journal=None):
+    """
+    Pushes a new version from the files in the directory at the given path.
+    If a `PushJournal` is given, work which it says was done already is
+    skipped, and progress is recorded in it.
+    """
+    storage = collection.storage
+    if journal != None and journal.committed != None:
+        print('Version {0} was already pushed from these files.'.format(journal.committed))
+        return
 
     # Pushing a new version is a somewhat complicated process.
     # We need to be able to make a comparison between the files of the version
@@ -33,44 +113,297 @@ def push(channel, collection,
     # see which ones have changed.
 
     os.chdir(vsn_path)
+    if watch:
+        # Start watching before reading the files so no change is missed.
+        watcher = watch_dir('.')
 
     # First, we check the MD5sums of all of the files in our new version.
-    new_md5s = md5_dir('.')
+    try:
+        new_md5s = md5_dir('.', journal)
+    finally:
+        # The journal is only saved every few seconds while hashing, so save
+        # the last hashes now, even if hashing stopped part of the way.
+        if journal != None:
+            journal.flush(force=True)
+    lease.hold(new_md5s.values())
 
     # Our goal in is to build a list of `UpdateFile` objects. To do this, we'll
     # go through our list of MD5s, add any new files to storage, and build the
-    # list.
-    vsn_files = []
-    for (localPath, md5) in new_md5s.items():
-        # First, if the file is not already present in storage, we need to add
-        # it.
-        remotePath = storage.file_for_md5(md5)
-        if remotePath == None:
-            print('Adding new file "{0}".'.format(localPath))
-            remotePath = storage.add_file(localPath)
-        perms = stat.S_IMODE(os.stat(localPath).st_mode)
-        executable = (perms & stat.S_IXUSR) != 0
-        # TODO: Handle slash nonsense better when joining URLs.
-        sources = [storage.url + os.path.relpath(remotePath, storage.path)]
-        # Now construct an UpdateFile object for it and add it to the list.
-        vsn_files.append(repo.UpdateFile(os.path.normpath(localPath), md5, perms, sources, executable));
+    # list. Entries are kept by path along with the file's size, so watch mode
+    # can replace single entries.
+    files = dict()
+    reused = []
+    try:
+        for (localPath, md5) in new_md5s.items():
+            files[os.path.normpath(localPath)] = file_entry(storage, localPath, md5, reused)
+        readd_missing(storage, files, reused)
+    finally:
+        if journal != None:
+            journal.flush(force=True)
 
     # Now, we just need to create the new version.
+    publish(channel, platform, collection, vsn_id, vsn_name, files)
+    if journal != None:
+        journal.commit(vsn_id)
+    if watch:
+        watch_and_push(channel, platform, collection, watcher, files,
+                       vsn_id, vsn_name, quiet_period, lease)
+
+
+def file_entry(storage, localPath, md5, reused=None):
+    """
+    Adds the given file to storage if it isn't there already and returns a
+    tuple with its `UpdateFile` object and its size.
+
+    If the file was already in storage and a `reused` list is given, a tuple
+    with its local path and storage path is added to the list.
+    """
+    # First, if the file is not already present in storage, we need to add
+    # it. Files uploaded by an interrupted push are found in storage like any
+    # other, and are checked for with the rest of the reused files, since gc
+    # may have deleted them since.
+    remotePath = storage.file_for_md5(md5)
+    if remotePath == None:
+        print('Adding new file "{0}".'.format(localPath))
+        remotePath = storage.add_file(localPath)
+    elif reused != None:
+        reused.append((localPath, remotePath))
+    st = os.stat(localPath)
+    perms = stat.S_IMODE(st.st_mode)
+    executable = (perms & stat.S_IXUSR) != 0
+    sources = [storage.url_for(remotePath)]
+    # Now construct an UpdateFile object for it.
+    f = repo.UpdateFile(os.path.normpath(localPath), md5, perms, sources, executable)
+    return f, st.st_size
+
+def archive_entries(storage, path, reused=None):
+    """
+    Reads the files in a zip or tar archive, adds new ones to storage, and
+    returns a dictionary of entries like `push` builds for directories.
+
+    The archive is read once from start to finish. Each file is hashed as
+    it's read and buffered until its MD5 is known, since files are stored
+    under their MD5, and is only uploaded if storage doesn't have it yet.
+    Permissions come from the archive's headers.
+
+    Like `file_entry`, files which were already in storage are added to
+    `reused` if it's given.
+    """
+    files = dict()
+    for name, perms, size, fileobj in archive_members(path):
+        localPath = os.path.normpath(name)
+        if os.path.isabs(localPath) or localPath.split(os.sep)[0] == '..':
+            raise ValueError('Unsafe path in archive: {0}'.format(name))
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as buf:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+                md5.update(chunk)
+                buf.write(chunk)
+            md5 = md5.hexdigest()
+            remotePath = storage.file_for_md5(md5)
+            if remotePath == None:
+                print('Adding new file "{0}".'.format(localPath))
+                buf.seek(0)
+                remotePath = storage.add_fileobj(buf, os.path.basename(localPath), md5)
+            elif reused != None:
+                reused.append((localPath, remotePath))
+        executable = (perms & stat.S_IXUSR) != 0
+        sources = [storage.url_for(remotePath)]
+        f = repo.UpdateFile(localPath, md5, perms, sources, executable)
+        files[localPath] = (f, size)
+    return files
+
+def missing_files(storage, reused):
+    """
+    Returns the entries of `reused`, a list of `(local path, storage path)`
+    tuples from `file_entry`, whose files aren't in storage anymore.
+
+    gc deletes files which no version links to, so files we found in storage
+    can disappear before our lease on them is taken. This must be checked
+    after taking the lease and before publishing.
+    """
+    if len(reused) == 0:
+        return []
+    stored = set(storage.get_all_files())
+    return [(l, r) for l, r in reused if os.path.basename(r) not in stored]
+
+def readd_missing(storage, files, reused):
+    """
+    Uploads the files from `missing_files` again and updates their entries
+    in a `files` dictionary from `push`.
+    """
+    for localPath, remotePath in missing_files(storage, reused):
+        path = os.path.normpath(localPath)
+        # In watch mode, the file may have changed or been removed since.
+        if path not in files or storage.url_for(remotePath) not in files[path][0].sources:
+            continue
+        print('"{0}" was deleted from storage while pushing. Adding it again.'.format(localPath))
+        md5 = files[path][0].md5
+        storage.add_file(localPath)
+        files[path] = file_entry(storage, localPath, md5)
+
+def archive_members(path):
+    """
+    Iterates over the regular files in the zip or tar archive at the given
+    path, yielding `(name, perms, size, fileobj)` tuples. Each file object is
+    only valid until the next one is yielded.
+
+    Pushing a directory follows links, but links in an archive can't be
+    followed while reading it once from start to finish, so archives with
+    links are refused instead of pushed without the linked files.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            # Go through the members in the order they're stored in.
+            for info in sorted(zf.infolist(), key=lambda i: i.header_offset):
+                if info.is_dir():
+                    continue
+                mode = info.external_attr >> 16
+                if stat.S_ISLNK(mode):
+                    raise ValueError(LINK_ERROR.format(info.filename))
+                # Some zip writers, like Python's `ZipFile.writestr`, store
+                # permissions without a file type. Those are regular files.
+                if stat.S_IFMT(mode) != 0 and not stat.S_ISREG(mode):
+                    print('Skipping "{0}", which is not a regular file.'.format(info.filename))
+                    continue
+                # Archives made on Windows don't store Unix permissions.
+                perms = stat.S_IMODE(mode) if mode != 0 else 0o644
+                with zf.open(info) as f:
+                    yield info.filename, perms, info.file_size, f
+    else:
+        # Stream mode reads the archive strictly in order, compressed or not.
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                if member.issym() or member.islnk():
+                    raise ValueError(LINK_ERROR.format(member.name))
+                if not member.isfile():
+                    print('Skipping "{0}", which is not a regular file.'.format(member.name))
+                    continue
+                yield member.name, stat.S_IMODE(member.mode), member.size, tar.extractfile(member)
+
+def publish(channel, platform, collection, vsn_id, vsn_name, files):
+    """
+    Adds a version with the given files, a dictionary from `push`, to the
+    channel.
+    """
+    summary = collection.storage.backend.transfer_summary()
+    if summary != None:
+        print('Transferred {0}.'.format(summary))
+
+    vsn_files = [f for f, _ in files.values()]
+    vsn_size = sum(size for _, size in files.values())
     vsn = channel.add_version(vsn_id, vsn_name, vsn_files)
+    collection.update_summary(platform.name, channel.id, vsn, vsn_size)
+
+def watch_and_push(channel, platform, collection, watcher, files,
+                   vsn_id, vsn_name, quiet_period, lease):
+    """
+    Pushes a new version every time the files in the current directory change
+    and then stay unchanged for `quiet_period` seconds, until interrupted.
 
+    Changed files are hashed and uploaded once they've settled, so only the
+    files which changed are read, and everything else keeps its entry from
+    the previous version.
+    """
+    print('Watching for changes. Press Ctrl+C to stop.')
+    # Maps paths of changed files to when they last changed.
+    pending = dict()
+    last_change = 0
+    dirty = False
+    reused = []
+    id = int(vsn_id)
+    count = 0
+    try:
+        while True:
+            changed = watcher.changes(min(SETTLE_TIME, quiet_period))
+            now = time.time()
+            if changed == None:
+                print('Some changes were missed. Checking every file.')
+                changed = set(files) | set(walk_dir('.'))
+            for path in changed:
+                pending[path] = now
+                last_change = now
+
+            for path in [p for p, t in pending.items() if now - t >= SETTLE_TIME]:
+                del pending[path]
+                if update_entry(collection.storage, files, path, reused):
+                    dirty = True
+
+            if dirty and len(pending) == 0 and now - last_change >= quiet_period:
+                lease.hold(f.md5 for f, _ in files.values())
+                readd_missing(collection.storage, files, reused)
+                reused = []
+                # Others may have pushed to the channel while we were
+                # watching, so take the next ID after the newest version.
+                collection.refresh()
+                id = max([id] + [int(v['id']) for v in channel.versions
+                                 if v['id'].isdigit()]) + 1
+                count += 1
+                name = '{0}+{1}'.format(vsn_name, count)
+                print('Pushing version "{0}" ({1}).'.format(name, id))
+                publish(channel, platform, collection, str(id), name, files)
+                dirty = False
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()
+
+def update_entry(storage, files, path, reused=None):
+    """
+    Updates the entry for the file at the given path in a `files` dictionary
+    from `push`, uploading the file if it's new. If the path doesn't exist,
+    the entries for it and any files under it are removed.
+
+    Returns True if anything changed.
+    """
+    if os.path.isfile(path):
+        try:
+            md5 = hash_file(path).hexdigest()
+            perms = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            return update_entry(storage, files, path, reused)
+        old = files.get(path)
+        if old != None and old[0].md5 == md5 and old[0].perms == perms:
+            return False
+        files[path] = file_entry(storage, path, md5, reused)
+        return True
+    if os.path.isdir(path):
+        return False
+    removed = [p for p in files if p == path or p.startswith(path + os.sep)]
+    for p in removed:
+        print('Removing file "{0}".'.format(p))
+        del files[p]
+    return len(removed) > 0
 
-def md5_dir(path):
+def md5_dir(path, journal=None):
     """
     Checks the MD5sum of all of the files in a directory and returns a
     dictionary mapping MD5s to filenames.
+
+    Files which the given journal has MD5s for aren't read again.
     """
     md5_map = dict()
     for root, dirs, files in os.walk(path):
         for file in files:
             file_path = os.path.join(root, file)
+            if journal != None and file_path in journal.hashed:
+                md5_map[file_path] = journal.hashed[file_path]
+                continue
             md5_map[file_path] = hash_file(file_path).hexdigest()
+            if journal != None:
+                journal.record_hash(file_path, md5_map[file_path])
     return md5_map
 
+def walk_dir(path):
+    """
+    Returns the normalized paths of all of the files in a directory.
+    """
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            yield os.path.normpath(os.path.join(root, file))
+
 def hash_file(path):
     with open(path, 'rb') as f:
         return hashlib.md5(f.read())
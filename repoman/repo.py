@@ -1,9 +1,57 @@
 # This file contains functions for dealing with repositories.
 
-import os, json, hashlib
+import os, json, hashlib, threading
+from collections import OrderedDict
 
-from repoman.backend import Backend
-from repoman.storage import FileStorage
+from repoman.backend import Backend, ConflictError, list_md5s_or_empty, walk_md5s_or_empty
+from repoman.storage import load_storage, walk_blob_md5s
+from repoman.jsonstream import iter_members, dump_members
+
+# Optional collection settings which can be set in `config.json`:
+#
+# - `history`: Splits channel histories into archive pages and a small head
+#   file. Contains the number of versions per archive page (`page_size`) and
+#   optionally how many versions to keep in the legacy `index.json`
+#   (`index_limit`).
+# - `delta_versions`: Also saves versions in the delta-encoded `ApiVersion: 1`
+#   format. Contains the maximum number of deltas between full snapshots
+#   (`snapshot_interval`).
+# - `storage_layout`: Stores files in nested directories named after their
+#   MD5s. Contains the number of directory levels (`shard_depth`).
+# - `storage_partitions`: Spreads new files over several storage directories
+#   by consistent hashing of their MD5s. Contains a list of `partitions`, each
+#   with a `name`, `path` and `url` and optionally a `bucket` or `dir` if it's
+#   on a different backend, and the number of ring points per partition
+#   (`vnodes`). The main storage directory is the partition named `default`.
+# - `cache_control`: Maps the kinds of files in `FILE_KINDS` to the
+#   `Cache-Control` header they're written with, on backends which store
+#   headers. Kinds which aren't listed use `DEFAULT_CACHE_CONTROL`.
+# - `change_manifests`: Publishes a list of the files which changed between
+#   each new version and the versions before it, in
+#   `changes/<from>-<to>.json`. Contains how many previous versions to publish
+#   manifests from (`count`).
+OPTIONS = ['history', 'delta_versions', 'storage_layout', 'change_manifests',
+           'storage_partitions', 'cache_control']
+
+# Kinds of files in a collection, in the order they should be copied so that
+# nothing ever links to a file which hasn't been copied yet.
+FILE_KINDS = ['storage', 'version', 'index', 'platform', 'config']
+
+# Storage files are named after their MD5s and never change once they're
+# written, so they can be cached forever. Everything else, including version
+# files, is checked for changes often, since version files are rewritten in
+# place by mod-urls, migrate-storage and pushes which reuse a version ID.
+DEFAULT_CACHE_CONTROL = {
+    'storage':  'public, max-age=31536000, immutable',
+    'version':  'public, max-age=60, must-revalidate',
+    'index':    'public, max-age=60, must-revalidate',
+    'platform': 'public, max-age=60, must-revalidate',
+    'config':   'public, max-age=60, must-revalidate',
+}
+
+# How many times to re-read and merge a metadata file when another writer
+# changes it while we're saving.
+CAS_RETRIES = 10
 
 
 class Collection(object):
@@ -25,9 +73,11 @@ class Collection(object):
         storage_url = obj['storage_url']
         # File storage path (relative to the collection's folder)
         storage_path = obj['storage_path']
-        storage = FileStorage(backend, storage_path, storage_url)
+        # Optional settings. See `OPTIONS` for what they do.
+        options = dict((k, obj[k]) for k in OPTIONS if k in obj)
+        storage = load_storage(backend, storage_path, storage_url, options)
 
-        return cls(backend, path, base_url, storage)
+        return cls(backend, path, base_url, storage, options)
 
     def save(self):
         obj = dict(
@@ -35,9 +85,16 @@ class Collection(object):
             storage_url = self.storage.url,
             storage_path = self.storage.path,
         )
+        obj.update(self.options)
         self.backend.write_json(obj, self.get_config_path())
+        # Loaded channels keep their own copies of the options, so bring them
+        # up to date.
+        self.apply_cache_control()
+        for p in self.platforms.values():
+            for ch in p.channels:
+                ch.set_options(self.options)
 
-    def __init__(self, backend, path, url, storage):
+    def __init__(self, backend, path, url, storage, options=None):
         """
         Constructs and loads the collection.
         """
@@ -45,23 +102,78 @@ class Collection(object):
         self.path = path
         self.url = url
         self.storage = storage
+        self.options = options if options != None else dict()
+        # Maps platform names to loaded platforms, so every lookup of a
+        # platform returns the same object for the collection's lifetime.
         self.platforms = {}
+        self.apply_cache_control()
+
+    def apply_cache_control(self):
+        """
+        Makes the collection's backends write files with the collection's
+        caching policy.
+        """
+        policy = self.cache_control()
+        func = lambda path: policy.get(self.file_kind(path))
+        self.backend.cache_control = func
+        for part in self.storage.partitions():
+            part.backend.cache_control = func
+
+    def cache_control(self):
+        """
+        Returns a dictionary mapping kinds of files to their `Cache-Control`
+        headers.
+        """
+        policy = dict(DEFAULT_CACHE_CONTROL)
+        policy.update(self.options.get('cache_control', dict()))
+        return policy
+
+    def file_kind(self, path):
+        """
+        Returns which of the kinds in `FILE_KINDS` the file at the given path
+        is.
+        """
+        for part in self.storage.partitions():
+            if path.startswith(part.path.rstrip('/') + '/'):
+                return 'storage'
+        rel = os.path.relpath(path, self.path) if self.path != '' else path
+        parts = rel.split('/')
+        name = parts[-1]
+        # Files directly in the collection directory, and repoman's own
+        # bookkeeping in `gc`, are treated like the config.
+        if len(parts) == 1 or parts[0] == 'gc':
+            return 'config'
+        if name == 'channels.json' and len(parts) == 2:
+            return 'platform'
+        if name in ('index.json', 'head.json') and len(parts) == 3:
+            return 'index'
+        return 'version'
 
     def get_platform(self, name):
         """
         Finds a platform in the collection with the given name.
 
-        Returns `None` if no such platform exists.
+        Returns `None` if no such platform exists. Loaded platforms are kept,
+        and the same object is returned every time. Use `refresh` to pick up
+        changes made by other processes.
         """
-        if name in self.platforms:
-            return name
-        else:
-            try:
-                p = self.platforms['name'] = Platform.load(self, name)
-                return p
-            except IOError as e:
-                print('Failed loading platform: {0}'.format(str(e)))
-                return None
+        p = self.platforms.get(name)
+        if p != None:
+            return p
+        try:
+            p = self.platforms[name] = Platform.load(self, name)
+            return p
+        except IOError as e:
+            print('Failed loading platform: {0}'.format(str(e)))
+            return None
+
+    def refresh(self):
+        """
+        Checks whether any loaded platform or channel files were changed by
+        another process, and updates the loaded objects if so.
+        """
+        for p in self.platforms.values():
+            p.refresh()
 
     def new_platform(self, id):
         """
@@ -72,12 +184,26 @@ class Collection(object):
         self.platforms[id] = p
         return p
 
+    def platform_dirs(self):
+        """
+        Returns the names of the directories in the collection which could be
+        platforms, leaving out the ones repoman uses for other things.
+        """
+        reserved = set(['gc'])
+        for part in self.storage.partitions():
+            rel = os.path.relpath(part.path, self.path) if self.path != '' else part.path
+            reserved.add(rel.split('/')[0])
+        return [d for d in self.backend.list_dir(self.path, type='dirs') if d not in reserved]
+
     def list_platforms(self):
-        dirs = self.backend.list_dir(self.path, type='dirs')
+        dirs = self.platform_dirs()
         for id in dirs:
-            yield self.get_platform(id)
+            # Skip directories which aren't platforms, like file storage.
+            p = self.get_platform(id)
+            if p != None:
+                yield p
 
-    def all_versions_where(self, pred):
+    def all_versions_where(self, pred, cached=True):
         """
         A generator which lists of every single version whose ID and name match
         the given predicate.
@@ -85,56 +211,207 @@ class Collection(object):
         The predicate takes a tuple with the version ID and name and returns
         true or false indicating whether the version should be listed.
 
+        If `cached` is false, the versions aren't added to the version cache,
+        so memory use stays flat however big the collection is.
+
         This will be horribly slow on non-disk backends like S3.
         """
         for p in self.list_platforms():
             for ch in p.channels:
-                for vsn in ch.all_versions_where(pred):
+                for vsn in ch.all_versions_where(pred, cached):
                     yield vsn
 
-    def all_latest_versions(self):
+    def all_latest_versions(self, use_summary=True):
         """
         A generator which lists latest versions from the collection.
+
+        If the collection has a summary file and `use_summary` is true, the
+        latest versions are loaded straight from the IDs listed in it, without
+        reading any platform or channel files. Anything which deletes files
+        should pass false, since the channel indexes are the only authority on
+        which versions exist.
         """
-        for p in self.list_platforms():
-            for ch in p.channels:
-                vsn = ch.get_latest_vsn()
-                yield vsn
+        summary = self.load_summary() if use_summary else None
+        if summary != None:
+            for plat, chans in summary['platforms'].items():
+                for chan_id, entry in chans.items():
+                    chan_dir = os.path.join(self.path, plat, chan_id)
+                    yield Version.load(self.backend, chan_dir, entry['id'], entry['name'])
+            return
+
+        # Otherwise, every platform and channel needs to be loaded, so load
+        # them all at once.
+        import repoman.aio as aio
+        for vsn in aio.run(aio.all_latest_versions, self):
+            yield vsn
+
+    def load_summary(self):
+        """
+        Loads the collection's summary file, which maps platforms to channels
+        to info about each channel's latest version.
+
+        Returns `None` if the collection doesn't have a summary.
+        """
+        obj, _ = self.backend.read_json_versioned(self.summary_path())
+        return obj
+
+    def update_summary(self, platform, channel, vsn, size):
+        """
+        Records the given version as the latest version of the given channel
+        in the collection's summary file. `size` is the total size of the
+        version's files in bytes.
+
+        Nothing is changed if the summary already lists a newer version. If
+        the collection has no summary, none is created, since it would only
+        list this channel. `rebuild-summary` creates it from every channel.
+        """
+        entry = dict(
+            id = vsn.id,
+            name = vsn.name,
+            files = len(vsn.files),
+            bytes = size,
+        )
+        for _ in range(CAS_RETRIES):
+            obj, token = self.backend.read_json_versioned(self.summary_path())
+            if obj == None:
+                return
+            chans = obj['platforms'].setdefault(platform, dict())
+            old = chans.get(channel)
+            if old != None and int(old['id']) > int(vsn.id):
+                return
+            chans[channel] = entry
+            try:
+                self.backend.write_json_if(obj, self.summary_path(), token)
+                return
+            except ConflictError:
+                print('Collection summary was changed by someone else. Retrying.')
+        raise ConflictError('Gave up updating collection summary after {0} conflicts.'
+                            .format(CAS_RETRIES))
+
+    def list_files(self, storage=True):
+        """
+        Returns a list of `(kind, path, md5)` tuples for all of the collection's
+        files, sorted by kind in the order of `FILE_KINDS`. If `storage` is
+        false, only metadata files are listed.
+        """
+        files = []
+        if storage:
+            st = self.storage
+            if len(st.partitions()) > 1:
+                raise ValueError('Partitioned storage cannot be listed with the collection.')
+            for rel, md5 in sorted(walk_blob_md5s(self.backend, st.path).items()):
+                files.append(('storage', os.path.join(st.path, rel), md5))
+
+        platforms = list(self.list_platforms())
+        indexes = []
+        for plat in platforms:
+            for chan in plat.channels:
+                idx_names = [os.path.basename(chan.index_path()),
+                             os.path.basename(chan.head_path())]
+                for name, md5 in sorted(list_md5s_or_empty(self.backend, chan.path).items()):
+                    # Skip leftovers from writes which are in progress.
+                    if name.endswith('.lock') or name.endswith('.tmp'):
+                        continue
+                    path = os.path.join(chan.path, name)
+                    if name in idx_names:
+                        indexes.append(('index', path, md5))
+                    else:
+                        files.append(('version', path, md5))
+                # Archive pages of sharded channels go along with the version
+                # files, before the head which points to them.
+                if len(chan.pages) > 0:
+                    history_dir = os.path.join(chan.path, 'history')
+                    for rel, md5 in sorted(walk_md5s_or_empty(self.backend, history_dir).items()):
+                        files.append(('version', os.path.join(history_dir, rel), md5))
+                if chan.change_manifests != None:
+                    changes_dir = os.path.join(chan.path, 'changes')
+                    for name, md5 in sorted(list_md5s_or_empty(self.backend, changes_dir).items()):
+                        files.append(('version', os.path.join(changes_dir, name), md5))
+        files += indexes
+
+        for plat in platforms:
+            md5 = list_md5s_or_empty(self.backend, plat.path).get('channels.json')
+            if md5 != None:
+                files.append(('platform', plat.channels_file_path(), md5))
+
+        md5s = list_md5s_or_empty(self.backend, self.path)
+        for path in [self.get_config_path(), self.summary_path()]:
+            md5 = md5s.get(os.path.basename(path))
+            if md5 != None:
+                files.append(('config', path, md5))
+        return files
 
     def get_config_path(self):
         return os.path.join(self.path, 'config.json')
 
+    def summary_path(self):
+        return os.path.join(self.path, 'summary.json')
+
 
 
 class Platform(object):
     @classmethod
     def load(cls, col, name):
         """
-        Loads a platform directory and all of its channels.
+        Loads a platform directory and its list of channels. Each channel's
+        index is loaded when the channel is first used.
         """
         b = col.backend
         path = os.path.join(col.path, name)
-        obj = b.read_json(os.path.join(path, 'channels.json'))
-        if obj['format_version'] != 0:
-            raise 'Format version mismatch.'
+        obj, token = b.read_json_versioned(os.path.join(path, 'channels.json'))
+        if obj == None:
+            raise IOError('No channels.json in {0}.'.format(path))
 
-        channels = []
-        chan_objs = obj['channels']
-        for chan_obj in chan_objs:
-            try:
-                channels.append(Channel.load(b, path, chan_obj))
-            except Exception as e:
-                print('Failed to load channel "{0}" from platform "{1}": {2}'
-                      .format(chan_obj['id'], path, str(e)))
-        return cls(col, name, channels)
+        plat = cls(col, name, load_channels(b, path, obj, col.options))
+        plat.channels_token = token
+        return plat
 
     def save(self):
-        chan_objs = []
+        """
+        Saves the platform's `channels.json` file.
+
+        If another process changed the file since it was loaded, channels added
+        by that process are merged in and the save is retried.
+        """
         print('Saving platform info for "{0}".'.format(self.name))
-        self.backend.write_json(dict(
-            format_version = 0,
-            channels = [chan.todict() for chan in self.channels]
-        ), self.channels_file_path())
+        for _ in range(CAS_RETRIES):
+            try:
+                self.channels_token = self.backend.write_json_if(dict(
+                    format_version = 0,
+                    channels = [chan.todict() for chan in self.channels]
+                ), self.channels_file_path(), self.channels_token)
+                return
+            except ConflictError:
+                print('Platform "{0}" was changed by someone else. Merging.'
+                      .format(self.name))
+                self.merge_channels()
+        raise ConflictError('Gave up saving platform "{0}" after {1} conflicts.'
+                            .format(self.name, CAS_RETRIES))
+
+    def merge_channels(self):
+        """
+        Re-reads `channels.json` and adds any channels which we don't know
+        about yet.
+        """
+        obj, self.channels_token = self.backend.read_json_versioned(
+            self.channels_file_path())
+        if obj == None:
+            return
+        ids = set(ch.id for ch in self.channels)
+        remote = [o for o in obj['channels'] if o['id'] not in ids]
+        self.channels += load_channels(self.backend, self.path,
+                                       dict(format_version=0, channels=remote),
+                                       self.collection.options)
+
+    def refresh(self):
+        """
+        Merges in channels added by other processes if `channels.json`
+        changed, and refreshes the loaded channels.
+        """
+        if self.backend.get_token(self.channels_file_path()) != self.channels_token:
+            self.merge_channels()
+        for ch in self.channels:
+            ch.refresh()
 
     def __init__(self, col, name, channels):
         self.collection = col
@@ -143,6 +420,9 @@ class Platform(object):
         self.path = os.path.join(col.path, name)
         self.name = name
         self.channels = channels
+        # Identifies the version of `channels.json` the channels were loaded
+        # from. `None` means the file hasn't been written yet.
+        self.channels_token = None
 
     def get_channel(self, id):
         """
@@ -162,7 +442,8 @@ class Platform(object):
         if name == None: name = id
         chan_url = self.collection.url + self.name + '/' + id + '/'
         chan_path = os.path.join(self.path, id)
-        chan = Channel(self.backend, id, name, desc, chan_url, chan_path, [])
+        chan = Channel(self.backend, id, name, desc, chan_url, chan_path, [],
+                       self.collection.options)
         self.channels.append(chan)
         self.save()
         return chan
@@ -173,45 +454,242 @@ class Platform(object):
 
 
 class Channel(object):
+    """
+    Class for managing a GoUpdate channel.
+
+    A channel's versions are listed in its `index.json` file. If the collection
+    has a history policy, the channel also keeps a small `head.json` file with
+    only the newest versions and pointers to immutable archive pages holding
+    older ones. In that case, only the head is loaded up front and the archive
+    pages are loaded when older versions are needed.
+
+    Channels loaded from `channels.json` don't read their index until their
+    versions are first needed.
+    """
     @classmethod
-    def load(cls, backend, path, obj):
+    def load(cls, backend, path, obj, options=None):
         """
         Loads a channel from the given platform directory based on info in the
         given dict, which should be loaded from the platform's `channels.json`
         file.
         """
-        b = backend
         id = obj['id']
         name = obj['name']
         desc = obj['description']
         url = obj['url']
         path = os.path.join(path, id)
 
-        # Load the index.json file.
-        idx = b.read_json(os.path.join(path, 'index.json'))
-        if idx['ApiVersion'] != 0:
-            return None
+        chan = cls(backend, id, name, desc, url, path, [], options)
+        chan.index_loaded = False
+        return chan
 
+    def load_index(self):
+        """
+        Loads the channel's index if it hasn't been loaded yet.
+        """
+        if self.index_loaded:
+            return
+        b = self.backend
         versions = []
-        for vsn_obj in idx['Versions']:
-            # TODO: Maybe check if the version file exists?
-            versions.append(dict(
-                id=vsn_obj['Id'],
-                name=vsn_obj['Name'],
-            ))
+        pages = []
+        head = None
+        if self.history != None:
+            head, token = b.read_json_versioned(self.head_path())
+        if head != None:
+            versions = index_versions(head)
+            pages = head['Pages']
+        else:
+            # Load the index.json file. If we have a history policy, this is a
+            # channel which hasn't been sharded yet and the head will be
+            # created the next time the index is saved.
+            idx, token = b.read_json_versioned(self.index_path())
+            if idx == None:
+                # The channel was just created and nothing has been pushed to
+                # it yet.
+                pass
+            elif idx['ApiVersion'] != 0:
+                raise IOError('Unsupported index version in {0}.'.format(self.index_path()))
+            else:
+                versions = index_versions(idx)
+            if self.history != None:
+                token = None
+
+        self._versions = versions
+        self._pages = pages
+        self.archived = None
+        self.index_token = token
+        self.known_ids = set(v['id'] for v in versions)
+        self.index_loaded = True
+
+    def refresh(self):
+        """
+        Forgets the loaded index if another process changed it, so it's
+        loaded again the next time it's needed.
+        """
+        if not self.index_loaded:
+            return
+        path = self.index_path() if self.history == None else self.head_path()
+        if self.backend.get_token(path) != self.index_token:
+            self.index_loaded = False
+
+    @property
+    def versions(self):
+        """
+        The versions in the channel's index. For sharded channels, this is
+        only the versions in the head.
+        """
+        self.load_index()
+        return self._versions
+
+    @versions.setter
+    def versions(self, versions):
+        self._versions = versions
+
+    @property
+    def pages(self):
+        """
+        Paths of the archive pages relative to the channel directory.
+        """
+        self.load_index()
+        return self._pages
 
-        return cls(b, id, name, desc, url, path, versions)
+    @pages.setter
+    def pages(self, pages):
+        self._pages = pages
 
     def save_index(self):
         """
         Saves the channel's index file.
+
+        If another process changed the index since it was loaded, versions
+        added by that process are merged in and the save is retried, so
+        concurrent pushes to the same channel don't lose each other's versions.
+
+        If the channel is sharded, the head file is the one which is checked
+        for conflicts, and `index.json` is rewritten from it afterwards.
+        """
+        self.load_index()
+        for _ in range(CAS_RETRIES):
+            try:
+                if self.history == None:
+                    self.index_token = self.backend.write_json_if(
+                        self.index_obj(self.versions), self.index_path(),
+                        self.index_token)
+                else:
+                    self.archive_pages()
+                    self.index_token = self.backend.write_json_if(dict(
+                        Versions = [index_entry(v) for v in self.versions],
+                        Pages = self.pages,
+                        ApiVersion = 0,
+                    ), self.head_path(), self.index_token)
+                    self.save_legacy_index()
+                self.known_ids = set(v['id'] for v in self.versions)
+                return
+            except ConflictError:
+                print('Index for channel "{0}" was changed by someone else. Merging.'
+                      .format(self.id))
+                self.merge_index()
+        raise ConflictError('Gave up saving index for channel "{0}" after {1} conflicts.'
+                            .format(self.id, CAS_RETRIES))
+
+    def merge_index(self):
+        """
+        Re-reads the index file and merges our versions into it. Versions from
+        the index come first, followed by any which we added since loading.
+        """
+        added = [v for v in self.versions if v['id'] not in self.known_ids]
+        if self.history == None:
+            idx, self.index_token = self.backend.read_json_versioned(self.index_path())
+        else:
+            idx, self.index_token = self.backend.read_json_versioned(self.head_path())
+        if idx == None:
+            return
+        remote = index_versions(idx)
+        if self.history != None:
+            if idx['Pages'] != self.pages:
+                self.archived = None
+            self.pages = idx['Pages']
+        self.known_ids = set(v['id'] for v in remote)
+        self.versions = remote + [v for v in added if v['id'] not in self.known_ids]
+
+    def archive_pages(self):
+        """
+        Moves the oldest versions in the head into new archive pages until the
+        head holds fewer than two pages worth of versions.
+
+        Archive pages are named after the hash of their contents, so they never
+        change once written and concurrent writers can't clobber each other's
+        pages.
+        """
+        page_size = self.history['page_size']
+        while len(self.versions) >= 2 * page_size:
+            page = self.versions[:page_size]
+            obj = dict(Versions = [index_entry(v) for v in page], ApiVersion = 0)
+            digest = hashlib.md5(json.dumps(obj).encode('utf-8')).hexdigest()
+            page_path = 'history/{0}.json'.format(digest)
+            self.backend.write_json(obj, os.path.join(self.path, page_path))
+            if self.archived != None:
+                self.archived += page
+            self.pages = self.pages + [page_path]
+            self.versions = self.versions[page_size:]
+
+    def save_legacy_index(self):
+        """
+        Writes `index.json` for clients which don't know about the head file.
+
+        If the history policy has an `index_limit`, only that many of the newest
+        versions are listed. Otherwise, all archive pages are loaded so the full
+        history can be written.
+
+        The index is always written from the newest head, with a
+        compare-and-swap, so a writer which saved an older head can't
+        overwrite an index written from a newer one.
         """
-        vsn_objs = [dict(Id = v['id'], Name = v['name']) for v in self.versions]
-        self.backend.write_json(dict(
-            Versions = vsn_objs,
+        limit = self.history.get('index_limit')
+        for _ in range(CAS_RETRIES):
+            # Read the index's token before the head, so any index written
+            # from a newer head than the one we read makes our write fail.
+            token = self.backend.get_token(self.index_path())
+            head, head_token = self.backend.read_json_versioned(self.head_path())
+            if head_token == self.index_token:
+                versions, pages = self.versions, self.pages
+            else:
+                # Someone else saved the head after us.
+                versions, pages = index_versions(head), head['Pages']
+            if limit == None or limit > len(versions):
+                versions = self.page_entries(pages) + versions
+                if limit != None:
+                    versions = versions[max(0, len(versions)-limit):]
+            else:
+                versions = versions[len(versions)-limit:]
+            try:
+                self.backend.write_json_if(self.index_obj(versions), self.index_path(), token)
+                return
+            except ConflictError:
+                print('Index for channel "{0}" was changed by someone else. Retrying.'
+                      .format(self.id))
+        raise ConflictError('Gave up saving index for channel "{0}" after {1} conflicts.'
+                            .format(self.id, CAS_RETRIES))
+
+    def page_entries(self, pages):
+        """
+        Returns the ID and name dicts of the versions in the given archive
+        pages.
+        """
+        if pages == self.pages:
+            self.load_history()
+            return self.archived
+        versions = []
+        for page in pages:
+            versions += index_versions(self.backend.read_json(os.path.join(self.path, page)))
+        return versions
+
+    def index_obj(self, versions):
+        return dict(
+            Versions = [index_entry(v) for v in versions],
             Channels = [], # This is unused.
             ApiVersion = 0,
-        ), self.index_path())
+        )
 
     def todict(self):
         return dict(
@@ -221,27 +699,90 @@ class Channel(object):
             url = self.url
         )
 
-    def __init__(self, backend, id, name, desc, url, path, versions):
+    def __init__(self, backend, id, name, desc, url, path, versions,
+                 options=None):
         self.backend = backend
         self.id = id
         self.name = name
         self.desc = desc
         self.url = url
         self.path = path
-        self.versions = versions
-        self.loaded_vsns = dict()
+        if options == None: options = dict()
+        self.history = options.get('history')
+        self.delta_versions = options.get('delta_versions')
+        self.change_manifests = options.get('change_manifests')
+        self._versions = versions
+        self._pages = []
+        # Versions from the archive pages. `None` until they're first needed.
+        self.archived = None
+        self.cache = version_cache
+        # Identifies the version of the index the versions were loaded from.
+        # `None` means the file hasn't been written yet.
+        self.index_token = None
+        # IDs of the versions which were in the index when it was last read.
+        self.known_ids = set(v['id'] for v in versions)
+        # False until the index has been read, for channels loaded from
+        # `channels.json`.
+        self.index_loaded = True
+
+    def set_options(self, options):
+        """
+        Applies the given collection options to the channel.
+        """
+        history = options.get('history')
+        # The history policy decides which index file is read, so the index
+        # is loaded again if it changes.
+        if history != self.history:
+            self.index_loaded = False
+        self.history = history
+        self.delta_versions = options.get('delta_versions')
+        self.change_manifests = options.get('change_manifests')
+
+    def load_history(self):
+        """
+        Loads the versions from the channel's archive pages, if it has any.
+        """
+        if self.archived != None:
+            return
+        archived = []
+        for page in self.pages:
+            print('Loading history page "{0}".'.format(page))
+            obj = self.backend.read_json(os.path.join(self.path, page))
+            archived += index_versions(obj)
+        self.archived = archived
+
+    def all_version_entries(self):
+        """
+        Returns the ID and name dicts of all of the channel's versions, oldest
+        first, loading archive pages if necessary.
+        """
+        self.load_history()
+        return self.archived + self.versions
 
     def get_version(self, id):
         """
         Loads full version info for the version with the given ID.
         """
-        if id in self.loaded_vsns:
-            return self.loaded_vsns[id]
+        vsn = self.cache.get((self.path, id))
+        if vsn != None:
+            return vsn
         for v in self.versions:
             if v['id'] == id:
-                vsn = Version.load(self.backend, self.path, v['id'], v['name'])
-                self.loaded_vsns[v['id']] = vsn
-                return vsn
+                return self.load_version(v)
+        # Only look through the archive if the version isn't in the head.
+        for v in self.all_version_entries():
+            if v['id'] == id:
+                return self.load_version(v)
+
+    def load_version(self, v, cached=True, resolve=None):
+        if self.delta_versions == None:
+            resolve = None
+        elif resolve == None:
+            resolve = self.get_version
+        vsn = Version.load(self.backend, self.path, v['id'], v['name'], resolve)
+        if cached:
+            self.cache.put((self.path, v['id']), vsn)
+        return vsn
 
     def add_version(self, id, name, files):
         """
@@ -249,17 +790,48 @@ class Channel(object):
         and returns the added version.
         """
         v = Version(self.backend, self.path, id, name, files)
+        if self.change_manifests != None:
+            # Find the previous versions before this one is added to the index.
+            previous = self.previous_versions(id, self.change_manifests['count'])
+        if self.delta_versions != None:
+            # Store the new version as a delta from the latest one, unless the
+            # chain from the last snapshot is already long enough.
+            interval = self.delta_versions['snapshot_interval']
+            latest = self.get_latest_vsn()
+            if (latest != None and latest.id != id and
+                    latest.delta_depth != None and
+                    latest.delta_depth + 1 < interval):
+                v.base = latest
+                v.delta_depth = latest.delta_depth + 1
+            else:
+                v.delta_depth = 0
         v.save()
+        self.cache.put((self.path, id), v)
+        if self.change_manifests != None:
+            for prev in previous:
+                save_change_manifest(self.backend, self.path, prev, v)
 
         # Do not put duplicated version IDs into the index.
-        for v in self.versions:
-            if v['id'] == id:
+        for existing in self.versions:
+            if existing['id'] == id:
                 return v
 
         self.versions.append(dict(id=id, name=name))
         self.save_index()
         return v
 
+    def previous_versions(self, id, count):
+        """
+        Returns up to `count` of the newest versions older than the version
+        with the given ID, newest first.
+        """
+        entries = self.versions
+        if len(entries) < count + 1:
+            entries = self.all_version_entries()
+        older = sorted([v for v in entries if int(v['id']) < int(id)],
+                       key=lambda v: int(v['id']), reverse=True)
+        return [self.get_version(v['id']) for v in older[:count]]
+
     def delete_version(self):
         """
         Deletes the version with the given ID.
@@ -270,13 +842,17 @@ class Channel(object):
 
     def get_latest_vsn(self):
         """Gets the channel's newest version."""
-        # The last version in the list should be the newest one.
+        # The last version in the list should be the newest one. For sharded
+        # channels, the newest versions are always in the head.
         if len(self.versions) > 0:
             v = sorted(self.versions, key=lambda v: int(v['id']))[len(self.versions)-1]
-            return self.get_version(v['id'])
+            vsn = self.get_version(v['id'])
+            # Latest versions are used over and over, so never evict them.
+            self.cache.pin((self.path, v['id']))
+            return vsn
         else: return None
 
-    def all_versions_where(self, pred):
+    def all_versions_where(self, pred, cached=True):
         """
         A generator which lists of every single version whose ID and name match
         the given predicate.
@@ -284,63 +860,190 @@ class Channel(object):
         The predicate takes a tuple with the version ID and name and returns
         true or false indicating whether the version should be listed.
 
+        If `cached` is false, versions which aren't in the cache yet are
+        loaded without being added to it, and the versions yielded are copies
+        which the caller is free to change.
+
         This will be horribly slow on non-disk backends like S3.
         """
-        for v in self.versions:
+        prev = prev_copy = None
+        def resolve(id):
+            # Delta versions are usually based on the previous one, which we
+            # still have even if it isn't cached.
+            if prev != None and prev.id == id:
+                return prev
+            return self.get_version(id)
+        for v in self.all_version_entries():
             if pred(v['id'], v['name']):
-                yield self.get_version(v['id'])
+                vsn = self.cache.get((self.path, v['id']))
+                if vsn == None:
+                    vsn = self.load_version(v, cached, resolve)
+                if cached:
+                    prev = vsn
+                    yield vsn
+                    continue
+                # Callers like mod-urls change the versions they're given in
+                # place, so they get a copy. Otherwise the changes would end
+                # up in the cache and in the files of later delta versions
+                # built on this one.
+                copy = vsn.copy()
+                if prev != None and vsn.base is prev:
+                    # Diff against the copy the caller changed, so a delta
+                    # saved after rewriting its URLs only lists the files
+                    # which really changed.
+                    copy.base = prev_copy
+                prev, prev_copy = vsn, copy
+                yield copy
+
+    def rewrite_change_manifests(self, rewrite, commit):
+        """
+        Replaces every source URL in the channel's change manifests with the
+        result of calling `rewrite` on it. Manifests whose URLs changed are
+        saved if `commit` is true.
+
+        Returns the number of manifests which changed.
+        """
+        changes_dir = os.path.join(self.path, 'changes')
+        try:
+            names = self.backend.list_dir(changes_dir, 'files')
+        except OSError:
+            return 0
+        changed = 0
+        for name in sorted(names):
+            # Skip leftovers from writes which are in progress.
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(changes_dir, name)
+            obj = self.backend.read_json(path)
+            obj_changed = False
+            for entry in obj['Added'] + obj['Changed']:
+                for src in entry['Sources']:
+                    url = rewrite(src['Url'])
+                    if url != src['Url']:
+                        src['Url'] = url
+                        obj_changed = True
+            if obj_changed:
+                changed += 1
+                if commit: self.backend.write_json(obj, path)
+        return changed
 
     def index_path(self):
         return os.path.join(self.path, 'index.json')
 
+    def head_path(self):
+        return os.path.join(self.path, 'head.json')
+
 
 
 class Version(object):
     """
     Class for holding information about versions.
+
+    Every version is saved in the legacy `ApiVersion: 0` format, which lists
+    all of its files. If the collection has delta versions enabled, versions
+    are also saved in the `ApiVersion: 1` format, which stores only the
+    differences from a base version, with a full snapshot every so often to
+    keep chains short.
     """
 
     @classmethod
-    def load(cls, backend, chan_dir, id, name):
+    def load(cls, backend, chan_dir, id, name, resolve=None):
+        """
+        Loads a version from the given channel directory.
+
+        If `resolve` is given, the delta file is tried first. `resolve` is a
+        function which takes a version ID and returns the loaded `Version`
+        with that ID, and is used to load base versions.
+        """
         # print('Loading version "{0}" ({1}).'.format(name, id))
         b = backend
+        if resolve != None:
+            obj, _ = b.read_json_versioned(delta_file_path(chan_dir, id))
+            if obj != None:
+                vsn = cls.load_delta(b, chan_dir, obj, name, resolve)
+                if vsn != None:
+                    return vsn
         jsonFilename = os.path.join(chan_dir, str(id) + '.json')
         # print("Reading: " + jsonFilename)
-        obj = b.read_json(jsonFilename)
+        # Version files can list a huge number of files, so they're parsed
+        # one file entry at a time instead of all at once.
+        obj = dict()
+        files = []
+        f = b.open_read(jsonFilename)
+        try:
+            for key, value in iter_members(f, ('Files',)):
+                if key == 'Files':
+                    files.append(UpdateFile.fromdict(value))
+                else:
+                    obj[key] = value
+        finally:
+            f.close()
         assert obj['ApiVersion'] == 0
         assert id == obj['Id']
         #assert name == obj['Name']
-        files = []
-        for file in obj['Files']:
-            # We only support the 'http' type anyway, so we'll just load sources
-            # as a list of URLs.
-            sources = map(lambda src: src['Url'], file['Sources'])
-            path = file['Path']
-            executable = file['Executable']
-            md5 = file['MD5']
-            perms = file['Perms']
-            files.append(UpdateFile(path, md5, perms, sources, executable))
         return cls(b, chan_dir, id, name, files)
 
+    @classmethod
+    def load_delta(cls, backend, chan_dir, obj, name, resolve):
+        """
+        Loads a version from the given `ApiVersion: 1` object.
+
+        Returns `None` if the version's base can't be loaded.
+        """
+        assert obj['ApiVersion'] == 1
+        if obj['Base'] == None:
+            files = [UpdateFile.fromdict(file) for file in obj['Files']]
+            base = None
+        else:
+            base = resolve(obj['Base'])
+            if base == None:
+                return None
+            removed = set(obj['Removed'])
+            changed = dict((f['Path'], f) for f in obj['Changed'])
+            files = []
+            for file in base.files:
+                if file.path in changed:
+                    files.append(UpdateFile.fromdict(changed[file.path]))
+                elif file.path not in removed:
+                    files.append(file.copy())
+            files += [UpdateFile.fromdict(file) for file in obj['Added']]
+        vsn = cls(backend, chan_dir, obj['Id'], name, files)
+        vsn.base = base
+        vsn.delta_depth = obj['Depth']
+        return vsn
+
     def save(self):
-        file_arr = []
-        for file in self.files:
-            sources = [{'Url': url, 'SourceType': 'http'} for url in file.sources]
-            file_arr.append({
-                'Path':       file.path,
-                'MD5':        file.md5,
-                'Executable': file.executable,
-                'Perms':      file.perms,
-                'Sources':    sources,
-            })
+        # File entries are converted and written one at a time.
+        members = [
+            ('ApiVersion', 0),
+            ('Id',         self.id),
+            ('Name',       self.name),
+            ('Files',      (file.todict() for file in self.files)),
+        ]
+        print('Saving version info to {0}.'.format(self.vsn_file_path()))
+        with self.backend.open_write(self.vsn_file_path()) as f:
+            dump_members(f, members)
+        if self.delta_depth != None:
+            self.save_delta()
+
+    def save_delta(self):
+        """
+        Saves the version's delta file. If the version has no base, a full
+        snapshot is saved instead.
+        """
         obj = {
-            'ApiVersion': 0,
+            'ApiVersion': 1,
             'Id':         self.id,
             'Name':       self.name,
-            'Files':      file_arr,
+            'Depth':      self.delta_depth,
         }
-        print('Saving version info to {0}.'.format(self.vsn_file_path()))
-        self.backend.write_json(obj, self.vsn_file_path())
+        if self.base == None:
+            obj['Base'] = None
+            obj['Files'] = [file.todict() for file in self.files]
+        else:
+            obj['Base'] = self.base.id
+            obj.update(diff_files(self.base.files, self.files))
+        self.backend.write_json(obj, self.delta_file_path())
 
     def __init__(self, backend, chan_dir, id, name, files):
         self.backend = backend
@@ -348,12 +1051,193 @@ class Version(object):
         self.id = id
         self.name = name
         self.files = files
+        # The version which the delta file is relative to, or `None` if the
+        # delta file is a full snapshot.
+        self.base = None
+        # The number of deltas between this version and the last snapshot.
+        # `None` means the version has no delta file.
+        self.delta_depth = None
+
+    def copy(self):
+        vsn = Version(self.backend, self.chan_dir, self.id, self.name,
+                      [file.copy() for file in self.files])
+        vsn.base = self.base
+        vsn.delta_depth = self.delta_depth
+        return vsn
 
     def vsn_file_path(self):
         return os.path.join(self.chan_dir, str(self.id) + '.json')
 
+    def delta_file_path(self):
+        return delta_file_path(self.chan_dir, self.id)
+
+
+def delta_file_path(chan_dir, id):
+    return os.path.join(chan_dir, str(id) + '.delta.json')
+
+def change_manifest_path(chan_dir, from_id, to_id):
+    return os.path.join(chan_dir, 'changes', '{0}-{1}.json'.format(from_id, to_id))
+
+def diff_files(old, new):
+    """
+    Compares two lists of `UpdateFile` objects and returns a dict with the
+    `Added` and `Changed` files from `new` and the `Removed` paths.
+    """
+    old_files = dict((f.path, f) for f in old)
+    paths = set(f.path for f in new)
+    return {
+        'Added':   [f.todict() for f in new if f.path not in old_files],
+        'Changed': [f.todict() for f in new
+                    if f.path in old_files and
+                    f.todict() != old_files[f.path].todict()],
+        'Removed': [p for p in old_files if p not in paths],
+    }
+
+def save_change_manifest(backend, chan_dir, old, new):
+    """
+    Saves the list of files which changed between the `old` and `new`
+    versions. A client on the old version only needs to fetch this instead
+    of the new version's full file list.
+    """
+    obj = {
+        'ApiVersion': 0,
+        'From':       old.id,
+        'To':         new.id,
+    }
+    obj.update(diff_files(old.files, new.files))
+    path = change_manifest_path(chan_dir, old.id, new.id)
+    print('Saving change manifest to {0}.'.format(path))
+    backend.write_json(obj, path)
+
+class VersionCache(object):
+    """
+    A bounded least recently used cache of loaded versions, shared by all
+    channels.
+
+    The cache holds at most `max_entries` versions and roughly `max_bytes`
+    worth of file lists. Pinned versions are never evicted. Each channel has
+    at most one pinned version, so pinning a channel's new latest version
+    unpins the old one.
+    """
+    def __init__(self, max_entries=256, max_bytes=256*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Maps `(channel path, version ID)` keys to `(version, size)` tuples,
+        # least recently used first.
+        self.entries = OrderedDict()
+        # Maps channel paths to the key of the channel's pinned version.
+        self.pinned = dict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, vsn):
+        size = version_size(vsn)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old != None:
+                self.size -= old[1]
+            self.entries[key] = (vsn, size)
+            self.size += size
+            self.evict()
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned[key[0]] = key
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used unpinned versions until the cache is
+        within its budget.
+        """
+        for key in list(self.entries.keys()):
+            if len(self.entries) <= self.max_entries and self.size <= self.max_bytes:
+                break
+            if self.pinned.get(key[0]) != key:
+                _, size = self.entries.pop(key)
+                self.size -= size
+
+def version_size(vsn):
+    """
+    Returns a rough estimate of how much memory a loaded version takes.
+    """
+    size = 0
+    for f in vsn.files:
+        # Per-object overhead, plus the strings.
+        size += 400 + len(f.path) + len(f.md5) + sum(len(src) + 50 for src in f.sources)
+    return size
+
+# The cache of loaded versions used by all channels.
+version_cache = VersionCache()
+
+
+def load_channels(backend, path, obj, options=None):
+    """
+    Loads the channels listed in the given `channels.json` object from the
+    given platform directory.
+    """
+    if obj['format_version'] != 0:
+        raise IOError('Format version mismatch.')
+
+    channels = []
+    for chan_obj in obj['channels']:
+        try:
+            channels.append(Channel.load(backend, path, chan_obj, options))
+        except Exception as e:
+            print('Failed to load channel "{0}" from platform "{1}": {2}'
+                  .format(chan_obj['id'], path, str(e)))
+    return channels
+
+def index_entry(v):
+    """
+    Returns the `index.json` entry for the given version dict.
+    """
+    return dict(Id = v['id'], Name = v['name'])
+
+def index_versions(idx):
+    """
+    Returns the list of version dicts in the given `index.json` object.
+    """
+    versions = []
+    for vsn_obj in idx['Versions']:
+        # TODO: Maybe check if the version file exists?
+        versions.append(dict(
+            id=vsn_obj['Id'],
+            name=vsn_obj['Name'],
+        ))
+    return versions
+
 
 class UpdateFile(object):
+    @classmethod
+    def fromdict(cls, obj):
+        """
+        Loads a file from an entry in a version file's `Files` list.
+        """
+        # We only support the 'http' type anyway, so we'll just load sources
+        # as a list of URLs.
+        sources = [src['Url'] for src in obj['Sources']]
+        return cls(obj['Path'], obj['MD5'], obj['Perms'], sources,
+                   obj['Executable'])
+
+    def todict(self):
+        sources = [{'Url': url, 'SourceType': 'http'} for url in self.sources]
+        return {
+            'Path':       self.path,
+            'MD5':        self.md5,
+            'Executable': self.executable,
+            'Perms':      self.perms,
+            'Sources':    sources,
+        }
+
     def __init__(self, path, md5, perms, sources, executable):
         self.path = path
         self.md5 = md5
@@ -361,6 +1245,10 @@ class UpdateFile(object):
         self.sources = sources
         self.executable = executable
 
+    def copy(self):
+        return UpdateFile(self.path, self.md5, self.perms, list(self.sources),
+                          self.executable)
+
 
 
 def read_json(path):
@@ -0,0 +1,198 @@
+# The "export" and "import" commands pack a whole collection into a single
+# archive and unpack it again.
+
+import os, io, json, tarfile, tempfile, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import repoman.repo as repo
+
+from repoman.command import command, Argument, with_collection
+
+# Name of the archive member listing the archive's files and their MD5s. It's
+# always the first member, so imports can verify files as they're read.
+MANIFEST_NAME = 'manifest.json'
+
+
+@command('export',
+         Argument('archive', help='path of the archive to write'),
+         Argument('--with-storage', action='store_true',
+                  help='include storage files as well as metadata'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of files to download at once'),
+         description="""
+         Packs the collection's metadata, and optionally its storage files,
+         into a single tar archive (gzipped if the name ends in .gz) with a
+         manifest of MD5s.
+         """,
+)
+@with_collection
+def export(collection, archive, with_storage, jobs, **kwargs):
+    b = collection.backend
+    files = collection.list_files(storage=with_storage)
+    members = [(kind, path, archive_name(collection, kind, path), md5)
+               for kind, path, md5 in files]
+    manifest = dict(
+        format_version = 0,
+        storage_path = collection.storage.path,
+        cache_control = collection.cache_control(),
+        files = [dict(name = name, kind = kind, md5 = md5)
+                 for kind, _, name, md5 in members],
+    )
+
+    def download(member):
+        _, path, _, md5 = member
+        fd, tmp = tempfile.mkstemp(prefix='repoman-export-')
+        os.close(fd)
+        b.download_file(path, tmp)
+        # Multipart S3 ETags aren't MD5s, so those can't be checked.
+        if '-' not in md5 and hash_file(tmp) != md5:
+            os.remove(tmp)
+            raise IOError('{0} changed while exporting.'.format(path))
+        return tmp
+
+    mode = 'w|gz' if archive.endswith('.gz') else 'w|'
+    with tarfile.open(archive, mode) as tar:
+        data = json.dumps(manifest).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+        # Download a batch of files at a time and append them to the archive
+        # in order.
+        batch = jobs * 4
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for start in range(0, len(members), batch):
+                chunk = members[start:start+batch]
+                for member, tmp in zip(chunk, pool.map(download, chunk)):
+                    try:
+                        tar.add(tmp, arcname=member[2])
+                    finally:
+                        os.remove(tmp)
+    print('Exported {0} files to {1}.'.format(len(members), archive))
+
+
+@command('import',
+         Argument('archive', help='path of the archive to read'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of files to upload at once'),
+         description="""
+         Unpacks an archive written by export into the collection path. Files
+         are verified against the archive's manifest as they are read, and
+         metadata is written after the files it links to.
+         """,
+)
+def import_collection(backend, collection, archive, jobs, **kwargs):
+    # The archive is closed even if a check fails part of the way.
+    with tarfile.open(archive, 'r|*') as tar:
+        first = tar.next()
+        if first == None or first.name != MANIFEST_NAME:
+            raise IOError('{0} does not start with a manifest.'.format(archive))
+        manifest = json.loads(tar.extractfile(first).read().decode('utf-8'))
+        if manifest['format_version'] != 0:
+            raise IOError('Format version mismatch.')
+        expected = dict((f['name'], f) for f in manifest['files'])
+        storage_path = manifest['storage_path']
+        if os.path.isabs(storage_path) or '..' in storage_path.split('/'):
+            raise IOError('Unsafe storage path in manifest: {0}'.format(storage_path))
+        # Files are written with the caching headers of the collection they
+        # were exported from. Older archives don't have them, so they get the
+        # defaults.
+        policy = manifest.get('cache_control', repo.DEFAULT_CACHE_CONTROL)
+        kinds = dict()
+        backend.cache_control = lambda path: policy.get(kinds.get(path))
+
+        def upload(tmp, dest):
+            try:
+                backend.upload_file(tmp, dest)
+            finally:
+                os.remove(tmp)
+
+        imported = 0
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = []
+            kind = None
+            for member in tar:
+                # Iterating starts over from the manifest, which we already
+                # read.
+                if member.name == MANIFEST_NAME:
+                    continue
+                entry = expected.pop(member.name, None)
+                if entry == None:
+                    raise IOError('{0} is not in the manifest.'.format(member.name))
+                if not member.isfile():
+                    raise IOError('{0} is not a regular file.'.format(member.name))
+                dest = destination_path(collection, storage_path, member.name)
+                # Wait for all files of one kind to be written before starting
+                # on the next, so metadata never links to missing files.
+                if entry['kind'] != kind:
+                    wait_all(pending)
+                    pending = []
+                    kind = entry['kind']
+                # Every pending upload has a temporary file, so don't let them
+                # pile up faster than they're uploaded.
+                if len(pending) >= jobs * 4:
+                    pending.pop(0).result()
+
+                fd, tmp = tempfile.mkstemp(prefix='repoman-import-')
+                md5 = hashlib.md5()
+                with os.fdopen(fd, 'wb') as f:
+                    src = tar.extractfile(member)
+                    for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                        md5.update(chunk)
+                        f.write(chunk)
+                if '-' not in entry['md5'] and md5.hexdigest() != entry['md5']:
+                    os.remove(tmp)
+                    raise IOError('{0} is corrupt.'.format(member.name))
+
+                kinds[dest] = entry['kind']
+                pending.append(pool.submit(upload, tmp, dest))
+                imported += 1
+            wait_all(pending)
+
+    if len(expected) > 0:
+        raise IOError('{0} files from the manifest are missing from the archive.'
+                      .format(len(expected)))
+    print('Imported {0} files into {1}.'.format(imported, collection))
+
+
+def archive_name(collection, kind, path):
+    """
+    Returns the name a file is stored under in an exported archive. Storage
+    files go under `storage/` and everything else under `collection/`.
+    """
+    if kind == 'storage':
+        return 'storage/' + relpath(path, collection.storage.path)
+    return 'collection/' + relpath(path, collection.path)
+
+def destination_path(collection_path, storage_path, name):
+    """
+    Returns the path an archive member is imported to.
+
+    Raises `IOError` for names which would be imported outside of the
+    collection or storage directory.
+    """
+    top, _, rel = name.partition('/')
+    rel = os.path.normpath(rel)
+    if (top not in ('storage', 'collection') or rel in ('', '.') or
+            os.path.isabs(rel) or rel.split(os.sep)[0] == '..'):
+        raise IOError('Unsafe path in archive: {0}'.format(name))
+    if top == 'storage':
+        return os.path.join(storage_path, rel)
+    return os.path.join(collection_path, rel)
+
+def relpath(path, start):
+    if start == '':
+        return path
+    return os.path.relpath(path, start)
+
+def wait_all(futures):
+    # `result()` re-raises any errors from the uploads.
+    for f in futures:
+        f.result()
+
+def hash_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
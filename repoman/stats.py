@@ -0,0 +1,141 @@
+# The "stats" command reports how much space a collection takes up.
+
+import os, json
+from concurrent.futures import ThreadPoolExecutor
+
+from repoman.command import command, Argument, with_collection
+
+
+@command('stats',
+         Argument('--json', action='store_true', dest='as_json',
+                  help='print the statistics as JSON'),
+         Argument('--jobs', type=int, default=8,
+                  help='number of channels to read at once'),
+         description="""
+         Reports the number of versions in every channel, how many bytes they
+         link to, how many bytes storage actually holds, the deduplication
+         ratio, and how many bytes orphan-files and obsolete-files would free.
+         """,
+)
+@with_collection
+def stats(collection, as_json, jobs, **kwargs):
+    # File sizes come from a single storage listing. Versions are streamed
+    # without filling the version cache, so this works on big collections.
+    sizes = collection.storage.get_file_sizes()
+    platforms = list(collection.list_platforms())
+    chans = [(plat, ch) for plat in platforms for ch in plat.channels]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(lambda c: channel_stats(c[1], sizes), chans))
+
+    linked = set()
+    latest = set()
+    plat_stats = dict()
+    plat_linked = dict()
+    for (plat, ch), (ch_stats, ch_linked, ch_latest) in zip(chans, results):
+        linked |= ch_linked
+        latest |= ch_latest
+        p = plat_stats.setdefault(plat.name, dict(versions = 0, referenced_bytes = 0,
+                                                  channels = dict()))
+        p['versions'] += ch_stats['versions']
+        p['referenced_bytes'] += ch_stats['referenced_bytes']
+        p['channels'][ch.id] = ch_stats
+        plat_linked.setdefault(plat.name, set()).update(ch_linked)
+    for name, p in plat_stats.items():
+        p['unique_bytes'] = blob_bytes(plat_linked[name], sizes)
+
+    stored = set(sizes.keys())
+    referenced = sum(p['referenced_bytes'] for p in plat_stats.values())
+    unique = blob_bytes(linked & stored, sizes)
+    result = dict(
+        versions = sum(p['versions'] for p in plat_stats.values()),
+        referenced_bytes = referenced,
+        unique_bytes = unique,
+        stored_files = len(stored),
+        stored_bytes = sum(sizes.values()),
+        dedup_ratio = referenced / unique if unique > 0 else None,
+        missing_files = len(linked - stored),
+        orphan_files = len(stored - linked),
+        orphan_bytes = blob_bytes(stored - linked, sizes),
+        obsolete_files = len(stored - latest),
+        obsolete_bytes = blob_bytes(stored - latest, sizes),
+        platforms = plat_stats,
+    )
+
+    if as_json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_stats(result)
+
+
+def channel_stats(chan, sizes):
+    """
+    Reads every version in the given channel once and returns a tuple with a
+    dictionary of statistics about the channel, the set of storage file names
+    its versions link to, and the set of storage file names its latest
+    version links to.
+    """
+    versions = 0
+    files = 0
+    referenced = 0
+    linked = set()
+    latest = None
+    for vsn in chan.all_versions_where(lambda id, name: True, cached=False):
+        versions += 1
+        files += len(vsn.files)
+        names = set()
+        for f in vsn.files:
+            name = os.path.basename(f.sources[0]) if len(f.sources) > 0 else None
+            referenced += sizes.get(name, 0)
+            for src in f.sources:
+                names.add(os.path.basename(src))
+        linked |= names
+        if latest == None or int(vsn.id) > int(latest[0]):
+            latest = (vsn.id, names)
+
+    ch_stats = dict(
+        versions = versions,
+        files = files,
+        referenced_bytes = referenced,
+        unique_bytes = blob_bytes(linked, sizes),
+        latest_id = latest[0] if latest != None else None,
+        latest_bytes = blob_bytes(latest[1], sizes) if latest != None else 0,
+    )
+    return ch_stats, linked, latest[1] if latest != None else set()
+
+def blob_bytes(names, sizes):
+    """
+    Returns the total size of the given storage files. Missing files count as
+    zero bytes.
+    """
+    return sum(sizes.get(n, 0) for n in names)
+
+def print_stats(s):
+    for plat_name, p in sorted(s['platforms'].items()):
+        print('{0}: {1} versions, {2} referenced, {3} unique'
+              .format(plat_name, p['versions'], format_bytes(p['referenced_bytes']),
+                      format_bytes(p['unique_bytes'])))
+        for ch_id, c in sorted(p['channels'].items()):
+            print('  {0}: {1} versions, {2} referenced, {3} unique, latest {4} ({5})'
+                  .format(ch_id, c['versions'], format_bytes(c['referenced_bytes']),
+                          format_bytes(c['unique_bytes']), c['latest_id'],
+                          format_bytes(c['latest_bytes'])))
+    print('Versions:    {0}'.format(s['versions']))
+    print('Referenced:  {0}'.format(format_bytes(s['referenced_bytes'])))
+    print('Stored:      {0} in {1} files'.format(format_bytes(s['stored_bytes']),
+                                                  s['stored_files']))
+    if s['dedup_ratio'] != None:
+        print('Dedup ratio: {0:.2f}'.format(s['dedup_ratio']))
+    print('Orphaned:    {0} in {1} files (freed by orphan-files)'
+          .format(format_bytes(s['orphan_bytes']), s['orphan_files']))
+    print('Obsolete:    {0} in {1} files (freed by obsolete-files)'
+          .format(format_bytes(s['obsolete_bytes']), s['obsolete_files']))
+    if s['missing_files'] > 0:
+        print('Missing:     {0} linked files are not in storage'.format(s['missing_files']))
+
+def format_bytes(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n < 1024:
+            return '{0:.1f} {1}'.format(n, unit) if unit != 'B' else '{0} B'.format(n)
+        n /= 1024
+    return '{0:.1f} TiB'.format(n)
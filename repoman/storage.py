@@ -1,4 +1,15 @@
-import os, hashlib, shutil
+import os, re, hashlib, shutil, bisect
+from concurrent.futures import ThreadPoolExecutor
+
+# Matches the names of files added with `add_file`, which start with the MD5 of
+# their contents.
+BLOB_NAME_RE = re.compile(r'^([0-9a-f]{32})-')
+
+# Directory inside the storage directory which archived files are moved to.
+COLD_DIR = 'cold'
+
+# Name of the partition made up of the collection's main storage directory.
+DEFAULT_PARTITION = 'default'
 
 def md5s_loaded(func):
     """Decorator which automatically calls load_md5s."""
@@ -18,13 +29,33 @@ class FileStorage(object):
 
     The class also manages a cache of the storage files' MD5s in an `cache.json`
     file inside the storage directory.
+
+    If `shard_depth` is greater than zero, files are stored in nested
+    subdirectories named after the first bytes of their MD5, like
+    `ab/cd/<md5>-<name>`, so no single directory gets too big. Files which are
+    still in the top-level directory from before the collection was sharded
+    are found as well.
+
+    Files which only old versions link to can be archived. On backends with
+    storage tiers, like S3, they're moved to the cheaper tier where they are.
+    Otherwise they're moved into the `cold` directory. The MD5 cache keeps
+    track of which tier each file is in, and archived files are restored
+    instead of uploaded again when they're pushed.
     """
-    def __init__(self, backend, path, url):
+    def __init__(self, backend, path, url, shard_depth=0):
         self.backend = backend
         self.path = path
         self.url = url
+        self.shard_depth = shard_depth
+        self.cold_path = os.path.join(path, COLD_DIR)
         # When this is None, it indicates MD5s haven't been loaded yet.
         self.md5_map = None
+        # Maps the MD5s of archived files to their paths, in the cold
+        # directory or where they were archived in place. Loaded along with
+        # `md5_map`.
+        self.cold_map = None
+        # Maps the names of the files found by `get_all_files` to their paths.
+        self.file_paths = dict()
 
     @md5s_loaded
     def add_file(self, file):
@@ -36,10 +67,62 @@ class FileStorage(object):
         hash = hash_file(file)
         _, filename = os.path.split(file)
         saneFileName = self.backend.sanitize_file_name(filename)
-        dest = os.path.join(self.path, '{0}-{1}'.format(hash, saneFileName))
+        dest = self.blob_path('{0}-{1}'.format(hash, saneFileName))
         self.backend.upload_file(file, dest)
+        # Keep the cache up to date so the same contents aren't uploaded
+        # twice.
+        self.md5_map[hash] = dest
         return dest
 
+    def add_fileobj(self, fileobj, filename, md5):
+        """
+        Adds the contents of the given file object to storage under the given
+        file name. `md5` is the MD5 of the contents, which the caller has
+        already read once to work out.
+        """
+        saneFileName = self.backend.sanitize_file_name(filename)
+        dest = self.blob_path('{0}-{1}'.format(md5, saneFileName))
+        self.backend.upload_fileobj(fileobj, dest)
+        if self.md5_map != None:
+            self.md5_map[md5] = dest
+        return dest
+
+    def url_for(self, path):
+        """
+        Returns the URL of the file at the given path in storage.
+        """
+        # TODO: Handle slash nonsense better when joining URLs.
+        return self.url + os.path.relpath(path, self.path)
+
+    def partitions(self):
+        """
+        Returns the list of `FileStorage` objects files are spread over.
+        """
+        return [self]
+
+    def blob_path(self, filename):
+        """
+        Returns the path where the file with the given name belongs, according
+        to the storage layout.
+        """
+        m = BLOB_NAME_RE.match(filename)
+        if self.shard_depth == 0 or m == None:
+            return os.path.join(self.path, filename)
+        return os.path.join(self.path, shard_dir(m.group(1), self.shard_depth), filename)
+
+    def is_blob_path(self, rel_path):
+        """
+        Checks if the given path relative to the storage directory is somewhere
+        a file could be stored, either at the top level or in a shard
+        directory.
+        """
+        parts = rel_path.split('/')
+        if len(parts) == 1:
+            return True
+        m = BLOB_NAME_RE.match(parts[-1])
+        return (self.shard_depth > 0 and m != None and
+                os.path.dirname(rel_path) == shard_dir(m.group(1), self.shard_depth))
+
     def add_raw_file(self, file):
         """
         Adds the given file to storage without messing with it.
@@ -54,16 +137,49 @@ class FileStorage(object):
         """
         Deletes the given file.
         """
-        self.backend.delete_file(os.path.join(self.path, filename))
+        path = self.file_paths.get(filename, self.blob_path(filename))
+        self.backend.delete_file(path)
         if self.md5_map != None:
-            md5_map = dict([(k, v) for k, v in self.md5_map.items if v != path])
+            self.md5_map = dict([(k, v) for k, v in self.md5_map.items() if v != path])
 
     def load_md5s(self):
         """
         Loads the MD5s of all of the files in storage.
         """
         # TODO: Caching
-        self.md5_map = self.backend.md5_dir(self.path)
+        try:
+            self.md5_map = self.backend.md5_dir(self.path)
+        except OSError:
+            # New storage directories are only created when the first file is
+            # added to them.
+            self.md5_map = dict()
+        if self.shard_depth > 0:
+            # Files in shard directories are named after their MD5, so we
+            # don't need to hash them.
+            for rel in self.backend.walk_files(self.path):
+                m = BLOB_NAME_RE.match(os.path.basename(rel))
+                if '/' in rel and m != None and self.is_blob_path(rel):
+                    self.md5_map[m.group(1)] = os.path.join(self.path, rel)
+        self.cold_map = dict()
+        for rel in self.backend.walk_archived(self.path):
+            path = os.path.join(self.path, rel)
+            md5 = self.md5_for_name(os.path.basename(rel), path)
+            if self.md5_map.get(md5) == path:
+                del self.md5_map[md5]
+            self.cold_map[md5] = path
+        for rel in self.backend.walk_files(self.cold_path):
+            path = os.path.join(self.cold_path, rel)
+            self.cold_map[self.md5_for_name(os.path.basename(rel), path)] = path
+
+    def md5_for_name(self, name, path):
+        """
+        Returns the MD5 of the file with the given name at the given path,
+        taking it from the name if possible.
+        """
+        m = BLOB_NAME_RE.match(name)
+        if m != None:
+            return m.group(1)
+        return self.backend.get_md5(path)
 
     @md5s_loaded
     def is_md5_present(self, md5):
@@ -80,11 +196,281 @@ class FileStorage(object):
         """
         if md5 in self.md5_map:
             return self.md5_map[md5]
+        elif md5 in self.cold_map:
+            print('Restoring archived file "{0}".'.format(os.path.basename(self.cold_map[md5])))
+            return self.restore_md5(md5)
         else:
             return None
 
+    @md5s_loaded
+    def archive_file(self, filename):
+        """
+        Moves the given file to the cold tier. Returns the file's new path.
+        """
+        path = self.file_paths.get(filename, self.blob_path(filename))
+        if self.backend.archives_in_place:
+            cold = path
+        else:
+            cold = os.path.join(self.cold_path, os.path.relpath(path, self.path))
+        self.backend.archive_file(path, cold)
+        md5 = self.md5_for_name(filename, cold)
+        if self.md5_map.get(md5) == path:
+            del self.md5_map[md5]
+        self.cold_map[md5] = cold
+        return cold
+
+    @md5s_loaded
+    def restore_md5(self, md5):
+        """
+        Moves the archived file with the given MD5 back to where it was
+        archived from. Returns the file's restored path.
+        """
+        cold = self.cold_map[md5]
+        if cold.startswith(self.cold_path.rstrip('/') + '/'):
+            path = os.path.join(self.path, os.path.relpath(cold, self.cold_path))
+        else:
+            path = cold
+        self.backend.restore_file(cold, path)
+        del self.cold_map[md5]
+        self.md5_map[md5] = path
+        return path
+
+    @md5s_loaded
+    def get_archived_files(self):
+        """
+        Returns a dictionary mapping the names of all archived files to their
+        MD5s.
+        """
+        return dict((os.path.basename(p), md5) for md5, p in self.cold_map.items())
+
     def get_all_files(self):
-        return [os.path.basename(f) for f in self.backend.list_dir(self.path, 'files')]
+        """
+        Returns the names of all of the files in storage.
+        """
+        if self.shard_depth == 0:
+            try:
+                paths = self.backend.list_dir(self.path, 'files')
+            except OSError:
+                paths = []
+        else:
+            paths = [p for p in self.backend.walk_files(self.path) if self.is_blob_path(p)]
+        self.file_paths = dict((os.path.basename(p), os.path.join(self.path, p))
+                               for p in paths)
+        return list(self.file_paths.keys())
+
+    def get_file_sizes(self):
+        """
+        Returns a dictionary mapping the names of all of the files in storage
+        to their sizes in bytes.
+        """
+        if self.shard_depth == 0:
+            try:
+                sizes = self.backend.list_sizes(self.path)
+            except OSError:
+                sizes = dict()
+        else:
+            sizes = self.backend.walk_sizes(self.path)
+        return dict((os.path.basename(p), n) for p, n in sizes.items()
+                    if self.is_blob_path(p))
+
+
+class PartitionedStorage(object):
+    """
+    Class which spreads a collection's files over several `FileStorage`
+    partitions, each with its own path and URL and possibly its own backend.
+
+    New files are placed by consistent hashing of their MD5: every partition
+    gets `vnodes` points on a hash ring, and a file goes to the partition
+    owning the first point after its MD5. Adding a partition only takes over
+    a share of new files from each existing one, and files which were placed
+    before are found wherever they are, so nothing has to be moved.
+
+    Lookups and listings go to all partitions in parallel and are merged.
+    """
+    def __init__(self, partitions, vnodes=64):
+        # Maps partition names to `FileStorage` objects. The default
+        # partition's attributes are used where one storage path or URL is
+        # expected, like in the collection's config.
+        self.by_name = partitions
+        default = partitions[DEFAULT_PARTITION]
+        self.backend = default.backend
+        self.path = default.path
+        self.url = default.url
+        self.shard_depth = default.shard_depth
+        # Files are told apart by their paths, so partitions can't share or
+        # nest directories, even on different backends.
+        paths = [p.path.rstrip('/') + '/' for p in partitions.values()]
+        for a in paths:
+            if any(b != a and b.startswith(a) for b in paths) or paths.count(a) > 1:
+                raise ValueError('Storage partitions need separate paths.')
+        self.ring = sorted((ring_point('{0}#{1}'.format(name, i)), name)
+                           for name in partitions for i in range(vnodes))
+        # Maps the names of files found by `get_all_files` to their partitions.
+        self.file_partitions = dict()
+
+    def partitions(self):
+        return list(self.by_name.values())
+
+    def partition_for(self, md5):
+        """
+        Returns the partition new files with the given MD5 are placed in.
+        """
+        i = bisect.bisect(self.ring, (int(md5[:8], 16), ''))
+        return self.by_name[self.ring[i % len(self.ring)][1]]
+
+    def map_partitions(self, func):
+        """
+        Calls the given function with every partition in parallel and returns
+        a list of the results.
+        """
+        parts = self.partitions()
+        with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+            return list(pool.map(func, parts))
+
+    def load_md5s(self):
+        self.map_partitions(lambda p: p.load_md5s())
+
+    def add_file(self, file):
+        return self.partition_for(hash_file(file)).add_file(file)
+
+    def add_fileobj(self, fileobj, filename, md5):
+        return self.partition_for(md5).add_fileobj(fileobj, filename, md5)
+
+    def file_for_md5(self, md5):
+        if any(p.md5_map == None for p in self.partitions()):
+            self.load_md5s()
+        # Check the partition the file would be placed in first, then the
+        # others, in case it was placed before partitions were added.
+        home = self.partition_for(md5)
+        for p in [home] + [p for p in self.partitions() if p is not home]:
+            if md5 in p.md5_map:
+                return p.md5_map[md5]
+        for p in self.partitions():
+            if md5 in p.cold_map:
+                return p.file_for_md5(md5)
+        return None
+
+    def is_md5_present(self, md5):
+        return self.file_for_md5(md5) != None
+
+    def partition_of(self, path):
+        """
+        Returns the partition the given storage path is in.
+        """
+        for p in self.partitions():
+            if path == p.path or path.startswith(p.path.rstrip('/') + '/'):
+                return p
+        raise ValueError('{0} is not in any storage partition.'.format(path))
+
+    def url_for(self, path):
+        return self.partition_of(path).url_for(path)
+
+    def get_all_files(self):
+        self.file_partitions = dict()
+        for p, names in zip(self.partitions(), self.map_partitions(lambda p: p.get_all_files())):
+            for name in names:
+                self.file_partitions[name] = p
+        return list(self.file_partitions.keys())
+
+    def get_file_sizes(self):
+        sizes = dict()
+        for s in self.map_partitions(lambda p: p.get_file_sizes()):
+            sizes.update(s)
+        return sizes
+
+    def get_archived_files(self):
+        archived = dict()
+        for a in self.map_partitions(lambda p: p.get_archived_files()):
+            archived.update(a)
+        return archived
+
+    def remove_file(self, filename):
+        self.owner(filename).remove_file(filename)
+
+    def archive_file(self, filename):
+        return self.owner(filename).archive_file(filename)
+
+    def restore_md5(self, md5):
+        for p in self.partitions():
+            if p.cold_map == None:
+                p.load_md5s()
+            if md5 in p.cold_map:
+                return p.restore_md5(md5)
+        raise KeyError(md5)
+
+    def owner(self, filename):
+        """
+        Returns the partition which has the file with the given name, as found
+        by `get_all_files`.
+        """
+        if len(self.file_partitions) == 0:
+            self.get_all_files()
+        return self.file_partitions[filename]
+
+
+def load_storage(backend, storage_path, storage_url, options):
+    """
+    Creates the storage object for a collection with the given storage path,
+    URL and options.
+    """
+    layout = options.get('storage_layout', dict())
+    depth = layout.get('shard_depth', 0)
+    default = FileStorage(backend, storage_path, storage_url, depth)
+    config = options.get('storage_partitions')
+    if config == None:
+        return default
+    partitions = {DEFAULT_PARTITION: default}
+    for obj in config['partitions']:
+        partitions[obj['name']] = FileStorage(partition_backend(backend, obj),
+                                              obj['path'], obj['url'], depth)
+    return PartitionedStorage(partitions, config.get('vnodes', 64))
+
+def partition_backend(backend, obj):
+    """
+    Returns the backend for a storage partition's config. Partitions are on
+    the collection's backend unless they name an S3 bucket or a directory.
+    """
+    if obj.get('bucket') != None:
+        from repoman.backend.s3 import S3Backend
+        return S3Backend(obj['bucket'])
+    elif obj.get('dir') != None:
+        from repoman.backend.disk import DiskBackend
+        return DiskBackend(obj['dir'], getattr(backend, 'transfer', 'auto'))
+    return backend
+
+def ring_point(key):
+    """
+    Returns the position of the given string on the consistent hashing ring.
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+def walk_blob_md5s(backend, path):
+    """
+    Returns a dictionary mapping the paths of all files under the given
+    storage directory, relative to it, to their MD5s. The MD5s of files added
+    with `add_file` are taken from their names, so only files with other
+    names are read. A directory which doesn't exist is treated as empty.
+    """
+    try:
+        rels = backend.walk_files(path)
+    except OSError:
+        return dict()
+    md5s = dict()
+    for rel in rels:
+        name = os.path.basename(rel)
+        # Skip files which are still being uploaded.
+        if name.startswith('.') and name.endswith('.tmp'):
+            continue
+        m = BLOB_NAME_RE.match(name)
+        md5s[rel] = m.group(1) if m != None else backend.get_md5(os.path.join(path, rel))
+    return md5s
+
+def shard_dir(md5, depth):
+    """
+    Returns the shard directory for a file with the given MD5, like `ab/cd`
+    for a depth of 2.
+    """
+    return '/'.join(md5[i*2:i*2+2] for i in range(depth))
 
 def hash_file(path):
     with open(path, 'rb') as f:
@@ -0,0 +1,40 @@
+# The "rebuild-summary" command regenerates the collection's summary file.
+
+import os
+
+from repoman.command import command, with_collection
+
+
+@command('rebuild-summary',
+         description="""
+         Rebuilds the collection's summary file from every channel's latest
+         version. New collections get a summary which push keeps up to date.
+         Push never creates one, so this is needed once for collections
+         created by older versions of repoman.
+         """,
+)
+@with_collection
+def rebuild_summary(collection, **kwargs):
+    storage = collection.storage
+    # File sizes are looked up in storage, since versions don't record them.
+    sizes = storage.get_file_sizes()
+
+    platforms = dict()
+    for plat in collection.list_platforms():
+        chans = platforms[plat.name] = dict()
+        for ch in plat.channels:
+            vsn = ch.get_latest_vsn()
+            if vsn == None:
+                continue
+            size = 0
+            for f in vsn.files:
+                size += sizes.get(os.path.basename(f.sources[0]), 0)
+            chans[ch.id] = dict(
+                id = vsn.id,
+                name = vsn.name,
+                files = len(vsn.files),
+                bytes = size,
+            )
+    print('Saving collection summary to {0}.'.format(collection.summary_path()))
+    collection.backend.write_json(dict(format_version = 0, platforms = platforms),
+                                  collection.summary_path())
@@ -0,0 +1,182 @@
+# The "sync" command mirrors a collection from one backend to another.
+
+import os, json, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import repoman.repo as repo
+from repoman.command import command, Argument, with_collection
+from repoman.backend import list_md5s_or_empty
+from repoman.storage import walk_blob_md5s
+
+# Descriptions of the kinds of files in `repo.FILE_KINDS`.
+PHASE_NAMES = {
+    'storage':  'storage files',
+    'version':  'version files',
+    'index':    'channel indexes',
+    'platform': 'platform files',
+    'config':   'config files',
+}
+
+
+@command('sync',
+         Argument('--dest-bucket', type=str, default=None,
+                  help='S3 bucket to mirror the collection to'),
+         Argument('--dest-dir', type=str, default=None,
+                  help='directory to mirror the collection to'),
+         Argument('--dest-path', type=str, default='',
+                  help="""path of the mirrored collection on the destination
+                  backend"""),
+         Argument('--jobs', type=int, default=8,
+                  help='number of files to transfer at once'),
+         Argument('--checkpoint', type=str, default=None,
+                  help="""local file to record progress in, so an interrupted
+                  sync can be resumed"""),
+         description="""
+         Copies new and changed files from the collection to a mirror.
+         Storage files are copied first and metadata last, so the mirror never
+         links to files it doesn't have yet.
+         """,
+)
+@with_collection
+def sync(collection, dest_bucket, dest_dir, dest_path, jobs, checkpoint,
+         **kwargs):
+    if dest_bucket != None:
+        from repoman.backend.s3 import S3Backend
+        dest = S3Backend(dest_bucket)
+    elif dest_dir != None:
+        from repoman.backend.disk import DiskBackend
+        dest = DiskBackend(dest_dir)
+    else:
+        print('Either --dest-bucket or --dest-dir must be given.')
+        exit(-1)
+
+    syncer = Syncer(collection, dest, dest_path, jobs, checkpoint)
+    syncer.run()
+
+
+class Syncer(object):
+    """
+    Class which copies the files of a collection to another backend.
+
+    Files are compared by MD5 using directory listings from both backends and
+    only missing or changed files are transferred. Transfers happen in phases:
+    storage files, then version files and history pages, then channel indexes,
+    then platform `channels.json` files, and finally the collection's config.
+    """
+    def __init__(self, collection, dest, dest_path, jobs=8, checkpoint=None):
+        self.collection = collection
+        self.src = collection.backend
+        self.dest = dest
+        self.dest_path = dest_path
+        self.jobs = jobs
+        self.checkpoint = checkpoint
+        # Maps destination paths to the MD5s which have already been copied
+        # there.
+        self.done = dict()
+        self.lock = threading.Lock()
+        self.copied = 0
+        self.skipped = 0
+        # Maps destination paths to the kinds of the files copied there, so
+        # the mirror gets the collection's caching headers.
+        self.kinds = dict()
+        policy = collection.cache_control()
+        self.dest.cache_control = lambda path: policy.get(self.kinds.get(path))
+
+    def run(self):
+        self.load_checkpoint()
+        col = self.collection
+        storage_path = col.storage.path
+        # Storage files keep the same storage path on the destination. The
+        # storage directory may have shard subdirectories, so it's listed
+        # recursively, and MD5s are taken from the files' names instead of
+        # reading them. Other directories are listed as we come across them.
+        dest_storage = walk_blob_md5s(self.dest, storage_path)
+        dest_dirs = dict()
+
+        files = col.list_files()
+        for kind in repo.FILE_KINDS:
+            diff = []
+            for _, path, md5 in [f for f in files if f[0] == kind]:
+                if kind == 'storage':
+                    dest = path
+                    dest_md5 = dest_storage.get(os.path.relpath(path, storage_path))
+                else:
+                    dest = self.dest_for(path)
+                    dest_dir = os.path.dirname(dest)
+                    if dest_dir not in dest_dirs:
+                        dest_dirs[dest_dir] = list_md5s_or_empty(self.dest, dest_dir)
+                    dest_md5 = dest_dirs[dest_dir].get(os.path.basename(dest))
+                if dest_md5 == md5 or self.done.get(dest) == md5:
+                    self.skipped += 1
+                else:
+                    self.kinds[dest] = kind
+                    diff.append((path, dest, md5))
+            self.sync_phase(PHASE_NAMES[kind], diff)
+
+        print('Copied {0} files, {1} already up to date.'
+              .format(self.copied, self.skipped))
+        if self.checkpoint != None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def dest_for(self, path):
+        """
+        Returns the destination path for the given metadata path.
+        """
+        if self.collection.path == '':
+            rel = path
+        else:
+            rel = os.path.relpath(path, self.collection.path)
+        return os.path.join(self.dest_path, rel)
+
+    def sync_phase(self, desc, files):
+        """
+        Copies the given files in parallel. Returns once all of them have been
+        copied.
+        """
+        if len(files) == 0:
+            return
+        print('Copying {0} {1}.'.format(len(files), desc))
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                # Iterating over the results re-raises any errors from the
+                # transfers.
+                for _ in pool.map(lambda f: self.copy_file(*f), files):
+                    pass
+        finally:
+            # Keep what was copied before a failure, so a resumed sync
+            # doesn't copy it again.
+            self.save_checkpoint()
+
+    def copy_file(self, src, dest, md5):
+        fd, tmp = tempfile.mkstemp(prefix='repoman-sync-')
+        os.close(fd)
+        try:
+            self.src.download_file(src, tmp)
+            self.dest.upload_file(tmp, dest)
+        finally:
+            os.remove(tmp)
+        with self.lock:
+            self.done[dest] = md5
+            self.copied += 1
+            if self.copied % 100 == 0:
+                self.save_checkpoint_locked()
+
+    def load_checkpoint(self):
+        if self.checkpoint != None and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                self.done = json.load(f)
+            print('Resuming sync, {0} files already copied.'.format(len(self.done)))
+
+    def save_checkpoint(self):
+        with self.lock:
+            self.save_checkpoint_locked()
+
+    def save_checkpoint_locked(self):
+        if self.checkpoint == None:
+            return
+        # Write to a temporary file first so an interruption never leaves a
+        # half-written checkpoint behind.
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.done, f)
+        os.replace(tmp, self.checkpoint)
@@ -0,0 +1,154 @@
+# This module contains classes for watching a directory tree for changes.
+
+import os, time, struct, select, errno
+import ctypes, ctypes.util
+
+# Flags from <sys/inotify.h>.
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def watch_dir(path):
+    """
+    Returns a watcher for the directory tree at the given path. inotify is
+    used where it's available, and the tree is polled otherwise.
+    """
+    try:
+        return InotifyWatcher(path)
+    except OSError as e:
+        print('Cannot use inotify ({0}), polling for changes instead.'.format(e))
+        return PollingWatcher(path)
+
+
+class InotifyWatcher(object):
+    """
+    Watches a directory tree for changes using Linux's inotify.
+
+    Every directory in the tree gets its own watch, and watches are added for
+    new directories as they're created.
+    """
+    def __init__(self, root):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name == None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.root = root
+        # Maps watch descriptors to directory paths relative to the root.
+        self.dirs = dict()
+        self.add_tree('.')
+
+    def add_tree(self, rel_dir):
+        """
+        Adds watches for the given directory and all directories under it, and
+        returns the paths of all files in them.
+        """
+        files = set()
+        for root, dirs, names in os.walk(os.path.join(self.root, rel_dir)):
+            rel_root = os.path.normpath(os.path.relpath(root, self.root))
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'Cannot watch {0}'.format(root))
+            self.dirs[wd] = rel_root
+            for name in names:
+                files.add(os.path.normpath(os.path.join(rel_root, name)))
+        return files
+
+    def changes(self, timeout):
+        """
+        Waits up to `timeout` seconds for changes and returns the set of paths
+        of files which changed, relative to the root. Returns `None` if events
+        were lost and the whole tree needs to be checked again.
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos+length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                dir = self.dirs.get(wd)
+                if dir == None or name == '':
+                    continue
+                path = os.path.normpath(os.path.join(dir, name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files may have been written to the new directory
+                        # before its watch was added, so list them all.
+                        changed |= self.add_tree(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        # We don't know which files were in the directory, so
+                        # have the caller check everything under it.
+                        changed.add(path)
+                else:
+                    changed.add(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Watches a directory tree for changes by comparing file sizes and
+    modification times.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.state = self.scan()
+
+    def scan(self):
+        state = dict()
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                rel = os.path.normpath(os.path.relpath(path, self.root))
+                state[rel] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        state = self.scan()
+        changed = set(p for p in set(state) | set(self.state)
+                      if state.get(p) != self.state.get(p))
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
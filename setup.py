@@ -47,11 +47,12 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
     ],
 
+    # The asyncio traversals in repoman.aio need asyncio.run.
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='development deployment updates',
 
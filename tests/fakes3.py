@@ -0,0 +1,237 @@
+# A small in-process S3 stand-in for tests.
+#
+# It speaks just enough of the S3 REST API for boto and `S3Backend`: bucket
+# listings, object GET/HEAD/PUT/DELETE, server-side copies and conditional
+# writes. Faults can be queued up to make the next matching requests fail
+# like S3 does when it's overloaded.
+
+import hashlib, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+import boto.s3.connection
+
+
+class FakeS3(object):
+    """
+    An S3 server with a single bucket, running in a background thread.
+
+    `objects` maps key names to dicts with the object's `data`, `etag`,
+    `headers` and `storage_class`. `requests` records a `(method, key,
+    headers)` tuple for every request which was received.
+    """
+    def __init__(self, bucket_name='bucket'):
+        self.bucket_name = bucket_name
+        self.objects = dict()
+        self.requests = []
+        self.faults = []
+        self.lock = threading.RLock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def connect(self):
+        """
+        Returns a boto connection to the server. boto's own retries are turned
+        off, so every retry goes through the backend's scheduler.
+        """
+        conn = boto.s3.connection.S3Connection(
+            'test-key', 'test-secret', is_secure=False,
+            host='127.0.0.1', port=self.port,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat())
+        conn.num_retries = 0
+        return conn
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, count, method=None, status=503, code='SlowDown'):
+        """
+        Makes the next `count` requests with the given HTTP method, or any
+        method if it's `None`, fail with the given status and error code.
+        """
+        with self.lock:
+            self.faults.append(dict(count=count, method=method,
+                                    status=status, code=code))
+
+    def take_fault(self, method):
+        with self.lock:
+            for f in self.faults:
+                if f['count'] > 0 and f['method'] in (None, method):
+                    f['count'] -= 1
+                    return f
+        return None
+
+    def put_object(self, key, data, headers=None, storage_class='STANDARD'):
+        with self.lock:
+            obj = dict(data=data, etag='"{0}"'.format(hashlib.md5(data).hexdigest()),
+                       headers=headers or dict(), storage_class=storage_class,
+                       modified=time.gmtime())
+            self.objects[key] = obj
+            return obj
+
+
+def make_handler(s3):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def parse(self):
+            url = urlsplit(self.path)
+            bucket, _, key = url.path.lstrip('/').partition('/')
+            query = dict((k, v[0]) for k, v in
+                         parse_qs(url.query, keep_blank_values=True).items())
+            return bucket, unquote(key), query
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length > 0 else b''
+
+        def respond(self, status, body=b'', headers=None):
+            self.send_response(status)
+            headers = headers or dict()
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def error(self, status, code):
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<Error><Code>{0}</Code><Message>{0}</Message></Error>'
+                    .format(code)).encode('utf-8')
+            self.respond(status, body, {'Content-Type': 'application/xml'})
+
+        def handle_any(self):
+            bucket, key, query = self.parse()
+            body = self.read_body()
+            with s3.lock:
+                s3.requests.append((self.command, key, dict(self.headers)))
+            fault = s3.take_fault(self.command)
+            if fault != None:
+                return self.error(fault['status'], fault['code'])
+            if bucket != s3.bucket_name:
+                return self.error(404, 'NoSuchBucket')
+            if key == '':
+                if self.command == 'GET':
+                    return self.list_objects(query)
+                return self.respond(200)
+            if 'acl' in query:
+                # ACLs aren't stored. Every object is private.
+                if self.command == 'GET':
+                    return self.respond(200, ACL.encode('utf-8'),
+                                        {'Content-Type': 'application/xml'})
+                return self.respond(200)
+            getattr(self, 'object_' + self.command)(key, body)
+
+        do_GET = do_HEAD = do_PUT = do_DELETE = handle_any
+
+        def object_headers(self, obj):
+            headers = {
+                'ETag': obj['etag'],
+                'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', obj['modified']),
+                'x-amz-storage-class': obj['storage_class'],
+            }
+            headers.update(obj['headers'])
+            return headers
+
+        def object_GET(self, key, body):
+            obj = s3.objects.get(key)
+            if obj == None:
+                return self.error(404, 'NoSuchKey')
+            self.respond(200, obj['data'], self.object_headers(obj))
+
+        def object_HEAD(self, key, body):
+            obj = s3.objects.get(key)
+            if obj == None:
+                return self.respond(404)
+            self.send_response(200)
+            for k, v in self.object_headers(obj).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(obj['data'])))
+            self.end_headers()
+
+        def object_PUT(self, key, body):
+            storage_class = self.headers.get('x-amz-storage-class', 'STANDARD')
+            source = self.headers.get('x-amz-copy-source')
+            if source != None:
+                src_key = unquote(source).lstrip('/').partition('/')[2]
+                src = s3.objects.get(src_key)
+                if src == None:
+                    return self.error(404, 'NoSuchKey')
+                obj = s3.put_object(key, src['data'], dict(src['headers']), storage_class)
+                result = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<CopyObjectResult><LastModified>{0}</LastModified>'
+                          '<ETag>{1}</ETag></CopyObjectResult>'
+                          .format(iso_time(obj['modified']), escape(obj['etag'])))
+                return self.respond(200, result.encode('utf-8'),
+                                    {'Content-Type': 'application/xml'})
+
+            headers = dict((k, v) for k, v in self.headers.items()
+                           if k.lower() in ('cache-control', 'content-type'))
+            if_match = self.headers.get('If-Match')
+            if_none_match = self.headers.get('If-None-Match')
+            # The check and the write happen atomically, like on S3.
+            with s3.lock:
+                current = s3.objects.get(key)
+                if ((if_match != None and (current == None or current['etag'] != if_match)) or
+                        (if_none_match == '*' and current != None)):
+                    obj = None
+                else:
+                    obj = s3.put_object(key, body, headers, storage_class)
+            if obj == None:
+                return self.error(412, 'PreconditionFailed')
+            self.respond(200, headers={'ETag': obj['etag']})
+
+        def object_DELETE(self, key, body):
+            with s3.lock:
+                s3.objects.pop(key, None)
+            self.respond(204)
+
+        def list_objects(self, query):
+            prefix = query.get('prefix', '')
+            delimiter = query.get('delimiter', '')
+            contents = []
+            prefixes = set()
+            for key in sorted(s3.objects):
+                if not key.startswith(prefix):
+                    continue
+                rest = key[len(prefix):]
+                if delimiter != '' and delimiter in rest:
+                    prefixes.add(prefix + rest[:rest.index(delimiter) + 1])
+                    continue
+                obj = s3.objects[key]
+                contents.append(
+                    '<Contents><Key>{0}</Key><LastModified>{1}</LastModified>'
+                    '<ETag>{2}</ETag><Size>{3}</Size><StorageClass>{4}</StorageClass>'
+                    '</Contents>'.format(escape(key), iso_time(obj['modified']),
+                                         escape(obj['etag']), len(obj['data']),
+                                         obj['storage_class']))
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<ListBucketResult><Name>{0}</Name><Prefix>{1}</Prefix>'
+                    '<IsTruncated>false</IsTruncated>{2}{3}</ListBucketResult>'
+                    .format(s3.bucket_name, escape(prefix), ''.join(contents),
+                            ''.join('<CommonPrefixes><Prefix>{0}</Prefix></CommonPrefixes>'
+                                    .format(escape(p)) for p in sorted(prefixes))))
+            self.respond(200, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    return Handler
+
+
+ACL = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+       '<AccessControlPolicy><Owner><ID>owner</ID><DisplayName>owner</DisplayName></Owner>'
+       '<AccessControlList></AccessControlList></AccessControlPolicy>')
+
+
+def iso_time(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', t)
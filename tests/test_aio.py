@@ -0,0 +1,131 @@
+import asyncio, os, shutil, tempfile, threading, time, unittest
+
+import repoman.aio as aio
+from repoman.backend import ConflictError
+from repoman.backend.aio import AsyncDiskBackend
+from repoman.create import add_platform
+
+from tests.util import CollectionTestCase
+
+
+class AsyncBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = AsyncDiskBackend(self.root, jobs=4)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_json_round_trip(self):
+        b = self.backend
+        async def go():
+            token = await b.write_json_if(dict(n=1), 'x.json', None)
+            with self.assertRaises(ConflictError):
+                await b.write_json_if(dict(n=2), 'x.json', None)
+            obj, read_token = await b.read_json_versioned('x.json')
+            self.assertEqual((obj, read_token), (dict(n=1), token))
+            await b.write_json(dict(n=3), 'x.json')
+            return await b.read_json('x.json')
+        self.assertEqual(self.run_async(go()), dict(n=3))
+
+    def test_files(self):
+        b = self.backend
+        src = os.path.join(self.root, 'src')
+        with open(src, 'w') as f:
+            f.write('aa')
+        async def go():
+            await b.upload_file(src, 'dir/a')
+            await b.copy_file('dir/a', 'dir/sub/b')
+            await b.move_file('dir/sub/b', 'dir/c')
+            self.assertEqual(sorted(await b.list_dir('dir', 'files')), ['a', 'c'])
+            self.assertEqual(await b.get_md5('dir/a'), '4124bc0a9335c27f086f24ba207a4912')
+            self.assertEqual(await b.get_size('dir/c'), 2)
+            self.assertEqual(await b.list_sizes('dir'), dict(a=2, c=2))
+            await b.delete_file('dir/c')
+            self.assertEqual(await b.walk_files('dir'), ['a'])
+        self.run_async(go())
+
+    def test_runs_calls_concurrently(self):
+        lock = threading.Lock()
+        state = dict(running=0, most=0)
+        def slow():
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return threading.current_thread()
+        async def go():
+            return await asyncio.gather(*[self.backend.run(slow) for _ in range(8)])
+        threads = self.run_async(go())
+        # Calls run in the pool, at most `jobs` at a time.
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(state['most'], 4)
+
+
+class TraversalTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'two\n'})
+        self.push('1', {'a': 'beta\n'}, channel='beta')
+        add_platform.func(backend=self.backend, collection=self.root, id='win')
+        chan = self.load().get_platform('win').get_channel('stable')
+        chan.add_version('5', 'v5', [])
+
+    def ids(self, vsns):
+        return sorted((os.path.relpath(v.chan_dir, self.root), v.id) for v in vsns)
+
+    def test_all_latest_versions(self):
+        vsns = aio.run(aio.all_latest_versions, self.load())
+        self.assertEqual(self.ids(vsns), [('lin/beta', '1'), ('lin/stable', '2'),
+                                          ('win/stable', '5')])
+
+    def test_all_versions_where(self):
+        col = self.load()
+        expected = self.ids(col.all_versions_where(lambda id, name: True, cached=False))
+        self.assertEqual(len(expected), 4)
+        vsns = aio.run(aio.all_versions_where, self.load(), lambda id, name: True)
+        self.assertEqual(self.ids(vsns), expected)
+        vsns = aio.run(aio.all_versions_where, self.load(), lambda id, name: id == '1')
+        self.assertEqual(self.ids(vsns), [('lin/beta', '1'), ('lin/stable', '1')])
+
+    def test_loads_platforms_once(self):
+        col = self.load()
+        plat = col.get_platform('lin')
+        platforms = aio.run(aio.list_platforms, col)
+        # Storage isn't a platform, and loaded platforms are reused.
+        self.assertEqual(sorted(p.name for p in platforms), ['lin', 'win'])
+        self.assertIn(plat, platforms)
+
+    def test_skips_broken_channels(self):
+        with open(os.path.join(self.root, 'lin', 'beta', 'index.json'), 'w') as f:
+            f.write('not json')
+        vsns = aio.run(aio.all_latest_versions, self.load())
+        self.assertEqual(self.ids(vsns), [('lin/stable', '2'), ('win/stable', '5')])
+
+    def test_reads_platforms_concurrently(self):
+        col = self.load()
+        lock = threading.Lock()
+        state = dict(running=0, most=0)
+        read_json_versioned = col.backend.read_json_versioned
+        def slow_read(path):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return read_json_versioned(path)
+        col.backend.read_json_versioned = slow_read
+        try:
+            aio.run(aio.list_platforms, col)
+        finally:
+            del col.backend.read_json_versioned
+        self.assertEqual(state['most'], 2)
@@ -0,0 +1,97 @@
+import os, re, shutil, tempfile, unittest
+
+import repoman.repo as repo
+from repoman.backend.s3 import S3Backend, classify_error
+from repoman.backend.scheduler import RequestScheduler
+from repoman.caching import set_cache_control, nginx_header_map
+from repoman.push import push
+from repoman.storage import FileStorage
+
+from tests.fakes3 import FakeS3
+from tests.util import CollectionTestCase
+
+
+class FileKindTest(CollectionTestCase):
+    def test_kinds(self):
+        self.create(history_page_size=2)
+        col = self.load()
+        kinds = {
+            'storage/0123-a': 'storage',
+            'config.json': 'config',
+            'summary.json': 'config',
+            'gc/tombstones.json': 'config',
+            'gc/leases/x.json': 'config',
+            'lin/channels.json': 'platform',
+            'lin/stable/index.json': 'index',
+            'lin/stable/head.json': 'index',
+            'lin/stable/1.json': 'version',
+            'lin/stable/1.delta.json': 'version',
+            'lin/stable/history/abc.json': 'version',
+            'lin/stable/changes/1-2.json': 'version',
+        }
+        for path, kind in kinds.items():
+            # Storage paths are relative to the backend, the others to the
+            # collection.
+            if kind != 'storage':
+                path = os.path.join(col.path, path)
+            self.assertEqual(col.file_kind(path), kind, path)
+
+    def test_set_cache_control(self):
+        self.create()
+        self.run_command(set_cache_control, kind='index', value='no-cache')
+        self.run_command(set_cache_control, kind='version', value='')
+        policy = self.load().cache_control()
+        self.assertEqual(policy['index'], 'no-cache')
+        self.assertEqual(policy['version'], None)
+        self.assertEqual(policy['storage'], repo.DEFAULT_CACHE_CONTROL['storage'])
+
+    def test_nginx_header_map(self):
+        self.create()
+        conf = nginx_header_map(self.load())
+        rules = re.findall(r'"~([^"]*)" "([^"]*)";', conf)
+        def header(uri):
+            for pattern, value in rules:
+                if re.search(pattern, uri):
+                    return value
+        policy = repo.DEFAULT_CACHE_CONTROL
+        self.assertEqual(header('/storage/0123-a'), policy['storage'])
+        self.assertEqual(header('/lin/stable/index.json'), policy['index'])
+        self.assertEqual(header('/lin/stable/1.json'), policy['version'])
+        self.assertEqual(header('/lin/channels.json'), policy['platform'])
+        self.assertEqual(header('/config.json'), policy['config'])
+
+
+class S3HeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.build = tempfile.mkdtemp()
+        self.s3 = FakeS3()
+        self.backend = S3Backend(self.s3.bucket_name, conn=self.s3.connect(),
+                                 scheduler=RequestScheduler(classify_error, sleep=lambda s: None))
+        col = repo.Collection(self.backend, 'col', 'http://example.com/',
+                              FileStorage(self.backend, 'col/storage',
+                                          'http://example.com/storage/'))
+        col.save()
+        col.new_platform('lin').save()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.build)
+        self.s3.close()
+
+    def test_push_writes_headers_by_kind(self):
+        with open(os.path.join(self.build, 'a'), 'w') as f:
+            f.write('one\n')
+        repo.version_cache = repo.VersionCache()
+        push.func(backend=self.backend, collection='col', platform='lin', channel='stable',
+                  vsn_id='1', vsn_name='v1', vsn_path=self.build, watch=False,
+                  quiet_period=0, journal_dir=None, use_journal=False)
+        policy = repo.DEFAULT_CACHE_CONTROL
+        headers = dict((k, o['headers'].get('Cache-Control')) for k, o in self.s3.objects.items())
+        blobs = [k for k in headers if k.startswith('col/storage/')]
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(headers[blobs[0]], policy['storage'])
+        self.assertEqual(headers['col/lin/stable/1.json'], policy['version'])
+        self.assertEqual(headers['col/lin/stable/index.json'], policy['index'])
+        self.assertEqual(headers['col/lin/channels.json'], policy['platform'])
+        self.assertEqual(headers['col/config.json'], policy['config'])
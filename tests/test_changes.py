@@ -0,0 +1,54 @@
+import os
+
+from repoman.cleanup import mod_urls
+from repoman.migrate import migrate_storage
+
+from tests.util import CollectionTestCase, STORAGE_URL
+
+CDN_URL = 'http://cdn.example.com/'
+
+
+class ChangeManifestTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create(change_manifests=2)
+        self.push('1', {'a': 'one\n', 'b': 'same\n', 'c': 'gone\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.push('3', {'a': 'three\n', 'b': 'same\n', 'd': 'new\n'})
+
+    def manifest(self, from_id, to_id):
+        return self.read_json(os.path.join('lin', 'stable', 'changes',
+                                           '{0}-{1}.json'.format(from_id, to_id)))
+
+    def manifest_urls(self):
+        urls = []
+        changes_dir = os.path.join(self.root, 'lin', 'stable', 'changes')
+        for name in os.listdir(changes_dir):
+            obj = self.read_json(os.path.join(changes_dir, name))
+            urls += [src['Url'] for e in obj['Added'] + obj['Changed'] for src in e['Sources']]
+        return urls
+
+    def test_push_publishes_manifests_from_previous_versions(self):
+        names = sorted(os.listdir(os.path.join(self.root, 'lin', 'stable', 'changes')))
+        self.assertEqual(names, ['1-2.json', '1-3.json', '2-3.json'])
+        obj = self.manifest('1', '3')
+        self.assertEqual((obj['From'], obj['To']), ('1', '3'))
+        self.assertEqual([f['Path'] for f in obj['Added']], ['d'])
+        self.assertEqual([f['Path'] for f in obj['Changed']], ['a'])
+        self.assertEqual(obj['Removed'], ['c'])
+        self.assertEqual(self.manifest('1', '2')['Added'], [])
+
+    def test_mod_urls_rewrites_manifests(self):
+        self.run_command(mod_urls, match=STORAGE_URL, replace=CDN_URL, prefix=True,
+                         jobs=2, commit=True)
+        urls = self.manifest_urls()
+        self.assertEqual(len(urls), 5)
+        for url in urls:
+            self.assertTrue(url.startswith(CDN_URL), url)
+
+    def test_migrate_storage_rewrites_manifests(self):
+        self.run_command(migrate_storage, shard_depth=2, limit=None, commit=True)
+        for url in self.manifest_urls():
+            rel = url[len(STORAGE_URL):]
+            self.assertIn('/', rel)
+            self.assertTrue(os.path.isfile(os.path.join(self.root, 'storage', rel)), url)
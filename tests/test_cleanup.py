@@ -0,0 +1,146 @@
+import os, unittest
+
+from repoman.cleanup import obsolete_files, orphan_files, restore_files, mod_urls, UrlRewriter
+
+from tests.util import CollectionTestCase, STORAGE_URL
+
+
+class ObsoleteFilesTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.old = self.storage_files()
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.latest = self.storage_files()
+
+    def delete_obsolete(self):
+        self.run_command(obsolete_files, delete=True, archive=False, jobs=1)
+
+    def test_deletes_files_only_old_versions_use(self):
+        self.delete_obsolete()
+        self.assertEqual(len(self.storage_files()), 2)
+        self.assertTrue(self.storage_files() < self.latest)
+        self.assertEqual(len(self.old - self.storage_files()), 1)
+
+    def test_without_summary(self):
+        os.remove(os.path.join(self.root, 'summary.json'))
+        self.delete_obsolete()
+        self.assertEqual(len(self.storage_files()), 2)
+
+    def test_ignores_stale_summary(self):
+        # A summary which still lists version 1 must not get version 2's
+        # files deleted.
+        summary = self.read_json('summary.json')
+        summary['platforms']['lin']['stable'].update(id='1', name='v1')
+        self.write_json(summary, 'summary.json')
+        self.delete_obsolete()
+        col = self.load()
+        vsn = col.get_platform('lin').get_channel('stable').get_latest_vsn()
+        for f in vsn.files:
+            name = f.sources[0][len(STORAGE_URL):]
+            self.assertIn(name, self.storage_files())
+
+
+class OrphanFilesTest(CollectionTestCase):
+    def test_deletes_files_no_version_uses(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        linked = self.storage_files()
+        with open(os.path.join(self.root, 'storage', 'junk'), 'w') as f:
+            f.write('junk\n')
+        self.run_command(orphan_files, delete=True)
+        self.assertEqual(self.storage_files(), linked)
+
+
+class ArchiveFilesTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.latest = self.storage_files()
+        self.run_command(obsolete_files, delete=False, archive=True, jobs=2)
+        self.archived = self.storage_files() - self.latest
+
+    def test_archives_into_cold_directory(self):
+        self.assertEqual(len(self.archived), 1)
+        name = list(self.archived)[0]
+        self.assertTrue(name.startswith('cold/'), name)
+        self.assertEqual(self.storage_files() - self.archived, self.latest - set([name[5:]]))
+        self.assertEqual(set(self.load().storage.get_archived_files()), set([name[5:]]))
+
+    def test_restore_files(self):
+        name = list(self.archived)[0][5:]
+        self.run_command(restore_files, files=[name], restore_all=False, linked=False, jobs=1)
+        self.assertIn(name, self.storage_files())
+        self.assertEqual(self.load().storage.get_archived_files(), dict())
+        self.assert_links_resolve(self.load())
+
+    def test_push_restores_archived_files(self):
+        self.push('3', {'a': 'one\n', 'b': 'same\n'})
+        # The old file comes back instead of a new copy being uploaded.
+        self.assertEqual(self.storage_files(), self.latest | set([list(self.archived)[0][5:]]))
+        self.assertEqual(self.load().storage.get_archived_files(), dict())
+        self.assert_links_resolve(self.load())
+
+
+class ModUrlsTest(CollectionTestCase):
+    def mod_urls(self, match, replace, prefix=False, commit=True):
+        self.run_command(mod_urls, match=match, replace=replace, prefix=prefix,
+                         jobs=2, commit=commit)
+
+    def test_rewrites_versions_and_channels(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'two\n', 'b': 'new\n'})
+        self.push('1', {'a': 'one\n'}, channel='beta')
+        self.mod_urls('http://example.com/', 'http://cdn.example.com/', prefix=True)
+        col = self.load()
+        for vsn in col.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                self.assertTrue(f.sources[0].startswith('http://cdn.example.com/storage/'))
+        for chan in col.get_platform('lin').channels:
+            self.assertTrue(chan.url.startswith('http://cdn.example.com/lin/'), chan.url)
+
+    def test_dry_run_changes_nothing(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        before = self.read_json('lin/stable/1.json')
+        self.mod_urls(STORAGE_URL, 'http://cdn.example.com/', prefix=True, commit=False)
+        self.assertEqual(self.read_json('lin/stable/1.json'), before)
+
+    def test_saves_only_changed_versions(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'two\n'})
+        path = os.path.join(self.root, 'lin', 'stable', '1.json')
+        os.utime(path, (0, 0))
+        name = self.read_json('lin/stable/2.json')['Files'][0]['Sources'][0]['Url']
+        self.mod_urls(name, 'http://cdn.example.com/a')
+        self.assertEqual(os.path.getmtime(path), 0)
+        self.assertEqual(self.read_json('lin/stable/2.json')['Files'][0]['Sources'][0]['Url'],
+                         'http://cdn.example.com/a')
+
+
+class UrlRewriterTest(unittest.TestCase):
+    def test_prefix(self):
+        r = UrlRewriter('http://a/', 'http://b/', prefix=True)
+        self.assertEqual(r.rewrite('http://a/x'), 'http://b/x')
+        self.assertEqual(r.rewrite('http://c/http://a/x'), 'http://c/http://a/x')
+
+    def test_literal(self):
+        r = UrlRewriter('old', 'new')
+        self.assertEqual(r.rewrite('http://old/old'), 'http://new/new')
+
+    def test_regex(self):
+        r = UrlRewriter(r'^http://(\w+)\.example\.com/', r'https://cdn/\1/')
+        self.assertEqual(r.rewrite('http://s1.example.com/x'), 'https://cdn/s1/x')
+        self.assertEqual(r.rewrite('http://example.org/x'), 'http://example.org/x')
+
+    def test_records_changes(self):
+        r = UrlRewriter('a', 'b')
+        for url in ['a1', 'a2', 'a1', 'c']:
+            r.rewrite(url)
+        self.assertEqual(r.changes, {'a1': 'b1', 'a2': 'b2'})
+        self.assertEqual(r.examples(), [('a1', 'b1'), ('a2', 'b2')])
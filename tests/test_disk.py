@@ -0,0 +1,79 @@
+import errno, os, shutil, tempfile, unittest
+from unittest import mock
+
+import repoman.backend.disk as disk
+from repoman.backend.disk import DiskBackend
+
+DATA = b'file contents\n' * 1000
+
+
+def unsupported(*args):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+
+class UploadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'root')
+        self.src = os.path.join(self.tmp, 'src')
+        with open(self.src, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def upload(self, transfer='auto'):
+        self.backend = DiskBackend(self.root, transfer)
+        result = self.backend.upload_file(self.src, 'storage/dest')
+        with open(os.path.join(self.root, 'storage', 'dest'), 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        return result
+
+    def no_reflinks(self):
+        return mock.patch.object(disk, 'fcntl', mock.Mock(ioctl=mock.Mock(side_effect=unsupported)))
+
+    def no_ranges(self):
+        return mock.patch.object(disk.os, 'copy_file_range', side_effect=unsupported, create=True)
+
+    def test_falls_back_to_copy(self):
+        with self.no_reflinks(), self.no_ranges():
+            self.assertEqual(self.upload(), ('copy', len(DATA)))
+        self.assertEqual(self.backend.transfer_stats, dict(copy=(1, len(DATA))))
+        self.assertEqual(self.backend.transfer_summary(),
+                         '1 files by copy ({0} bytes copied)'.format(len(DATA)))
+
+    def test_range_copy(self):
+        if not hasattr(os, 'copy_file_range'):
+            self.skipTest('copy_file_range is not available.')
+        with self.no_reflinks():
+            self.assertEqual(self.upload(), ('range', len(DATA)))
+
+    def test_reflink_copies_nothing(self):
+        # Pretend the clone worked by copying the data behind the ioctl.
+        def clone(dest_fd, request, src_fd):
+            self.assertEqual(request, disk.FICLONE)
+            os.write(dest_fd, os.pread(src_fd, len(DATA), 0))
+        with mock.patch.object(disk, 'fcntl', mock.Mock(ioctl=clone)):
+            self.assertEqual(self.upload(), ('reflink', 0))
+
+    def test_hardlink(self):
+        self.assertEqual(self.upload('hardlink'), ('hardlink', 0))
+        self.assertTrue(os.path.samefile(self.src, os.path.join(self.root, 'storage', 'dest')))
+
+    def test_hardlink_falls_back_to_copy(self):
+        with mock.patch.object(disk.os, 'link', side_effect=unsupported):
+            self.assertEqual(self.upload('hardlink'), ('copy', len(DATA)))
+        self.assertFalse(os.path.samefile(self.src, os.path.join(self.root, 'storage', 'dest')))
+
+    def test_other_errors_leave_no_temporary_files(self):
+        def fail(*args):
+            raise OSError(errno.EIO, 'Input/output error')
+        backend = DiskBackend(self.root)
+        with mock.patch.object(disk, 'fcntl', mock.Mock(ioctl=fail)):
+            with self.assertRaises(OSError):
+                backend.upload_file(self.src, 'storage/dest')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'storage')), [])
+
+    def test_invalid_strategy(self):
+        with self.assertRaises(ValueError):
+            DiskBackend(self.root, 'teleport')
@@ -0,0 +1,74 @@
+import os, sys, hashlib
+from unittest import mock
+
+from repoman.gc import gc, Lease
+
+from tests.util import CollectionTestCase
+
+JUNK_MD5 = hashlib.md5(b'junk\n').hexdigest()
+JUNK = JUNK_MD5 + '-junk'
+
+
+class GcTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.linked = self.storage_files()
+        with open(os.path.join(self.root, 'storage', JUNK), 'w') as f:
+            f.write('junk\n')
+
+    def gc(self, grace=0, commit=True):
+        self.run_command(gc, grace=grace, commit=commit)
+
+    def test_deletes_unused_files_after_grace_period(self):
+        self.gc(grace=1)
+        self.assertIn(JUNK, self.storage_files())
+        self.assertIn(JUNK, self.read_json('gc/tombstones.json')['tombstones'])
+
+        self.gc(grace=0)
+        self.assertEqual(self.storage_files(), self.linked)
+        self.assertEqual(self.read_json('gc/tombstones.json')['tombstones'], dict())
+        self.assert_links_resolve(self.load())
+
+    def test_keeps_files_of_old_versions(self):
+        # Version 1's files aren't used by the latest version, but they're
+        # still linked.
+        self.gc(grace=0)
+        self.assertEqual(self.storage_files(), self.linked)
+
+    def test_dry_run_deletes_nothing(self):
+        self.gc(grace=0, commit=False)
+        self.assertIn(JUNK, self.storage_files())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'gc', 'tombstones.json')))
+
+    def test_keeps_leased_files(self):
+        lease = Lease(self.load())
+        lease.hold([JUNK_MD5])
+        self.gc(grace=0)
+        self.assertIn(JUNK, self.storage_files())
+        lease.release()
+        self.gc(grace=0)
+        self.assertNotIn(JUNK, self.storage_files())
+
+    def test_rechecks_leases_before_deleting(self):
+        # A push leases the file after gc read the leases the first time.
+        gc_module = sys.modules['repoman.gc']
+        with mock.patch.object(gc_module, 'leased_md5s', side_effect=[set(), set([JUNK_MD5])]):
+            self.gc(grace=0)
+        self.assertIn(JUNK, self.storage_files())
+        # It keeps its tombstone, so it's deleted once the push is done.
+        self.assertIn(JUNK, self.read_json('gc/tombstones.json')['tombstones'])
+
+    def test_reused_files_lose_their_tombstones(self):
+        self.gc(grace=1)
+        self.push('3', {'a': 'junk\n'})
+        self.gc(grace=0)
+        self.assertIn(JUNK, self.storage_files())
+        self.assertEqual(self.read_json('gc/tombstones.json')['tombstones'], dict())
+        self.assert_links_resolve(self.load())
+
+    def test_gc_directory_is_not_a_platform(self):
+        self.gc(grace=1)
+        self.assertEqual([p.name for p in self.load().list_platforms()], ['lin'])
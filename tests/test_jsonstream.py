@@ -0,0 +1,85 @@
+import io, json, unittest
+from unittest import mock
+
+import repoman.jsonstream as jsonstream
+from repoman.jsonstream import iter_members, dump_members
+
+VERSION = {
+    'ApiVersion': 0,
+    'Id':         '12345',
+    'Name':       'v1 "quoted" \\ back\\slash\ttab\nnewline',
+    'Files': [
+        {'Path': 'bin/app', 'MD5': 'd41d8cd98f00b204e9800998ecf8427e', 'Mode': 493,
+         'Executable': True, 'Size': 1234567890, 'Ratio': -1.5e-10},
+        {'Path': 'café/☃/\U0001f600.txt', 'MD5': '0' * 32, 'Mode': 420,
+         'Executable': False, 'Sources': [{'Url': 'http://example.com/a?b=c&d'}]},
+        {'Path': 'empty', 'Sources': [], 'Extra': None},
+    ],
+    'Trailing': 7,
+}
+
+
+class JsonStreamTest(unittest.TestCase):
+    def read(self, data, array_keys=('Files',)):
+        """
+        Reads the members of the given JSON bytes with every chunk size up to
+        a few dozen bytes, so values are cut off at every possible place.
+        Returns the object read with each chunk size.
+        """
+        results = []
+        for size in list(range(1, 40)) + [jsonstream.CHUNK_SIZE]:
+            with mock.patch.object(jsonstream, 'CHUNK_SIZE', size):
+                obj = dict()
+                for key, value in iter_members(io.BytesIO(data), array_keys):
+                    if key in array_keys:
+                        obj.setdefault(key, []).append(value)
+                    else:
+                        obj[key] = value
+                results.append(obj)
+        return results
+
+    def test_reads_json_dump_output(self):
+        for ensure_ascii in [True, False]:
+            for indent in [None, 2]:
+                data = json.dumps(VERSION, ensure_ascii=ensure_ascii,
+                                  indent=indent).encode('utf-8')
+                for obj in self.read(data):
+                    self.assertEqual(obj, VERSION)
+
+    def test_numbers_at_chunk_ends(self):
+        obj = dict(a=123456789, b=-0.25, c=[1, 22, 333], d=1e100)
+        for result in self.read(json.dumps(obj, separators=(',', ':')).encode('utf-8'), ()):
+            self.assertEqual(result, obj)
+
+    def test_empty_arrays_and_objects(self):
+        for result in self.read(b'{"Files": [], "Id": "1"}'):
+            self.assertEqual(result, dict(Id='1'))
+        for result in self.read(b'  {  }  '):
+            self.assertEqual(result, dict())
+        # Arrays under other keys are returned whole.
+        for result in self.read(b'{"Files": [{}], "Other": []}'):
+            self.assertEqual(result, dict(Files=[{}], Other=[]))
+
+    def test_dump_matches_json_dump(self):
+        members = [(k, iter(v) if k == 'Files' else v) for k, v in VERSION.items()]
+        out = io.BytesIO()
+        dump_members(out, members)
+        self.assertEqual(out.getvalue(), json.dumps(VERSION).encode('utf-8'))
+
+        out = io.BytesIO()
+        dump_members(out, [('Files', iter([])), ('Id', '1')])
+        self.assertEqual(json.loads(out.getvalue().decode('utf-8')), dict(Files=[], Id='1'))
+
+    def test_round_trip(self):
+        out = io.BytesIO()
+        dump_members(out, [(k, iter(v) if k == 'Files' else v) for k, v in VERSION.items()])
+        for obj in self.read(out.getvalue()):
+            self.assertEqual(obj, VERSION)
+
+    def test_rejects_broken_json(self):
+        for data in [b'', b'[]', b'{"a": 1', b'{"a" 1}', b'{"a": 1 "b": 2}',
+                     b'{"Files": [1 2]}', b'{"a": "unterminated}', b'{1: 2}']:
+            with self.assertRaises(ValueError, msg=data):
+                list(iter_members(io.BytesIO(data), ('Files',)))
+        with self.assertRaisesRegex(ValueError, 'Expected "," or "}" but found \'"\''):
+            list(iter_members(io.BytesIO(b'{"a": 1 "b": 2}')))
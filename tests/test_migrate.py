@@ -0,0 +1,98 @@
+import os, re
+
+from repoman.migrate import migrate_storage
+from repoman.cleanup import mod_urls
+
+from tests.util import CollectionTestCase, STORAGE_URL
+
+
+class MigrateStorageTest(CollectionTestCase):
+    def migrate(self, limit=None, commit=True):
+        self.run_command(migrate_storage, shard_depth=2, limit=limit, commit=commit)
+
+    def flat_files(self):
+        return set(p for p in self.storage_files() if '/' not in p)
+
+    def push_versions(self):
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n', 'c/d': 'new\n'})
+        self.push('3', {'a': 'three\n', 'b': 'same\n'})
+
+    def assert_sharded(self, col):
+        for vsn in col.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                for url in f.sources:
+                    rel = url[len(STORAGE_URL):]
+                    self.assertEqual(rel[:5], '{0}/{1}'.format(f.md5[:2], f.md5[2:4]), url)
+
+    def test_moves_files_into_shards(self):
+        self.create()
+        self.push_versions()
+        names = self.flat_files()
+        self.migrate()
+        self.assertEqual(self.flat_files(), set())
+        self.assertEqual(set(os.path.basename(p) for p in self.storage_files()), names)
+        col = self.load()
+        self.assertEqual(col.storage.shard_depth, 2)
+        self.assert_sharded(col)
+        self.assert_links_resolve(col)
+
+        # New pushes go straight into shard directories.
+        self.push('4', {'a': 'four\n'})
+        self.assertEqual(self.flat_files(), set())
+        self.assert_links_resolve(self.load())
+
+    def test_dry_run_changes_nothing(self):
+        self.create()
+        self.push_versions()
+        files = self.storage_files()
+        config = self.read_json('config.json')
+        self.migrate(commit=False)
+        self.assertEqual(self.storage_files(), files)
+        self.assertEqual(self.read_json('config.json'), config)
+
+    def test_limit_migrates_in_steps(self):
+        self.create()
+        self.push_versions()
+        total = len(self.flat_files())
+        self.migrate(limit=2)
+        # Copied files are gone from the top level, and everything still
+        # resolves while the rest waits.
+        self.assertEqual(len(self.flat_files()), total - 2)
+        self.assert_links_resolve(self.load())
+        self.migrate()
+        self.assertEqual(self.flat_files(), set())
+        self.assert_links_resolve(self.load())
+
+    def test_keeps_files_linked_through_other_urls(self):
+        self.create()
+        self.push_versions()
+        names = self.flat_files()
+        # Move the URLs to a CDN which serves the top-level storage directory.
+        self.run_command(mod_urls, match=STORAGE_URL, replace='http://cdn.example.com/',
+                         prefix=True, jobs=1, commit=True)
+        self.migrate()
+        self.assertEqual(self.flat_files(), names)
+        col = self.load()
+        for vsn in col.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                self.assertEqual(f.sources, ['http://cdn.example.com/' + os.path.basename(f.sources[0])])
+
+    def test_delta_versions(self):
+        self.create(delta_snapshot_interval=10)
+        self.push_versions()
+        # A version with the same files as the one it's based on.
+        self.push('4', {'a': 'three\n', 'b': 'same\n'})
+        self.migrate()
+        self.assertEqual(self.flat_files(), set())
+        col = self.load()
+        self.assert_sharded(col)
+        self.assert_links_resolve(col)
+        # Every version file, delta or not, was rewritten.
+        chan_dir = os.path.join(self.root, 'lin', 'stable')
+        for dir, _, names in os.walk(chan_dir):
+            for name in names:
+                with open(os.path.join(dir, name)) as f:
+                    urls = re.findall(re.escape(STORAGE_URL) + '[^"]*', f.read())
+                for url in urls:
+                    self.assertIn('/', url[len(STORAGE_URL):], url)
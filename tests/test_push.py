@@ -0,0 +1,189 @@
+import importlib, io, os, stat, tarfile, zipfile
+from unittest import mock
+
+from repoman.push import push
+from repoman.storage import FileStorage
+
+from tests.util import CollectionTestCase
+
+# `repoman.push` is the command, which hides the module of the same name.
+push_module = importlib.import_module('repoman.push')
+
+
+class ArchivePushTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+
+    def push_archive(self, name, vsn_id='1'):
+        self.run_command(push, platform='lin', channel='stable', vsn_id=vsn_id,
+                         vsn_name='v' + vsn_id, vsn_path=os.path.join(self.tmp, name),
+                         watch=False, quiet_period=0, journal_dir=None, use_journal=False)
+
+    def files(self, vsn_id='1'):
+        col = self.load()
+        vsn = col.get_platform('lin').get_channel('stable').get_version(vsn_id)
+        return dict((f.path, f) for f in vsn.files)
+
+    def make_zip(self, name, members):
+        """
+        Writes a zip with the given `(ZipInfo or name, data)` members.
+        """
+        with zipfile.ZipFile(os.path.join(self.tmp, name), 'w') as zf:
+            for info, data in members:
+                zf.writestr(info, data)
+
+    def make_tar(self, name, members):
+        """
+        Writes a tar with the given `(TarInfo, data)` members.
+        """
+        with tarfile.open(os.path.join(self.tmp, name), 'w:gz') as tar:
+            for info, data in members:
+                if data != None:
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                else:
+                    tar.addfile(info)
+
+    def zip_info(self, name, mode):
+        info = zipfile.ZipInfo(name)
+        if mode == 0:
+            info.create_system = 0
+            info.external_attr = 0x20
+        else:
+            info.external_attr = mode << 16
+        return info
+
+    def tar_info(self, name, mode=0o644, type=tarfile.REGTYPE, linkname=''):
+        info = tarfile.TarInfo(name)
+        info.mode = mode
+        info.type = type
+        info.linkname = linkname
+        return info
+
+    def test_zip_permissions(self):
+        self.make_zip('v.zip', [
+            # `writestr` with a plain name stores 0o600 with no file type.
+            ('bin/x', b'x\n'),
+            (self.zip_info('y', stat.S_IFREG | 0o755), b'y\n'),
+            # Zips made on Windows only have MS-DOS attributes, like the
+            # archive bit.
+            (self.zip_info('z', 0), b'z\n'),
+            (self.zip_info('dir/', stat.S_IFDIR | 0o755), b''),
+        ])
+        self.push_archive('v.zip')
+        files = self.files()
+        self.assertEqual(sorted(files), ['bin/x', 'y', 'z'])
+        self.assertEqual(files['bin/x'].perms, 0o600)
+        self.assertFalse(files['bin/x'].executable)
+        self.assertEqual(files['y'].perms, 0o755)
+        self.assertTrue(files['y'].executable)
+        self.assertEqual(files['z'].perms, 0o644)
+        self.assert_links_resolve(self.load())
+
+    def test_tar_permissions(self):
+        self.make_tar('v.tar.gz', [
+            (self.tar_info('bin', type=tarfile.DIRTYPE, mode=0o755), None),
+            (self.tar_info('bin/x', mode=0o755), b'x\n'),
+            (self.tar_info('y', mode=0o640), b'y\n'),
+            (self.tar_info('fifo', type=tarfile.FIFOTYPE), None),
+        ])
+        self.push_archive('v.tar.gz')
+        files = self.files()
+        self.assertEqual(sorted(files), ['bin/x', 'y'])
+        self.assertEqual(files['bin/x'].perms, 0o755)
+        self.assertTrue(files['bin/x'].executable)
+        self.assertEqual(files['y'].perms, 0o640)
+        self.assert_links_resolve(self.load())
+
+    def test_archive_and_directory_pushes_share_files(self):
+        self.push('1', {'a': 'one\n'})
+        self.make_zip('v.zip', [('a', b'one\n'), ('b', b'two\n')])
+        self.push_archive('v.zip', vsn_id='2')
+        self.assertEqual(len(self.storage_files()), 2)
+        self.assertEqual(self.files('2')['a'].sources, self.files('1')['a'].sources)
+
+    def assert_refused(self, name):
+        with self.assertRaises((ValueError, SystemExit)):
+            self.push_archive(name)
+        self.assertEqual(self.load().get_platform('lin').get_channel('stable').versions, [])
+
+    def test_zip_links_are_refused(self):
+        self.make_zip('v.zip', [
+            ('a', b'a\n'),
+            (self.zip_info('link', stat.S_IFLNK | 0o777), b'a'),
+        ])
+        self.assert_refused('v.zip')
+
+    def test_tar_links_are_refused(self):
+        self.make_tar('sym.tar.gz', [
+            (self.tar_info('a'), b'a\n'),
+            (self.tar_info('link', type=tarfile.SYMTYPE, linkname='a'), None),
+        ])
+        self.assert_refused('sym.tar.gz')
+        self.make_tar('hard.tar.gz', [
+            (self.tar_info('a'), b'a\n'),
+            (self.tar_info('link', type=tarfile.LNKTYPE, linkname='a'), None),
+        ])
+        self.assert_refused('hard.tar.gz')
+
+    def test_paths_outside_the_archive_are_refused(self):
+        self.make_zip('up.zip', [('../evil', b'x\n')])
+        self.assert_refused('up.zip')
+        self.make_tar('up.tar.gz', [(self.tar_info('a/../../evil'), b'x\n')])
+        self.assert_refused('up.tar.gz')
+        self.make_tar('abs.tar.gz', [(self.tar_info('/etc/evil'), b'x\n')])
+        self.assert_refused('abs.tar.gz')
+
+    def test_archives_without_files_are_refused(self):
+        self.make_zip('empty.zip', [(self.zip_info('dir/', stat.S_IFDIR | 0o755), b'')])
+        with self.assertRaises(SystemExit):
+            self.push_archive('empty.zip')
+        self.assertEqual(self.load().get_platform('lin').get_channel('stable').versions, [])
+
+
+class JournalTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        self.journal_dir = os.path.join(self.tmp, 'journals')
+        os.mkdir(self.build)
+        for name in ['a', 'b', 'c', 'd']:
+            with open(os.path.join(self.build, name), 'w') as f:
+                f.write(name + '\n')
+
+    def push_build(self):
+        try:
+            self.run_command(push, platform='lin', channel='stable', vsn_id='1',
+                             vsn_name='v1', vsn_path=self.build, watch=False,
+                             quiet_period=0, journal_dir=self.journal_dir, use_journal=True)
+        finally:
+            os.chdir(self.root)
+
+    def test_resumes_interrupted_push(self):
+        add_file = FileStorage.add_file
+        uploads = []
+        def fail_second_upload(storage, file):
+            if len(uploads) == 1:
+                raise OSError('Interrupted.')
+            uploads.append(file)
+            return add_file(storage, file)
+        with mock.patch.object(FileStorage, 'add_file', fail_second_upload):
+            with self.assertRaises(OSError):
+                self.push_build()
+        self.assertEqual(len(self.storage_files()), 1)
+
+        # Nothing is hashed again, and only the missing files are uploaded.
+        with mock.patch.object(push_module, 'hash_file', wraps=push_module.hash_file) as hash_file:
+            with mock.patch.object(FileStorage, 'add_file', autospec=True,
+                                   side_effect=add_file) as add:
+                self.push_build()
+        self.assertEqual(hash_file.call_count, 0)
+        self.assertEqual(add.call_count, 3)
+        self.assertEqual(len(self.storage_files()), 4)
+        self.assert_links_resolve(self.load())
+
+        # Pushing the same files again finds the version was saved.
+        self.push_build()
+        self.assertEqual([v['id'] for v in self.load().get_platform('lin')
+                          .get_channel('stable').versions], ['1'])
@@ -0,0 +1,292 @@
+import os, unittest
+
+import repoman.repo as repo
+from repoman.backend import ConflictError
+from repoman.cleanup import mod_urls
+
+from tests.util import CollectionTestCase
+
+
+class MergeTest(CollectionTestCase):
+    """
+    Tests for saving channel and platform files which other processes changed
+    since they were loaded.
+    """
+    def channel(self):
+        chan = self.load().get_platform('lin').get_channel('stable')
+        chan.load_index()
+        return chan
+
+    def index_ids(self):
+        obj = self.read_json(os.path.join('lin', 'stable', 'index.json'))
+        return [v['Id'] for v in obj['Versions']]
+
+    def test_concurrent_pushes_keep_both_versions(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        a = self.channel()
+        b = self.channel()
+        a.add_version('2', 'v2', [])
+        b.add_version('3', 'v3', [])
+        self.assertEqual([v['id'] for v in self.channel().versions], ['1', '2', '3'])
+
+    def test_concurrent_channel_creation(self):
+        self.create()
+        a = self.load().get_platform('lin')
+        b = self.load().get_platform('lin')
+        a.get_channel('stable')
+        b.get_channel('beta')
+        plat = self.load().get_platform('lin')
+        self.assertEqual(sorted(ch.id for ch in plat.channels), ['beta', 'stable'])
+
+    def test_gives_up_after_repeated_conflicts(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        chan = self.channel()
+        chan.versions.append(dict(id='2', name='v2'))
+        # Another writer pushes a version right before each of our writes.
+        backend = chan.backend
+        write_json_if = backend.write_json_if
+        ids = iter(range(100, 200))
+        def push_and_write(obj, path, token):
+            other = backend.read_json(path)
+            other['Versions'].append(dict(Id=str(next(ids)), Name='other'))
+            backend.write_json(other, path)
+            return write_json_if(obj, path, token)
+        backend.write_json_if = push_and_write
+        try:
+            with self.assertRaises(ConflictError):
+                chan.save_index()
+        finally:
+            del backend.write_json_if
+        self.assertNotIn('2', self.index_ids())
+
+    def test_history_pages_keep_every_version(self):
+        self.create(history_page_size=2)
+        self.push('1', {'a': 'one\n'})
+        a = self.channel()
+        b = self.channel()
+        for i in range(2, 12, 2):
+            a.add_version(str(i), 'v', [])
+            b.add_version(str(i + 1), 'v', [])
+        chan = self.channel()
+        ids = [v['id'] for v in chan.all_version_entries()]
+        self.assertEqual(ids, [str(i) for i in range(1, 12)])
+        self.assertGreater(len(chan.pages), 0)
+        self.assertEqual(self.index_ids(), ids)
+
+    def test_legacy_index_is_written_from_newest_head(self):
+        self.create(history_page_size=2)
+        self.push('1', {'a': 'one\n'})
+        a = self.channel()
+        b = self.channel()
+        a.add_version('2', 'v2', [])
+        b.add_version('3', 'v3', [])
+        # A's write of the legacy index comes in late, after B's head and
+        # index. It must not drop B's version.
+        a.save_legacy_index()
+        self.assertEqual(self.index_ids(), ['1', '2', '3'])
+
+    def test_legacy_index_limit(self):
+        self.create(history_page_size=2, index_limit=3)
+        self.push('1', {'a': 'one\n'})
+        chan = self.channel()
+        for i in range(2, 8):
+            chan.add_version(str(i), 'v', [])
+        self.assertEqual(self.index_ids(), ['5', '6', '7'])
+        self.assertEqual([v['id'] for v in self.channel().all_version_entries()],
+                         [str(i) for i in range(1, 8)])
+
+
+class VersionCacheTest(CollectionTestCase):
+    def test_uncached_versions_are_copies(self):
+        self.create(delta_snapshot_interval=4)
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'one\n'})
+        chan = self.load().get_platform('lin').get_channel('stable')
+        # Version 2 is built from version 1, which mustn't show our change.
+        for vsn in chan.all_versions_where(lambda id, name: True, cached=False):
+            self.assertNotEqual(vsn.files[0].sources, ['changed'])
+            vsn.files[0].sources = ['changed']
+
+    def test_watch_pushes_stay_within_budget(self):
+        self.create(delta_snapshot_interval=4)
+        self.push('1', {'a': 'one\n'})
+        chan = self.load().get_platform('lin').get_channel('stable')
+        cache = chan.cache
+        cache.max_entries = 3
+        # Like push --watch, one process adds version after version.
+        for i in range(2, 10):
+            chan.add_version(str(i), 'v', [])
+        self.assertLessEqual(len(cache.entries), 3)
+        self.assertEqual(list(cache.pinned.values()), [(chan.path, '8')])
+
+
+class DeltaVersionTest(CollectionTestCase):
+    def delta(self, id):
+        return self.read_json(os.path.join('lin', 'stable', id + '.delta.json'))
+
+    def files(self, vsn):
+        return dict((f.path, f.md5) for f in vsn.files)
+
+    def push_versions(self):
+        self.push('1', {'a': 'one\n', 'b': 'same\n', 'c': 'gone\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n', 'd': 'new\n'})
+        self.push('3', {'a': 'three\n', 'b': 'same\n', 'd': 'new\n'})
+        self.push('4', {'a': 'four\n', 'b': 'same\n'})
+
+    def test_saves_only_differences(self):
+        self.create(delta_snapshot_interval=10)
+        self.push_versions()
+        first = self.delta('1')
+        self.assertEqual(first['Base'], None)
+        self.assertEqual(sorted(f['Path'] for f in first['Files']), ['a', 'b', 'c'])
+        second = self.delta('2')
+        self.assertEqual(second['Base'], '1')
+        self.assertEqual([f['Path'] for f in second['Added']], ['d'])
+        self.assertEqual([f['Path'] for f in second['Changed']], ['a'])
+        self.assertEqual(second['Removed'], ['c'])
+
+    def test_resolves_to_full_versions(self):
+        self.create(delta_snapshot_interval=10)
+        self.push_versions()
+        # The legacy full version files are the reference.
+        chan_dir = os.path.join(self.root, 'lin', 'stable')
+        chan = self.load().get_platform('lin').get_channel('stable')
+        vsns = list(chan.all_versions_where(lambda id, name: True, cached=False))
+        self.assertEqual([v.id for v in vsns], ['1', '2', '3', '4'])
+        for vsn in vsns:
+            full = repo.Version.load(self.backend, chan_dir, vsn.id, vsn.name)
+            self.assertEqual(self.files(vsn), self.files(full))
+            self.assertEqual(vsn.delta_depth, int(vsn.id) - 1)
+        self.assertEqual(self.files(self.load().get_platform('lin').get_channel('stable')
+                                    .get_version('3')),
+                         self.files(vsns[2]))
+
+    def test_snapshot_interval_limits_chain_length(self):
+        self.create(delta_snapshot_interval=3)
+        for i in range(1, 8):
+            self.push(str(i), {'a': '{0}\n'.format(i)})
+        self.assertEqual([self.delta(str(i))['Depth'] for i in range(1, 8)],
+                         [0, 1, 2, 0, 1, 2, 0])
+        self.assertEqual([self.delta(str(i))['Base'] for i in range(1, 8)],
+                         [None, '1', '2', None, '4', '5', None])
+        # Loading a version only goes back as far as the last snapshot.
+        vsn = self.load().get_platform('lin').get_channel('stable').get_version('6')
+        chain = []
+        while vsn != None:
+            chain.append(vsn.id)
+            vsn = vsn.base
+        self.assertEqual(chain, ['6', '5', '4'])
+
+    def test_rewriting_urls_keeps_deltas_small(self):
+        self.create(delta_snapshot_interval=10)
+        self.push_versions()
+        self.run_command(mod_urls, match='http://example.com/', replace='http://cdn.example.com/',
+                         prefix=True, jobs=1, commit=True)
+        second = self.delta('2')
+        self.assertEqual([f['Path'] for f in second['Changed']], ['a'])
+        self.assertEqual([f['Path'] for f in second['Added']], ['d'])
+        self.assertTrue(second['Changed'][0]['Sources'][0]['Url'].startswith('http://cdn.example.com/'))
+        self.assertEqual([f['Path'] for f in self.delta('3')['Changed']], ['a'])
+        chan = self.load().get_platform('lin').get_channel('stable')
+        for vsn in chan.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                self.assertTrue(f.sources[0].startswith('http://cdn.example.com/'), f.sources)
+
+
+def version(chan, id, files=0):
+    return repo.Version(None, chan, id, id, [repo.UpdateFile('f{0}'.format(i), 'x', 0o644,
+                                                             ['u'], False)
+                                             for i in range(files)])
+
+
+class VersionCacheLimitsTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = repo.VersionCache(max_entries=2)
+        for id in ['1', '2']:
+            cache.put(('c', id), version('c', id))
+        cache.get(('c', '1'))
+        cache.put(('c', '3'), version('c', '3'))
+        self.assertEqual(list(cache.entries), [('c', '1'), ('c', '3')])
+
+    def test_byte_budget(self):
+        size = repo.version_size(version('c', '1', files=10))
+        cache = repo.VersionCache(max_bytes=size * 2)
+        for id in ['1', '2', '3']:
+            cache.put(('c', id), version('c', id, files=10))
+        self.assertEqual(list(cache.entries), [('c', '2'), ('c', '3')])
+        self.assertEqual(cache.size, size * 2)
+
+    def test_one_pinned_version_per_channel(self):
+        cache = repo.VersionCache(max_entries=2)
+        for chan in ['c', 'd']:
+            cache.put((chan, '1'), version(chan, '1'))
+            cache.pin((chan, '1'))
+        cache.put(('c', '2'), version('c', '2'))
+        # Pinned versions are kept, even over the limit.
+        self.assertEqual(list(cache.entries), [('c', '1'), ('d', '1')])
+
+        # Pinning a channel's new latest version unpins the old one.
+        cache.max_entries = 3
+        cache.put(('c', '2'), version('c', '2'))
+        cache.pin(('c', '2'))
+        cache.put(('c', '3'), version('c', '3'))
+        self.assertEqual(list(cache.entries), [('d', '1'), ('c', '2'), ('c', '3')])
+        self.assertEqual(sorted(cache.pinned.values()), [('c', '2'), ('d', '1')])
+
+
+class ObjectCacheTest(CollectionTestCase):
+    def test_lookups_return_the_same_objects(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        col = self.load()
+        plat = col.get_platform('lin')
+        self.assertIs(col.get_platform('lin'), plat)
+        self.assertIs(plat.get_channel('stable'), plat.get_channel('stable'))
+        self.assertIs(list(col.list_platforms())[0], plat)
+
+    def test_channel_indexes_load_lazily(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        chan = self.load().get_platform('lin').get_channel('stable')
+        self.assertFalse(chan.index_loaded)
+        self.assertEqual([v['id'] for v in chan.versions], ['1'])
+        self.assertTrue(chan.index_loaded)
+
+    def test_refresh_picks_up_changes_by_others(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        col = self.load()
+        plat = col.get_platform('lin')
+        chan = plat.get_channel('stable')
+        self.assertEqual(len(chan.versions), 1)
+        self.push('2', {'a': 'two\n'})
+        self.push('1', {'a': 'one\n'}, channel='beta')
+        # Nothing changes until the collection is refreshed.
+        self.assertEqual(len(chan.versions), 1)
+        col.refresh()
+        self.assertIs(plat.get_channel('stable'), chan)
+        self.assertEqual([v['id'] for v in chan.versions], ['1', '2'])
+        self.assertEqual(sorted(ch.id for ch in plat.channels), ['beta', 'stable'])
+
+    def test_save_keeps_loaded_channels(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        col = self.load()
+        chan = col.get_platform('lin').get_channel('stable')
+        col.options['delta_versions'] = dict(snapshot_interval=4)
+        col.save()
+        self.assertIs(col.get_platform('lin').get_channel('stable'), chan)
+        self.assertEqual(chan.delta_versions, dict(snapshot_interval=4))
+
+    def test_save_reloads_index_when_history_changes(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        col = self.load()
+        chan = col.get_platform('lin').get_channel('stable')
+        chan.load_index()
+        col.options['history'] = dict(page_size=2)
+        col.save()
+        self.assertFalse(chan.index_loaded)
+        self.assertEqual([v['id'] for v in chan.versions], ['1'])
@@ -0,0 +1,183 @@
+import unittest
+
+from boto.exception import S3ResponseError, BotoServerError
+
+import repoman.repo as repo
+from repoman.backend import ConflictError
+from repoman.backend.s3 import S3Backend, classify_error, RETRY_POLICIES
+from repoman.backend.scheduler import RequestScheduler, RetryPolicy
+from repoman.storage import FileStorage
+
+from tests.fakes3 import FakeS3
+
+
+class S3BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.scheduler = RequestScheduler(classify_error, max_concurrency=8,
+                                          default_policy=RetryPolicy(max_retries=3),
+                                          policies=RETRY_POLICIES,
+                                          sleep=lambda s: None)
+        self.backend = S3Backend(self.s3.bucket_name, conn=self.s3.connect(),
+                                 scheduler=self.scheduler)
+
+    def tearDown(self):
+        self.s3.close()
+
+    def requests(self, method):
+        return [r for r in self.s3.requests if r[0] == method]
+
+    def test_round_trip(self):
+        self.backend.write_json(dict(a=1), 'col/config.json')
+        self.assertEqual(self.backend.read_json('col/config.json'), dict(a=1))
+        self.assertEqual(self.backend.list_dir('col', 'files'), ['config.json'])
+
+    def test_retries_throttled_requests(self):
+        self.backend.write_json(dict(a=1), 'x.json')
+        self.s3.fail(2, 'GET')
+        self.assertEqual(self.backend.read_json('x.json'), dict(a=1))
+        m = self.scheduler.metrics()
+        self.assertEqual(m['retries'], 2)
+        self.assertEqual(m['throttled'], 2)
+        self.assertEqual(m['failures'], 0)
+        # Throttling lowers the concurrency limit.
+        self.assertLess(self.scheduler.limit, 8)
+
+    def test_retries_server_errors_without_throttling(self):
+        self.s3.fail(1, 'PUT', status=500, code='InternalError')
+        self.backend.write_json(dict(a=1), 'x.json')
+        self.assertEqual(self.backend.read_json('x.json'), dict(a=1))
+        self.assertEqual(self.scheduler.metrics()['throttled'], 0)
+        self.assertGreaterEqual(self.scheduler.limit, 8)
+
+    def test_gives_up_after_max_retries(self):
+        self.backend.write_json(dict(a=1), 'x.json')
+        self.s3.fail(4, 'GET')
+        with self.assertRaises(BotoServerError):
+            self.backend.read_json('x.json')
+        self.assertEqual(len(self.requests('GET')), 4)
+        self.assertEqual(self.scheduler.metrics()['failures'], 1)
+
+    def test_listings_retry_longer(self):
+        self.backend.write_json(dict(a=1), 'dir/x.json')
+        # More failures than the default policy allows.
+        self.s3.fail(4, 'GET')
+        self.assertEqual(self.backend.list_dir('dir', 'files'), ['x.json'])
+
+    def test_client_errors_are_not_retried(self):
+        self.s3.fail(1, 'GET', status=403, code='AccessDenied')
+        with self.assertRaises(S3ResponseError):
+            self.backend.get_contents('x.json')
+        self.assertEqual(self.scheduler.metrics()['retries'], 0)
+
+    def test_conditional_writes(self):
+        b = self.backend
+        token = b.write_json_if(dict(n=1), 'x.json', None)
+        # Creating it again fails.
+        with self.assertRaises(ConflictError):
+            b.write_json_if(dict(n=2), 'x.json', None)
+        obj, read_token = b.read_json_versioned('x.json')
+        self.assertEqual(obj, dict(n=1))
+        self.assertEqual(read_token, token)
+        self.assertEqual(b.get_token('x.json'), token)
+
+        b.write_json_if(dict(n=2), 'x.json', token)
+        # The old token is stale now.
+        with self.assertRaises(ConflictError):
+            b.write_json_if(dict(n=3), 'x.json', token)
+        self.assertEqual(b.read_json('x.json'), dict(n=2))
+        self.assertEqual(b.read_json_versioned('missing.json'), (None, None))
+        self.assertEqual(b.get_token('missing.json'), None)
+
+    def test_failed_conditional_writes_are_not_retried(self):
+        token = self.backend.write_json_if(dict(n=1), 'x.json', None)
+        self.backend.write_json(dict(n=2), 'x.json')
+        puts = len(self.requests('PUT'))
+        with self.assertRaises(ConflictError):
+            self.backend.write_json_if(dict(n=3), 'x.json', token)
+        self.assertEqual(len(self.requests('PUT')), puts + 1)
+
+    def test_listing_md5s_and_sizes(self):
+        b = self.backend
+        b.set_contents('aa', 'storage/a')
+        b.set_contents('bbb', 'storage/sub/b')
+        self.assertEqual(b.list_md5s('storage'), dict(a='4124bc0a9335c27f086f24ba207a4912'))
+        self.assertEqual(b.list_sizes('storage'), dict(a=2))
+        self.assertEqual(b.walk_sizes('storage'), {'a': 2, 'sub/b': 3})
+        self.assertEqual(sorted(b.list_dir('storage', 'dirs')), ['sub'])
+        self.assertEqual(b.get_md5('storage/a'), '4124bc0a9335c27f086f24ba207a4912')
+        self.assertEqual(b.get_size('storage/sub/b'), 3)
+        self.assertEqual(b.get_md5('storage/missing'), None)
+
+    def test_archives_in_place(self):
+        b = self.backend
+        b.set_contents('aa', 'storage/a')
+        b.archive_file('storage/a', 'storage/a')
+        obj = self.s3.objects['storage/a']
+        self.assertEqual(obj['storage_class'], 'STANDARD_IA')
+        self.assertEqual(obj['data'], b'aa')
+        self.assertEqual(b.walk_archived('storage'), ['a'])
+        b.restore_file('storage/a', 'storage/a')
+        self.assertEqual(self.s3.objects['storage/a']['storage_class'], 'STANDARD')
+        self.assertEqual(b.walk_archived('storage'), [])
+
+    def test_storage_archives_in_place(self):
+        b = self.backend
+        b.set_contents('aa', 'storage/a')
+        b.set_contents('bb', 'storage/b')
+        md5 = b.get_md5('storage/a')
+        storage = FileStorage(b, 'storage', 'http://example.com/storage/')
+        self.assertEqual(storage.archive_file('a'), 'storage/a')
+        self.assertEqual(sorted(self.s3.objects), ['storage/a', 'storage/b'])
+
+        # A fresh load tells archived files apart by their storage class, and
+        # finding one restores it where it is.
+        storage = FileStorage(b, 'storage', 'http://example.com/storage/')
+        self.assertEqual(storage.get_archived_files(), dict(a=md5))
+        self.assertFalse(storage.is_md5_present(md5))
+        self.assertEqual(storage.file_for_md5(md5), 'storage/a')
+        self.assertEqual(self.s3.objects['storage/a']['storage_class'], 'STANDARD')
+        self.assertEqual(storage.get_archived_files(), dict())
+
+
+class S3CollectionTest(unittest.TestCase):
+    """
+    Tests which use a collection stored in the S3 stand-in, to check merges
+    go through S3's conditional writes.
+    """
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.conn = self.s3.connect()
+        b = self.backend()
+        col = repo.Collection(b, 'col', 'http://example.com/',
+                              FileStorage(b, 'col/storage', 'http://example.com/storage/'))
+        col.save()
+        col.new_platform('lin').save()
+
+    def tearDown(self):
+        self.s3.close()
+
+    def backend(self):
+        scheduler = RequestScheduler(classify_error, sleep=lambda s: None)
+        return S3Backend(self.s3.bucket_name, conn=self.conn, scheduler=scheduler)
+
+    def test_concurrent_channel_creation(self):
+        a = repo.Collection.load(self.backend(), 'col').get_platform('lin')
+        b = repo.Collection.load(self.backend(), 'col').get_platform('lin')
+        a.get_channel('stable')
+        # The write conflicts and is retried after a throttled attempt.
+        self.s3.fail(1, 'PUT')
+        b.get_channel('beta')
+        plat = repo.Collection.load(self.backend(), 'col').get_platform('lin')
+        self.assertEqual(sorted(ch.id for ch in plat.channels), ['beta', 'stable'])
+
+    def test_concurrent_pushes_to_one_channel(self):
+        repo.Collection.load(self.backend(), 'col').get_platform('lin').get_channel('stable')
+        a = repo.Collection.load(self.backend(), 'col').get_platform('lin').get_channel('stable')
+        b = repo.Collection.load(self.backend(), 'col').get_platform('lin').get_channel('stable')
+        a.load_index()
+        b.load_index()
+        a.add_version('1', 'v1', [])
+        b.add_version('2', 'v2', [])
+        chan = repo.Collection.load(self.backend(), 'col').get_platform('lin').get_channel('stable')
+        self.assertEqual([v['id'] for v in chan.versions], ['1', '2'])
@@ -0,0 +1,91 @@
+import hashlib, io, json, os, tarfile
+
+from repoman.backend.disk import DiskBackend
+from repoman.snapshot import export, import_collection, MANIFEST_NAME
+
+from tests.util import CollectionTestCase
+
+
+class SnapshotTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create(delta_snapshot_interval=4)
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.archive = os.path.join(self.tmp, 'export.tar.gz')
+        self.dest = os.path.join(self.tmp, 'imported')
+
+    def export(self, with_storage):
+        self.run_command(export, archive=self.archive, with_storage=with_storage, jobs=2)
+
+    def import_archive(self):
+        import_collection.func(backend=DiskBackend(self.dest), collection=self.dest,
+                               archive=self.archive, jobs=2)
+
+    def imported_path(self, path):
+        # Storage files keep their path relative to the backend root, which
+        # is the collection here.
+        return os.path.join(self.dest, os.path.relpath(path, self.root))
+
+    def assert_imported(self, files):
+        for kind, path, md5 in files:
+            with open(path, 'rb') as a, open(self.imported_path(path), 'rb') as b:
+                self.assertEqual(a.read(), b.read(), path)
+
+    def write_archive(self, members, manifest_files=None):
+        """
+        Writes an archive with the given `(name, kind, data)` members. The
+        manifest lists them with their MD5s unless other entries are given.
+        """
+        if manifest_files == None:
+            manifest_files = [dict(name=name, kind=kind, md5=hashlib.md5(data).hexdigest())
+                              for name, kind, data in members]
+        manifest = dict(format_version=0, storage_path='storage', files=manifest_files)
+        with tarfile.open(self.archive, 'w:gz') as tar:
+            for name, data in ([(MANIFEST_NAME, json.dumps(manifest).encode('utf-8'))] +
+                               [(name, data) for name, _, data in members]):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    def test_round_trip_without_storage(self):
+        self.export(False)
+        self.import_archive()
+        self.assert_imported(self.load().list_files(storage=False))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'storage')))
+
+    def test_round_trip_with_storage(self):
+        self.export(True)
+        self.import_archive()
+        files = self.load().list_files()
+        self.assertGreater(len([f for f in files if f[0] == 'storage']), 0)
+        self.assert_imported(files)
+
+    def test_rejects_corrupt_members(self):
+        self.write_archive([('collection/config.json', 'config', b'{}')],
+                           [dict(name='collection/config.json', kind='config',
+                                 md5=hashlib.md5(b'{"a": 1}').hexdigest())])
+        with self.assertRaisesRegex(IOError, 'corrupt'):
+            self.import_archive()
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'config.json')))
+
+    def test_rejects_paths_outside_the_collection(self):
+        for name in ['collection/../evil', 'storage/../../evil', 'other/evil']:
+            self.write_archive([(name, 'config', b'evil\n')])
+            with self.assertRaisesRegex(IOError, 'Unsafe'):
+                self.import_archive()
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'evil')))
+
+    def test_rejects_members_missing_from_the_manifest(self):
+        self.write_archive([('collection/config.json', 'config', b'{}')], [])
+        with self.assertRaisesRegex(IOError, 'not in the manifest'):
+            self.import_archive()
+
+    def test_rejects_manifest_files_missing_from_the_archive(self):
+        data = b'{}'
+        files = [dict(name=name, kind='config', md5=hashlib.md5(data).hexdigest())
+                 for name in ['collection/config.json', 'collection/summary.json']]
+        self.write_archive([('collection/config.json', 'config', data)], files)
+        with self.assertRaisesRegex(IOError, '1 files from the manifest are missing'):
+            self.import_archive()
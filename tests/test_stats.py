@@ -0,0 +1,48 @@
+import contextlib, io, json, os
+
+from repoman.stats import stats, format_bytes
+
+from tests.util import CollectionTestCase
+
+
+class StatsTest(CollectionTestCase):
+    def stats(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.run_command(stats, as_json=True, jobs=2)
+        text = out.getvalue()
+        return json.loads(text[text.index('{'):])
+
+    def test_two_versions(self):
+        self.create()
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two!\n', 'b': 'same\n'})
+        with open(os.path.join(self.root, 'storage', 'junk'), 'w') as f:
+            f.write('orphan\n')
+        s = self.stats()
+        # Version 1 links 4 + 5 bytes and version 2 links 5 + 5 bytes, of
+        # which `b` is shared.
+        self.assertEqual(s['versions'], 2)
+        self.assertEqual(s['referenced_bytes'], 19)
+        self.assertEqual(s['unique_bytes'], 14)
+        self.assertAlmostEqual(s['dedup_ratio'], 19 / 14)
+        self.assertEqual(s['stored_files'], 4)
+        self.assertEqual(s['stored_bytes'], 21)
+        self.assertEqual((s['orphan_files'], s['orphan_bytes']), (1, 7))
+        # Version 1's `a` and the orphan aren't used by the latest version.
+        self.assertEqual((s['obsolete_files'], s['obsolete_bytes']), (2, 11))
+        self.assertEqual(s['missing_files'], 0)
+        ch = s['platforms']['lin']['channels']['stable']
+        self.assertEqual((ch['latest_id'], ch['latest_bytes']), ('2', 10))
+        self.assertEqual(ch['files'], 4)
+
+    def test_empty_collection(self):
+        self.create()
+        s = self.stats()
+        self.assertEqual(s['versions'], 0)
+        self.assertEqual(s['dedup_ratio'], None)
+
+    def test_format_bytes(self):
+        self.assertEqual(format_bytes(10), '10 B')
+        self.assertEqual(format_bytes(1536), '1.5 KiB')
+        self.assertEqual(format_bytes(3 * 1024 ** 4), '3.0 TiB')
@@ -0,0 +1,115 @@
+import os
+
+from repoman.backend.disk import DiskBackend
+from repoman.cleanup import obsolete_files, orphan_files
+from repoman.create import add_storage_partition
+from repoman.storage import FileStorage, PartitionedStorage, DEFAULT_PARTITION, hash_file
+
+from tests.util import CollectionTestCase, STORAGE_URL
+
+PARTITION_URL = 'http://example.com/storage2/'
+
+
+def build_files(prefix, count):
+    return dict(('f{0}'.format(i), '{0} {1}\n'.format(prefix, i)) for i in range(count))
+
+
+class PartitionedStorageTest(CollectionTestCase):
+    def storage(self):
+        return PartitionedStorage({
+            DEFAULT_PARTITION: FileStorage(self.backend, 'storage', STORAGE_URL),
+            'p2': FileStorage(self.backend, 'storage2', PARTITION_URL),
+        })
+
+    def write_files(self, files):
+        paths = []
+        for name, data in sorted(files.items()):
+            path = os.path.join(self.tmp, name)
+            with open(path, 'w') as f:
+                f.write(data)
+            paths.append(path)
+        return paths
+
+    def test_places_files_by_md5(self):
+        storage = self.storage()
+        placed = dict()
+        for path in self.write_files(build_files('data', 32)):
+            md5 = hash_file(path)
+            dest = storage.add_file(path)
+            part = storage.partition_for(md5)
+            self.assertTrue(dest.startswith(part.path + '/'), dest)
+            self.assertEqual(storage.url_for(dest), part.url + os.path.basename(dest))
+            self.assertEqual(storage.file_for_md5(md5), dest)
+            placed[part.path] = placed.get(part.path, 0) + 1
+        # Both partitions get a share.
+        self.assertEqual(sorted(placed), ['storage', 'storage2'])
+
+        # A fresh storage object finds every file and lists them all.
+        storage = self.storage()
+        self.assertEqual(len(storage.get_all_files()), 32)
+        self.assertEqual(len(storage.get_file_sizes()), 32)
+
+    def test_partitions_need_separate_paths(self):
+        with self.assertRaises(ValueError):
+            PartitionedStorage({
+                DEFAULT_PARTITION: FileStorage(self.backend, 'storage', STORAGE_URL),
+                'p2': FileStorage(self.backend, 'storage/p2', PARTITION_URL),
+            })
+
+
+class PartitionedCollectionTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+
+    def add_partition(self):
+        self.run_command(add_storage_partition, name='p2', path='storage2',
+                         url=PARTITION_URL, bucket=None, dir=None)
+
+    def partition_files(self, path):
+        return set(DiskBackend(self.root).walk_files(path))
+
+    def assert_links_resolve(self, col):
+        for vsn in col.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                url = f.sources[0]
+                if url.startswith(PARTITION_URL):
+                    path = os.path.join(self.root, 'storage2', url[len(PARTITION_URL):])
+                else:
+                    path = os.path.join(self.root, 'storage', url[len(STORAGE_URL):])
+                self.assertEqual(hash_file(path), f.md5, url)
+
+    def test_finds_files_placed_before_partitions_were_added(self):
+        old = build_files('old', 16)
+        self.push('1', old)
+        before = self.storage_files()
+        self.add_partition()
+        new = dict(old)
+        new.update(build_files('new', 16))
+        self.push('2', new)
+        # The old files are reused where they are, and only new ones are
+        # spread over both partitions.
+        self.assertEqual(self.storage_files() & before, before)
+        self.assertEqual(len(self.storage_files()) + len(self.partition_files('storage2')), 32)
+        self.assertGreater(len(self.partition_files('storage2')), 0)
+        self.assert_links_resolve(self.load())
+
+    def test_cleanup_covers_every_partition(self):
+        self.add_partition()
+        self.push('1', build_files('one', 16))
+        self.push('2', build_files('two', 16))
+        for path in ['storage', 'storage2']:
+            with open(os.path.join(self.root, path, 'junk-' + path), 'w') as f:
+                f.write('junk\n')
+        self.run_command(orphan_files, delete=True)
+        self.assertNotIn('junk-storage', self.storage_files())
+        self.assertNotIn('junk-storage2', self.partition_files('storage2'))
+        self.assertEqual(len(self.storage_files()) + len(self.partition_files('storage2')), 32)
+
+        self.run_command(obsolete_files, delete=True, archive=False, jobs=1)
+        self.assertEqual(len(self.storage_files()) + len(self.partition_files('storage2')), 16)
+        self.assertGreater(len(self.partition_files('storage2')), 0)
+        latest = self.load().get_platform('lin').get_channel('stable').get_latest_vsn()
+        for f in latest.files:
+            self.assertIn(os.path.basename(f.sources[0]),
+                          self.storage_files() | self.partition_files('storage2'))
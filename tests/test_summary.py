@@ -0,0 +1,31 @@
+import os
+
+from repoman.summary import rebuild_summary
+
+from tests.util import CollectionTestCase
+
+
+class SummaryTest(CollectionTestCase):
+    def test_push_keeps_summary_up_to_date(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'two\n', 'b': 'new\n'}, channel='beta')
+        summary = self.read_json('summary.json')['platforms']['lin']
+        self.assertEqual(summary['stable']['id'], '1')
+        self.assertEqual(summary['beta'], dict(id='2', name='v2', files=2, bytes=8))
+
+    def test_push_does_not_create_partial_summary(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        os.remove(os.path.join(self.root, 'summary.json'))
+        self.push('2', {'a': 'two\n'}, channel='beta')
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'summary.json')))
+
+    def test_rebuild(self):
+        self.create()
+        self.push('1', {'a': 'one\n'})
+        self.push('2', {'a': 'two\n', 'b': 'new\n'}, channel='beta')
+        summary = self.read_json('summary.json')
+        os.remove(os.path.join(self.root, 'summary.json'))
+        self.run_command(rebuild_summary)
+        self.assertEqual(self.read_json('summary.json'), summary)
@@ -0,0 +1,127 @@
+import json, os
+
+import repoman.repo as repo
+from repoman.backend.disk import DiskBackend
+from repoman.backend.s3 import S3Backend, classify_error
+from repoman.backend.scheduler import RequestScheduler
+from repoman.sync import Syncer
+
+from tests.fakes3 import FakeS3
+from tests.util import CollectionTestCase
+
+
+class SyncTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create(delta_snapshot_interval=4)
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+        self.push('2', {'a': 'two\n', 'b': 'same\n'})
+        self.mirror = os.path.join(self.tmp, 'mirror')
+        self.checkpoint = os.path.join(self.tmp, 'checkpoint.json')
+
+    def syncer(self, dest=None, dest_path='', checkpoint=None):
+        if dest == None:
+            dest = DiskBackend(self.mirror)
+        return Syncer(self.load(), dest, dest_path, jobs=1, checkpoint=checkpoint)
+
+    def mirror_path(self, path):
+        """
+        Returns where the given source path ends up in the mirror.
+        """
+        return os.path.join(self.mirror, os.path.relpath(path, self.root))
+
+    def test_mirrors_every_file(self):
+        self.syncer().run()
+        files = self.load().list_files()
+        for kind, path, md5 in files:
+            with open(path, 'rb') as a, open(self.mirror_path(path), 'rb') as b:
+                self.assertEqual(a.read(), b.read(), path)
+        repo.version_cache = repo.VersionCache()
+        mirror = repo.Collection.load(DiskBackend(self.mirror), self.mirror)
+        vsn = mirror.get_platform('lin').get_channel('stable').get_latest_vsn()
+        self.assertEqual(vsn.id, '2')
+
+    def test_copies_in_phases(self):
+        syncer = self.syncer()
+        copy_file = syncer.copy_file
+        copied = []
+        def record(src, dest, md5):
+            copied.append(dest)
+            copy_file(src, dest, md5)
+        syncer.copy_file = record
+        syncer.run()
+        kinds = [repo.FILE_KINDS.index(syncer.kinds[d]) for d in copied]
+        self.assertEqual(kinds, sorted(kinds))
+        # Storage files come first, and the config last.
+        self.assertEqual(syncer.kinds[copied[0]], 'storage')
+        self.assertEqual(syncer.kinds[copied[-1]], 'config')
+        self.assertEqual(len(copied), len(self.load().list_files()))
+
+    def test_second_run_copies_nothing(self):
+        self.syncer().run()
+        syncer = self.syncer()
+        syncer.run()
+        self.assertEqual(syncer.copied, 0)
+        self.assertEqual(syncer.skipped, len(self.load().list_files()))
+
+        # Only the files of a new version are copied.
+        self.push('3', {'a': 'three\n', 'b': 'same\n'})
+        syncer = self.syncer()
+        syncer.run()
+        self.assertGreater(syncer.copied, 0)
+        self.assertLess(syncer.copied, syncer.skipped)
+
+    def test_resumes_from_checkpoint(self):
+        total = len(self.load().list_files())
+        dest = DiskBackend(self.mirror)
+        upload_file = dest.upload_file
+        uploads = []
+        def fail_fourth_upload(src, path):
+            if len(uploads) == 3:
+                raise OSError('Interrupted.')
+            uploads.append(path)
+            return upload_file(src, path)
+        dest.upload_file = fail_fourth_upload
+        with self.assertRaises(OSError):
+            self.syncer(dest, checkpoint=self.checkpoint).run()
+        with open(self.checkpoint) as f:
+            self.assertEqual(sorted(json.load(f)), sorted(uploads))
+
+        syncer = self.syncer(checkpoint=self.checkpoint)
+        syncer.run()
+        self.assertEqual(syncer.copied, total - 3)
+        self.assertEqual(syncer.skipped, 3)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class S3SyncTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3 = FakeS3()
+        self.create()
+        self.push('1', {'a': 'one\n', 'b': 'same\n'})
+
+    def tearDown(self):
+        self.s3.close()
+        super().tearDown()
+
+    def dest(self):
+        scheduler = RequestScheduler(classify_error, sleep=lambda s: None)
+        return S3Backend(self.s3.bucket_name, conn=self.s3.connect(), scheduler=scheduler)
+
+    def test_mirrors_to_s3(self):
+        col = self.load()
+        Syncer(col, self.dest(), 'mirror', jobs=2).run()
+        policy = col.cache_control()
+        for kind, path, md5 in col.list_files():
+            if kind == 'storage':
+                key = path
+            else:
+                key = os.path.join('mirror', os.path.relpath(path, self.root))
+            obj = self.s3.objects[key]
+            self.assertEqual(obj['etag'], '"{0}"'.format(md5), key)
+            self.assertEqual(obj['headers'].get('Cache-Control'), policy.get(kind), key)
+
+        syncer = Syncer(self.load(), self.dest(), 'mirror', jobs=2)
+        syncer.run()
+        self.assertEqual(syncer.copied, 0)
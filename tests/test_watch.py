@@ -0,0 +1,99 @@
+import importlib, os, shutil, tempfile, unittest
+
+from repoman.watch import InotifyWatcher, PollingWatcher
+
+from tests.util import CollectionTestCase
+
+# `repoman.push` is the command, which hides the module of the same name.
+push_module = importlib.import_module('repoman.push')
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class UpdateEntryTest(CollectionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create()
+        os.mkdir(self.build)
+        os.chdir(self.build)
+        for path in ['a', 'd/x', 'd/y', 'dx']:
+            write(path, path + '\n')
+        self.storage = self.load().storage
+        self.files = dict()
+        for p in push_module.walk_dir('.'):
+            md5 = push_module.hash_file(p).hexdigest()
+            self.files[p] = push_module.file_entry(self.storage, p, md5)
+
+    def update(self, path):
+        return push_module.update_entry(self.storage, self.files, path)
+
+    def test_changed_files(self):
+        old = self.files['a'][0]
+        self.assertFalse(self.update('a'))
+        write('a', 'changed\n')
+        self.assertTrue(self.update('a'))
+        f, size = self.files['a']
+        self.assertNotEqual(f.md5, old.md5)
+        self.assertEqual(size, len('changed\n'))
+        self.assertEqual(self.storage.file_for_md5(f.md5).split('/')[0], 'storage')
+
+        os.chmod('a', 0o755)
+        self.assertTrue(self.update('a'))
+        self.assertTrue(self.files['a'][0].executable)
+
+    def test_new_files(self):
+        write('d/z', 'new\n')
+        self.assertTrue(self.update(os.path.join('d', 'z')))
+        self.assertIn(os.path.join('d', 'z'), self.files)
+
+    def test_removed_files(self):
+        os.remove('a')
+        self.assertTrue(self.update('a'))
+        self.assertNotIn('a', self.files)
+        # Nothing is left to remove the second time.
+        self.assertFalse(self.update('a'))
+
+    def test_removed_directories(self):
+        self.assertFalse(self.update('d'))
+        shutil.rmtree('d')
+        self.assertTrue(self.update('d'))
+        # Only files under the directory go, not ones which share a prefix.
+        self.assertEqual(sorted(self.files), ['a', 'dx'])
+
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        write(os.path.join(self.root, 'a'), 'a\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def watcher(self):
+        return PollingWatcher(self.root)
+
+    def test_changes(self):
+        watcher = self.watcher()
+        try:
+            self.assertEqual(watcher.changes(0.05), set())
+            write(os.path.join(self.root, 'a'), 'longer\n')
+            self.assertEqual(watcher.changes(0.05), set(['a']))
+            write(os.path.join(self.root, 'sub', 'b'), 'b\n')
+            self.assertIn(os.path.join('sub', 'b'), watcher.changes(0.05))
+            os.remove(os.path.join(self.root, 'a'))
+            self.assertEqual(watcher.changes(0.05), set(['a']))
+            self.assertEqual(watcher.changes(0.05), set())
+        finally:
+            watcher.close()
+
+
+class InotifyWatcherTest(WatcherTest):
+    def watcher(self):
+        try:
+            return InotifyWatcher(self.root)
+        except OSError as e:
+            self.skipTest('inotify is not available: {0}'.format(e))
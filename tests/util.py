@@ -0,0 +1,97 @@
+# Helpers for tests which run commands against a collection on disk.
+
+import os, shutil, tempfile, unittest
+
+import repoman.repo as repo
+from repoman.backend.disk import DiskBackend
+from repoman.create import create, add_platform
+from repoman.push import push
+from repoman.storage import hash_file
+
+STORAGE_URL = 'http://example.com/storage/'
+
+
+class CollectionTestCase(unittest.TestCase):
+    """
+    Base class for tests which need a collection in a temporary directory.
+
+    Commands are called the way `main` calls them from inside the collection:
+    with a disk backend rooted at the collection and the collection's
+    absolute path.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'col')
+        self.build = os.path.join(self.tmp, 'build')
+        os.mkdir(self.root)
+        os.chdir(self.root)
+        self.backend = DiskBackend(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def create(self, history_page_size=None, index_limit=None,
+               delta_snapshot_interval=None, change_manifests=None):
+        create.func(backend=self.backend, path=self.root, url='http://example.com/',
+                    storage_path='storage', storage_url=STORAGE_URL,
+                    history_page_size=history_page_size, index_limit=index_limit,
+                    delta_snapshot_interval=delta_snapshot_interval,
+                    change_manifests=change_manifests)
+        os.mkdir(os.path.join(self.root, 'storage'))
+        add_platform.func(backend=self.backend, collection=self.root, id='lin')
+
+    def run_command(self, cmd, **kwargs):
+        # Commands normally run in a process of their own, which starts with
+        # an empty version cache.
+        repo.version_cache = repo.VersionCache()
+        return cmd.func(backend=self.backend, collection=self.root, **kwargs)
+
+    def push(self, vsn_id, files, channel='stable'):
+        """
+        Pushes a version of the given channel whose files are given as a
+        dictionary mapping paths to contents.
+        """
+        shutil.rmtree(self.build, ignore_errors=True)
+        for path, data in files.items():
+            full = os.path.join(self.build, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full, 'w') as f:
+                f.write(data)
+        self.run_command(push, platform='lin', channel=channel, vsn_id=vsn_id,
+                         vsn_name='v' + vsn_id, vsn_path=self.build, watch=False,
+                         quiet_period=0, journal_dir=None, use_journal=False)
+        # Push changes into the directory it pushes from.
+        os.chdir(self.root)
+
+    def load(self):
+        repo.version_cache = repo.VersionCache()
+        return repo.Collection.load(self.backend, self.root)
+
+    def storage_files(self):
+        """
+        Returns the paths of all files in storage, relative to the storage
+        directory.
+        """
+        return set(self.backend.walk_files('storage'))
+
+    def read_json(self, path):
+        return self.backend.read_json(os.path.join(self.root, path))
+
+    def write_json(self, obj, path):
+        self.backend.write_json(obj, os.path.join(self.root, path))
+
+    def assert_links_resolve(self, col):
+        """
+        Checks that every storage URL in every version of the collection
+        points at a file in storage with the contents it should have.
+        """
+        for vsn in col.all_versions_where(lambda id, name: True, cached=False):
+            for f in vsn.files:
+                for url in f.sources:
+                    self.assertTrue(url.startswith(STORAGE_URL), url)
+                    rel = url[len(STORAGE_URL):]
+                    path = os.path.join(self.root, 'storage', rel)
+                    self.assertTrue(os.path.isfile(path), url)
+                    self.assertEqual(hash_file(path), f.md5)